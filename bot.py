@@ -2,46 +2,149 @@ from pathlib import Path
 
 from dotenv import dotenv_values
 
+from utils import metrics, tracing
+from utils.assets import AssetStore
+from utils.cluster import WorkerSpec, shard_of
+from utils.command_sync import SIGNATURE_FILE, TreeSyncer
 from utils.config import BotConfig
+from utils.database import Database
+from utils.dedup import backfill_index
+from utils.ipc import Peer
+from utils.migrations import migrate
+from utils.outbound import OutboundScheduler
+from utils.rounds.answer_matching import compile_cache_hit_ratio
+from utils.rounds.checkpoint import SessionStore
+from utils.rounds.deck import DeckCache
+from utils.rounds.router import AnswerRouter
+from utils.timer_wheel import TimerWheel
 
 BOT_DIR = Path(__file__).absolute().parent
 cfg = BotConfig(dotenv_values(BOT_DIR / ".env"))
 
-if not cfg.dev:
-    try:
-        import pyjion
-
-        pyjion.enable()
-    except ImportError as e:
-        print(e)
-
 import asyncio
-import jishaku
 import logging
 import logging.handlers
+import math
+import signal
 import sys
 from pathlib import Path
+from typing import Any, Optional
 
-import aiosqlite
 import discord
 from discord.ext import commands
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot
+from discord.webhook.async_ import async_context
 
 
-class MountainBot(Bot):
+class MountainBot(AutoShardedBot):
     cfg: BotConfig
-    db: aiosqlite.Connection
-
-    def __init__(self, *args, **kwargs):
+    db: Database
+    answers: AnswerRouter
+    decks: DeckCache
+    outbound: OutboundScheduler
+    timers: TimerWheel
+    assets: AssetStore
+    checkpoints: SessionStore
+    syncer: TreeSyncer
+    ipc: Peer
+
+    def __init__(self, *args, ipc: Optional[Peer] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        # alone unless started by launcher.py, as worker 0 of a cluster of one
+        self.ipc = ipc or Peer(0)
+        self.answers = AnswerRouter()
+        self.decks = DeckCache()
+        self.outbound = OutboundScheduler()
+        self.timers = TimerWheel()
+        self.syncer = TreeSyncer(self.tree, BOT_DIR / SIGNATURE_FILE)
+        # interaction responses go through the webhook adapter, not self.http
+        tracing.instrument_http(self.http)
+        tracing.instrument_http(async_context.get())
+        self.ipc.handle("invalidate_pack", self.decks.invalidate)
+        self.ipc.handle("status", self.cluster_status)
+
+    @property
+    def primary(self) -> bool:
+        """Whether this process does what only one worker of a cluster should, e.g. syncing commands."""
+        return self.ipc.worker == 0
+
+    def owns(self, guild_id: Optional[int]) -> bool:
+        """Whether the events of a guild, or of direct messages if None, come to this process."""
+        if self.shard_ids is None or self.shard_count is None:
+            return True
+        return shard_of(guild_id, self.shard_count) in self.shard_ids
+
+    def cluster_status(self, _: Any = None) -> dict[str, Any]:
+        """This worker's shards, for the owner commands of the cluster."""
+        shards = []
+        for (id, shard) in sorted(self.shards.items()):
+            latency = shard.latency if math.isfinite(shard.latency) else None
+            guilds = sum(1 for guild in self.guilds if guild.shard_id == id)
+            shards.append({"id": id, "latency": latency, "guilds": guilds})
+        return {
+            "shards": shards,
+            "loop_lag": metrics.recent_loop_lag(),
+            "games": len(self.answers),
+        }
+
+    async def before_identify_hook(self, shard_id: Optional[int], *, initial=False):
+        if self.ipc.connected and shard_id is not None:
+            # identifies are limited for the whole bot, not per process
+            await self.ipc.identify(shard_id)
+        else:
+            await super().before_identify_hook(shard_id, initial=initial)
+
+    async def on_shard_connect(self, shard_id: int):
+        shard = str(shard_id)
+        metrics.SHARD_LOOP_LAG_SECONDS.labels(shard).set_function(
+            metrics.recent_loop_lag
+        )
+        metrics.SHARD_LATENCY_SECONDS.labels(shard).set_function(
+            lambda: self.get_shard(shard_id).latency  # type: ignore
+        )
+
+
+async def load_extensions(bot: MountainBot):
+    """Load every cog, and jishaku in dev mode, concurrently."""
+    extensions = [f"cogs.{file.stem}" for file in (BOT_DIR / "cogs").glob("*.py")]
+    if cfg.dev:
+        extensions.insert(0, "jishaku")
 
+    results = await asyncio.gather(
+        *(bot.load_extension(extension) for extension in extensions),
+        return_exceptions=True,
+    )
+    for (extension, result) in zip(extensions, results):
+        if isinstance(result, BaseException):
+            print(f"Failed to load extension {extension}")
+            print(f"{type(result).__name__}: {result}")
+        else:
+            print(f"Loaded {extension}")
+
+
+async def startup(worker: Optional[WorkerSpec] = None):
+    """
+    Run the bot until it is closed.
+
+    Optional parameters
+    -------------------
+    worker: The shards to run and the cluster to join, in a process started by
+        launcher.py (default: run every shard, alone)
+    """
+    if not cfg.dev:
+        try:
+            import pyjion
+
+            pyjion.enable()
+        except ImportError as e:
+            print(e)
 
-async def startup():
     logger = logging.getLogger("discord")
     logger.setLevel(logging.DEBUG)
 
     handler = logging.handlers.RotatingFileHandler(
-        filename="discord.log",
+        # a file per worker: processes can't rotate a shared one safely
+        filename="discord.log" if worker is None else f"discord-{worker.id}.log",
         encoding="utf-8",
         maxBytes=32 * 1024 * 1024,  # 32 MiB
         backupCount=5,  # Rotate through 5 files
@@ -53,31 +156,71 @@ async def startup():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    (intents := discord.Intents.default()).message_content = True
-    bot = MountainBot(command_prefix=commands.when_mentioned_or("!"), intents=intents)
+    # commands slower than tracing.SLOW_TRACE, with their spans
+    tracing.log.setLevel(logging.INFO)
+    tracing.log.addHandler(handler)
+    logging.getLogger("utils.ipc").addHandler(handler)
+    logging.getLogger("utils.dedup").addHandler(handler)
+
+    token = cfg.token
+    if worker is None:
+        (ipc, shards, path) = (Peer(0), {}, BOT_DIR / "database" / "database.sqlite3")
+    else:
+        ipc = Peer(worker.id, worker.ipc_path)
+        shards = {
+            "shard_ids": list(worker.shard_ids),
+            "shard_count": worker.shard_count,
+        }
+        path = Path(worker.database)
+        if worker.api_base is not None and worker.gateway_url is not None:
+            from utils.fake_gateway import FakeDiscord
+
+            FakeDiscord.install(worker.api_base, worker.gateway_url)
+            token = "fake"
 
-    if cfg.dev:
-        await bot.load_extension("jishaku")
-        print("Loaded jishaku")
-
-    for file in (BOT_DIR / "cogs").glob("*.py"):
-        try:
-            await bot.load_extension(f"cogs.{file.stem}")
-            print(f"Loaded cogs.{file.stem}")
-        except Exception as e:
-            print(f"Failed to load extension cogs.{file.stem}")
-            print(f"{type(e).__name__}: {e}")
+    (intents := discord.Intents.default()).message_content = True
+    bot = MountainBot(
+        command_prefix=commands.when_mentioned_or("!"),
+        intents=intents,
+        ipc=ipc,
+        **shards,
+    )
+    # launcher.py stops workers with SIGTERM: close the bot to run the finally below
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, lambda: asyncio.ensure_future(bot.close())
+    )
 
-    async with aiosqlite.connect(BOT_DIR / "database" / "database.sqlite3") as db:
-        with (BOT_DIR / "database" / "schema.sql").open() as f:
-            await db.executescript(f.read())
-        await db.commit()
+    async with Database(path, shared=worker is not None) as db:
+        # migrations run on the database's threads meanwhile
+        (_, applied) = await asyncio.gather(load_extensions(bot), migrate(db))
+        for migration in applied:
+            print(f"Applied migration {migration}")
 
         bot.db = db
         bot.cfg = cfg
-
+        bot.assets = AssetStore(BOT_DIR / "assets", db)
+        bot.checkpoints = SessionStore(db)
+
+        metrics.ACTIVE_SESSIONS.set_function(lambda: len(bot.answers))
+        metrics.DB_READERS_IN_USE.set_function(lambda: db.stats.readers_in_use)
+        metrics.CACHE_HIT_RATIO.labels("decks").set_function(
+            lambda: bot.decks.hit_ratio
+        )
+        metrics.CACHE_HIT_RATIO.labels("answers").set_function(compile_cache_hit_ratio)
+        metrics.start_lag_monitor()
+        if cfg.metrics_port:
+            # one port per worker, from METRICS_PORT on
+            port = cfg.metrics_port + ipc.worker
+            await metrics.serve(port)
+            print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+        # questions imported before duplicate detection, or by an /import whose
+        # indexing failed: once per cluster, off the commands' path
+        backfill = asyncio.create_task(backfill_index(db)) if bot.primary else None
+
+        await ipc.connect()
         try:
-            await bot.start(cfg.token)
+            await bot.start(token)
         except discord.LoginFailure:
             sys.exit(
                 "[ERROR] Token invalid, make sure the 'AUTOTSS_TOKEN' environment variable is set to your bot token. Exiting."
@@ -86,7 +229,24 @@ async def startup():
             sys.exit(
                 "[ERROR] Server Members Intent not enabled, go to 'https://discord.com/developers/applications' and enable the Server Members Intent. Exiting."
             )
+        finally:
+            if backfill is not None:
+                backfill.cancel()
+            # the last checkpoints of the games being played, to resume them
+            await bot.checkpoints.close()
+            await bot.assets.close()
+            await ipc.close()
+
+
+def run_worker(worker: WorkerSpec):
+    """Entry point of the worker processes started by launcher.py."""
+    # Ctrl+C reaches the whole process group: leave it to the launcher, which
+    # stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(startup(worker))
 
 
 if __name__ == "__main__":
+    # cogs import this module as `bot`, reuse it instead of running it twice
+    sys.modules["bot"] = sys.modules[__name__]
     asyncio.run(startup())
@@ -0,0 +1,97 @@
+import asyncio
+import io
+import threading
+import time
+
+from discord import Color, Embed, File, Object, app_commands
+from discord.ext import commands
+
+from bot import MountainBot, cfg
+from utils import tracing
+from utils.context import Context, transform_context
+from utils.framework.checks import always_whisper, owner_only
+
+
+class DebugCog(commands.Cog, name="Debug"):
+    def __init__(self, bot: MountainBot):
+        self.bot = bot
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(description="Đo hiệu năng của bot trong vài giây")
+    @app_commands.describe(seconds="Số giây lấy mẫu")
+    @transform_context
+    @always_whisper
+    @owner_only
+    async def profile(self, ctx: Context, seconds: app_commands.Range[int, 1, 60] = 10):
+        await ctx.defer(ephemeral=True)
+        # the event loop runs on this thread; sample it from another one
+        stacks = await asyncio.to_thread(
+            tracing.sample_stacks, seconds, threading.get_ident()
+        )
+        samples = sum(int(line.rsplit(" ", 1)[1]) for line in stacks.splitlines())
+        await ctx.followup.send(
+            f"{samples} mẫu trong {seconds} giây. "
+            "Mở file bằng https://speedscope.app hoặc flamegraph.pl.",
+            file=File(
+                io.BytesIO(stacks.encode()), filename=f"profile-{int(time.time())}.txt"
+            ),
+            ephemeral=True,
+        )
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(description="Xem thời gian chạy của các lệnh gần đây")
+    @app_commands.describe(
+        questions="Xem các câu hỏi của các vòng thi thay vì các lệnh"
+    )
+    @transform_context
+    @always_whisper
+    @owner_only
+    async def traces(self, ctx: Context, questions: bool = False):
+        spans = tracing.recent_questions if questions else tracing.recent
+        text = "\n\n".join("\n".join(span.format()) for span in spans)
+        await ctx.respond(
+            file=File(io.BytesIO(text.encode()), filename="traces.txt"),
+            ephemeral=True,
+        )
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(description="Đồng bộ lại các lệnh với Discord")
+    @transform_context
+    @always_whisper
+    @owner_only
+    async def sync(self, ctx: Context):
+        await ctx.defer(ephemeral=True)
+        await self.bot.syncer.sync(Object(id=cfg.guild_id), force=True)
+        await ctx.send_success("Đã đồng bộ các lệnh.")
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(description="Xem trạng thái các tiến trình và shard của bot")
+    @transform_context
+    @always_whisper
+    @owner_only
+    async def cluster(self, ctx: Context):
+        await ctx.defer(ephemeral=True)
+        statuses = await self.bot.ipc.gather("status")
+        embed = Embed(title="Cụm tiến trình", color=Color.blurple())
+        for (worker, status) in sorted(statuses.items()):
+            if status is None:
+                continue  # not a worker
+            lines = [
+                f"Shard {shard['id']}: {shard['guilds']} server, "
+                + (
+                    f"ping {shard['latency'] * 1000:.0f} ms"
+                    if shard["latency"] is not None
+                    else "chưa kết nối"
+                )
+                for shard in status["shards"]
+            ]
+            lines.append(
+                f"Độ trễ vòng lặp sự kiện: {status['loop_lag'] * 1000:.1f} ms, "
+                f"{status['games']} vòng đang chơi"
+            )
+            embed.add_field(name=f"Tiến trình {worker}", value="\n".join(lines))
+        await ctx.respond_or_edit(embed=embed)
+
+
+async def setup(bot: MountainBot):
+    await bot.add_cog(DebugCog(bot))
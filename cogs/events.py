@@ -15,6 +15,10 @@ class EventsCog(commands.Cog, name="Events"):
     async def on_command_error(self, ctx, err):
         print(err)
 
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        self.bot.answers.dispatch(message)
+
     @commands.Cog.listener()
     async def on_ready(self):
         assert isinstance(self.bot.user, discord.ClientUser)
@@ -24,7 +28,14 @@ class EventsCog(commands.Cog, name="Events"):
         print(f"Python version: {platform.python_version()}")
         print(f"Running on: {platform.system()} {platform.release()} ({os.name})")
         print(f"Developer mode: {self.bot.cfg.dev}")
-        await self.bot.tree.sync(guild=discord.Object(id=self.bot.cfg.guild_id))
+        # the commands are the application's, not a worker's
+        if not self.bot.primary:
+            return
+        # on_ready also fires on reconnects, when the commands rarely changed
+        if await self.bot.syncer.sync(discord.Object(id=self.bot.cfg.guild_id)):
+            print("Synced application commands")
+        else:
+            print("Application commands unchanged, skipped syncing")
 
 
 async def setup(bot: MountainBot):
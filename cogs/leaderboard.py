@@ -0,0 +1,59 @@
+from discord import Color, Embed, app_commands
+from discord.ext import commands
+from discord.utils import escape_markdown
+
+from bot import MountainBot, cfg
+from utils.context import Context, transform_context
+from utils.leaderboard import TOP, Order, guild_stats, top_players
+
+ORDERS = {"total": "Tổng điểm", "average": "Điểm trung bình", "best": "Điểm cao nhất"}
+
+
+class LeaderboardCog(commands.Cog, name="Leaderboard"):
+    def __init__(self, bot: MountainBot):
+        self.bot = bot
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(description="Bảng xếp hạng vòng khởi động")
+    @app_commands.describe(order="Xếp hạng theo")
+    @app_commands.describe(top="Số người chơi hiển thị")
+    @transform_context
+    async def leaderboard(
+        self,
+        ctx: Context,
+        order: Order = "total",
+        top: app_commands.Range[int, 1, 25] = TOP,
+    ):
+        guild = ctx.guild.id if ctx.guild else 0
+        async with self.bot.db.read("leaderboard") as conn:
+            players = await top_players(conn, guild, order, top)
+            stats = await guild_stats(conn, guild)
+        if stats is None or not players:
+            await ctx.send_warning("Chưa có vòng khởi động nào kết thúc.")
+            return
+
+        lines = []
+        for (rank, player) in enumerate(players, 1):
+            value = (
+                f"{player.average:.1f}"
+                if order == "average"
+                else getattr(player, order)
+            )
+            lines.append(
+                f"**{rank}.** {escape_markdown(player.name)}: **{value}** "
+                f"({player.games} vòng)"
+            )
+        embed = Embed(
+            title=f"Bảng xếp hạng: {ORDERS[order]}",
+            description="\n".join(lines),
+            color=Color.gold(),
+        )
+        embed.set_footer(
+            text=f"{stats.games} vòng đã chơi, tổng {stats.total} điểm, "
+            f"cao nhất {stats.best}, trung bình gần đây {stats.average:.1f}"
+        )
+        await ctx.respond_or_edit(embed=embed)
+
+
+async def setup(bot: MountainBot):
+    await bot.add_cog(LeaderboardCog(bot))
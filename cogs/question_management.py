@@ -1,13 +1,63 @@
-import io
+import asyncio
+import logging
+import time
+from typing import Optional
 
-import pylightxl as xl
 from discord import Attachment, Color, Embed, File, app_commands
 from discord.ext import commands
-from pylightxl.pylightxl import Worksheet
+from discord.utils import escape_markdown
 
 from bot import BOT_DIR, MountainBot, cfg
+from utils import metrics
 from utils.context import Context, transform_context
+from utils.dedup import (
+    BATCH,
+    Duplicate,
+    find_duplicates,
+    pack_questions,
+    remove_duplicates,
+    update_index,
+)
 from utils.framework.checks import always_whisper
+from utils.packs import parse_workbook, store_pack
+from utils.search import KINDS, search_questions
+from utils.views.search import SearchMenu, results_embed
+
+log = logging.getLogger(__name__)
+
+
+def _duplicate_report(duplicates: list[Duplicate], skipped: bool) -> str:
+    lines = []
+    for duplicate in duplicates:
+        (question, existing, earlier) = (
+            duplicate.question,
+            duplicate.existing,
+            duplicate.earlier,
+        )
+        if existing is not None:
+            other = f"{existing.round} #{existing.id} (bộ đề {existing.pack_id})"
+        elif earlier is not None:
+            other = f"{KINDS[earlier.kind]} câu {earlier.index + 1} của bộ đề này"
+        else:
+            continue
+        lines.append(
+            f"{KINDS[question.kind]} câu {question.index + 1}: "
+            f"*{escape_markdown(str(question.question)[:60])}* ≈ {other}, "
+            f"giống {duplicate.similarity:.0%}"
+        )
+    footer = (
+        "Đã bỏ qua các câu này."
+        if skipped
+        else "Dùng `skip_duplicates` để bỏ qua các câu này."
+    )
+    shown: list[str] = []
+    for (i, line) in enumerate(lines):
+        # keep room for the footer and the "... và N câu khác" line
+        if sum(len(s) + 1 for s in shown) + len(line) + len(footer) + 30 > 1024:
+            shown.append(f"... và {len(lines) - i} câu khác")
+            break
+        shown.append(line)
+    return "\n".join([*shown, footer])
 
 
 # TODO:
@@ -17,156 +67,6 @@ class QuestionManagementCog(commands.Cog, name="Question Manager"):
     def __init__(self, bot: MountainBot):
         self.bot = bot
 
-    async def __import_start_questions_o23(self, pack_id: int, data: Worksheet):
-        inserted_data = (
-            [
-                (
-                    pack_id,
-                    1,
-                    data.address(f"B{x}"),
-                    data.address(f"C{x}"),
-                    data.address(f"D{x}"),
-                )
-                for x in range(6, 14)
-                if data.address(f"B{x}").strip()  # import only if there's a question
-            ]
-            + [
-                (
-                    pack_id,
-                    2,
-                    data.address(f"B{x}"),
-                    data.address(f"C{x}"),
-                    data.address(f"D{x}"),
-                )
-                for x in range(16, 28)
-                if data.address(f"B{x}").strip()  # import only if there's a question
-            ]
-            + [
-                (
-                    pack_id,
-                    3,
-                    data.address(f"B{x}"),
-                    data.address(f"C{x}"),
-                    data.address(f"D{x}"),
-                )
-                for x in range(30, 46)
-                if data.address(f"B{x}").strip()  # import only if there's a question
-            ]
-        )
-        await self.bot.db.executemany(
-            "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)",
-            inserted_data,
-        )
-
-    async def __import_start_questions_o22(self, pack_id: int, data: Worksheet):
-        inserted_data = [
-            (
-                pack_id,
-                x,
-                data.address(f"B{y}"),
-                data.address(f"C{y}"),
-                data.address(f"D{y}"),
-            )
-            for x in range(1, 4)
-            for y in range((x - 1) * 27 + 6, (x - 1) * 27 + 31)
-            if data.address(f"B{y}").strip()  # import only if there's a question
-        ]
-        await self.bot.db.executemany(
-            "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)",
-            inserted_data,
-        )
-
-    async def __import_obstacle(self, pack_id: int, data: Worksheet):
-        async with self.bot.db.cursor() as cursor:
-            if not data.address("C3"):
-                return
-            await cursor.execute(
-                "INSERT INTO obstacle(pack_id, answer, image_url, display_type) VALUES(?,?,?,?)",
-                (
-                    pack_id,
-                    data.address("C3"),
-                    data.address("B3"),
-                    int(data.address("D3")),
-                ),
-            )
-            obstacle_id = cursor.lastrowid
-            for row in range(5, 10):
-                row_idx = row - 4 if row != 9 else 0
-                await cursor.execute(
-                    "INSERT INTO obstacle_questions(obstacle_id, row, question, answer) VALUES(?,?,?,?)",
-                    (
-                        obstacle_id,
-                        row_idx,
-                        data.address(f"B{row}"),
-                        data.address(f"C{row}"),
-                    ),
-                )
-
-    async def __import_acceleration(self, pack_id: int, data: Worksheet):
-        async with self.bot.db.cursor() as cursor:
-            for row in range(4, 8):
-                if not data.address(f"B{row}"):
-                    continue
-                await cursor.execute(
-                    "INSERT INTO acceleration(pack_id, question, answer, answer_image_url, first_image_with_question) VALUES(?,?,?,?,?)",
-                    (
-                        pack_id,
-                        data.address(f"B{row}"),
-                        data.address(f"C{row}"),
-                        data.address(f"D{row}"),
-                        data.address(f"E{row}") == 1,
-                    ),
-                )
-                acceleration_id = cursor.lastrowid
-
-                imgset_column = chr(
-                    (row - 4) * 2 + 66
-                )  # image sets are in column B, D, F, H
-                time_column = chr((row - 4) * 2 + 67)
-                imgcount = int(data.address(f"{imgset_column}12"))
-                for imgrow in range(13, 13 + imgcount):
-                    await cursor.execute(
-                        "INSERT INTO acceleration_images(acceleration_id, ord, image_url, image_time) VALUES(?,?,?,?)",
-                        (
-                            acceleration_id,
-                            imgrow - 13,
-                            data.address(f"{imgset_column}{imgrow}"),
-                            float(time)
-                            if (time := data.address(f"{time_column}{imgrow}").strip())
-                            else 0,
-                        ),
-                    )
-
-    async def __import_finish(self, pack_id: int, data: Worksheet):
-        inserted_data = [
-            (
-                pack_id,
-                rnd,
-                20 if row <= (rnd - 1) * 8 + 7 else 30,
-                data.address(f"B{row}"),
-                data.address(f"C{row}"),
-                data.address(f"D{row}"),
-                data.address(f"E{row}"),
-            )
-            for rnd in range(1, 4)
-            for row in range((rnd - 1) * 8 + 5, (rnd - 1) * 8 + 11)
-            if data.address(f"B{row}")
-        ]
-        await self.bot.db.executemany(
-            "INSERT INTO finish(pack_id, rnd, score, question, answer, image_url, explanation) VALUES(?,?,?,?,?,?,?)",
-            inserted_data,
-        )
-
-        inserted_data_chp = [
-            (pack_id, data.address(f"B{row}"), data.address(f"C{row}"))
-            for row in range(38, 41)
-            if data.address(f"B{row}")
-        ]
-        await self.bot.db.executemany(
-            "INSERT INTO chp(pack_id, question, answer) VALUES(?,?,?)",
-            inserted_data_chp,
-        )
-
     @app_commands.guilds(cfg.guild_id)
     @app_commands.command(name="import", description="Nhập một bộ đề")
     @app_commands.describe(name="Tên bộ đề")
@@ -174,11 +74,19 @@ class QuestionManagementCog(commands.Cog, name="Question Manager"):
         xlsx="File Excel 2010 (.xlsx) có bộ đề cần nhập (dùng /template để lấy form nhập đề)"
     )
     @app_commands.describe(banned="Bộ đề có bị loại khỏi luyện tập hay không")
+    @app_commands.describe(
+        skip_duplicates="Bỏ qua các câu hỏi gần giống câu đã có trong ngân hàng đề"
+    )
     @transform_context
     @always_whisper
     # TODO: permission check
     async def _import(
-        self, ctx: Context, name: str, xlsx: Attachment, banned: bool = True
+        self,
+        ctx: Context,
+        name: str,
+        xlsx: Attachment,
+        banned: bool = True,
+        skip_duplicates: bool = False,
     ):
         await ctx.defer()
         if (
@@ -193,42 +101,90 @@ class QuestionManagementCog(commands.Cog, name="Question Manager"):
             await ctx.respond_or_edit(embed=embed, delete_after=10)
             return
 
-        fp = io.BytesIO()
-        await xlsx.save(fp)
+        started = time.perf_counter()
+        data = await xlsx.read()
 
         # import vcnv tt and vd
         try:
-            db = xl.readxl(fp)
-
-            async with self.bot.db.cursor() as cursor:
-                await cursor.execute("INSERT INTO packs(name) VALUES(?)", (name,))
-                pack_id = cursor.lastrowid
-
-            if (data := db.ws("Khởi động")).address("A4") == "LƯỢT 1 (8 CÂU)":
-                await self.__import_start_questions_o23(pack_id, data)
-            elif (data := db.ws("Khởi động")).address("A4") == "LƯỢT 1 (60 GIÂY)":
-                await self.__import_start_questions_o22(pack_id, data)
-
-            await self.__import_obstacle(pack_id, db.ws("Vượt chướng ngại vật"))
-            await self.__import_acceleration(pack_id, db.ws("Tăng tốc"))
-            await self.__import_finish(pack_id, db.ws("Về đích"))
+            pack = await asyncio.to_thread(parse_workbook, data)
+            questions = await asyncio.to_thread(pack_questions, pack)
+            # advisory: the pack is imported even if the check fails
+            duplicates: Optional[list[Duplicate]] = None
+            try:
+                # a bounded catch-up, the bank is indexed in the background
+                await update_index(self.bot.db, limit=BATCH)
+                duplicates = await find_duplicates(self.bot.db, questions)
+            except Exception:
+                log.exception("checking pack %r for duplicates failed", name)
+            if skip_duplicates and duplicates:
+                remove_duplicates(pack, duplicates)
+            async with self.bot.db.transaction("store_pack") as db:
+                pack_id = await store_pack(db, name, pack)
         except Exception as e:
-            await self.bot.db.rollback()
             embed = Embed(
                 title="Lỗi",
                 description=f"Đã xảy ra lỗi khi nhập đề. Đề không được nhập.\n```{e}```",
                 color=Color.red(),
             )
             await ctx.respond_or_edit(embed=embed)
+            metrics.IMPORT_SECONDS.observe(time.perf_counter() - started)
             return
 
-        await self.bot.db.commit()
+        try:
+            await update_index(self.bot.db, questions, limit=len(questions) + BATCH)
+        except Exception:
+            # the pack is stored: the next import or backfill indexes it
+            log.exception("indexing pack %d for duplicate detection failed", pack_id)
+        # the decks cached by every worker of a cluster
+        await self.bot.ipc.broadcast("invalidate_pack", pack_id)
+        report = await self.bot.assets.fetch_all(pack.image_urls())
         embed = Embed(
             title="Thành công!",
             description=f"Đã nhập bộ đề {name}, ID {pack_id}",
             color=Color.green(),
         )
+        embed.add_field(
+            name="Hình ảnh",
+            value=f"Đã tải {report.downloaded} ảnh mới, {report.cached} ảnh đã có sẵn",
+        )
+        if duplicates is None:
+            embed.add_field(
+                name="Câu hỏi trùng lặp",
+                value="Không kiểm tra được câu hỏi trùng lặp, bộ đề vẫn được nhập.",
+                inline=False,
+            )
+        elif duplicates:
+            embed.add_field(
+                name=f"Câu hỏi trùng lặp ({len(duplicates)})",
+                value=_duplicate_report(duplicates, skip_duplicates),
+                inline=False,
+            )
+        if report.failed:
+            failed = [f"{url}: {error}" for (url, error) in report.failed.items()]
+            if len(failed) > 5:
+                failed[5:] = [f"... và {len(failed) - 5} ảnh khác"]
+            embed.add_field(
+                name="Không tải được", value="\n".join(failed)[:1024], inline=False
+            )
         await ctx.respond_or_edit(embed=embed)
+        metrics.IMPORT_SECONDS.observe(time.perf_counter() - started)
+
+    @app_commands.guilds(cfg.guild_id)
+    @app_commands.command(name="search", description="Tìm câu hỏi trong ngân hàng đề")
+    @app_commands.describe(
+        query="Các từ cần tìm trong câu hỏi hoặc đáp án, có dấu hay không đều được (thêm * để tìm theo tiền tố)"
+    )
+    @transform_context
+    @always_whisper
+    async def _search(self, ctx: Context, query: str):
+        page = await search_questions(self.bot.db, query)
+        if not page.hits:
+            await ctx.send_warning(f"Không tìm thấy câu hỏi nào với từ khoá `{query}`.")
+            return
+        view = SearchMenu(ctx, self.bot.db, page, timeout=300)
+        await ctx.respond_or_edit(
+            embed=results_embed(page), view=view, ephemeral=ctx.whisper
+        )
 
     @app_commands.guilds(cfg.guild_id)
     @app_commands.command(description="Lấy form nhập đề mẫu")
@@ -1,167 +1,248 @@
 import asyncio
 from random import shuffle
 from time import time
-from typing import Literal, Optional
+from typing import Any, Awaitable, Callable, Literal, Optional
 
 from discord import Color, Embed, Message, app_commands
 from discord.ext import commands
 
 from bot import MountainBot, cfg
+from utils.assets import AssetStore
 from utils.context import Context, transform_context
-from utils.rounds.answer_matching import match_answer
-from utils.rounds.start import LastQuestionState, StartQuestion, rulesets
+from utils.outbound import Priority
+from utils.rounds.checkpoint import SavedSession
+from utils.rounds.router import AnswerInbox
+from utils.rounds.sampling import sample_start_questions
+from utils.rounds.session import GRACE, GameSession
+from utils.rounds.start import LastQuestionState, StartQuestion
+from utils.timer_wheel import WheelClock
 from utils.views.start import StartingMenu
 
+GAME_QUESTIONS = 150  # questions drawn for games not limited to a pack
+RESUME_WINDOW = 15 * 60  # seconds after which interrupted games are ended instead
 
-class StartCog(commands.Cog, name="Start"):
-    def __init__(self, bot: MountainBot):
-        self.bot = bot
 
-    async def _fetch_questions(
-        self, pack_id: Optional[int] = None
-    ) -> list[StartQuestion]:
-        cur = await (
-            await self.bot.db.execute(
-                "SELECT * FROM starting WHERE pack_id = ?", (pack_id,)
-            )
-            if pack_id
-            else await self.bot.db.execute("SELECT * FROM starting")
-        ).fetchall()
-        return [StartQuestion(x[2], x[3], x[4], x[5]) for x in cur]
+class EmbedSink:
+    """Shows a `GameSession` in a Discord channel."""
 
-    async def _start(
+    def __init__(
         self,
-        ctx: Context,
-        questions: list[StartQuestion],
-        limit_users: dict[int, str],
-        results: Optional[dict[int, int]] = None,
-        limit_time: Optional[float] = None,
-        limit_count: int = -1,
-        correct_awarded: int = 10,
-        incorrect_deducted: int = 5,
-        timeout: Optional[int] = 10,
-    ) -> dict[int, int]:
+        send: Callable[..., Awaitable[Message]],
+        assets: Optional[AssetStore] = None,
+    ):
         """
-        Initiates a Starting round
-
         Parameters
         ----------
-        ctx: Bot context
-        questions: List of questions to use for this round
-        limit_users: Only allow user(s) with given ID(s) to answer the questions (single for O20/21, multi for O22+)
-
-        Optional parameters
-        -------------------
-        results: Last round's results (irrelevant if pre-O21 rules)
-        limit_time: Limit this starting round by time length in seconds
-        limit_count: Limit this starting round by number of questions (O20, O23)
-        correct_awarded: Award this much on answering correctly
-        incorrect_deducted: Deduct this much on answering incorrectly
-        timeout: Number of seconds to wait before moving on to next question
-
-        Returns
-        -------
-        A dict of this round's results
-
-        Notes
-        -----
-        - Any questions used will be removed from the `questions` list.
-        - If a results dict is passed in, it will be mutated according to the current round.
+        send: Sends a message to the channel, taking a `Priority` as `priority`
+            and the same keyword arguments as `Messageable.send`
         """
-        if results is None:
-            results = {user: 0 for user in limit_users.keys()}
-        end_time: Optional[float] = None
-        lqstate: LastQuestionState = LastQuestionState.Unknown
-        lqanswer: Optional[str] = None
-        if limit_time:
-            end_time = time() + limit_time
-
-        for (idx, question) in enumerate(questions):
-            if (end_time is not None and time() >= end_time) or idx == limit_count:
-                break
-
-            remaining = end_time - time() if end_time is not None else None
-
-            match lqstate:
-                case LastQuestionState.Correct:
-                    embed_color = Color.green()
-                case LastQuestionState.Incorrect:
-                    embed_color = Color.red()
-                case LastQuestionState.Timeout:
-                    embed_color = Color.yellow()
-                case _:
-                    embed_color = Color.blurple()
-            embed = Embed(
-                title=f"Câu hỏi thứ {idx + 1}",
-                description=question.question,
-                color=embed_color,
+        self.send = send
+        self.assets = assets
+
+    async def single_player(self):
+        await self.send(
+            priority=Priority.COSMETIC,
+            embed=Embed(
+                title="Chỉ có 1 người tham gia",
+                description="Luật khởi động O21 sẽ được áp dụng.",
+                color=Color.yellow(),
+            ),
+        )
+
+    async def turn_started(self, name: str, delay: float):
+        embed = Embed(
+            title=f"Lượt khởi động của {name}",
+            description=f"Lượt khởi động sẽ bắt đầu <t:{round(time() + delay)}:R>. Bạn có 60 giây để hoàn thành lượt khởi động của mình. Chúc bạn thành công!",
+            color=Color.blurple(),
+        )
+        await self.send(priority=Priority.COSMETIC, embed=embed)
+
+    async def round_started(
+        self, ruleset: str, rnd: int, rules: dict[str, Any], delay: float
+    ):
+        if ruleset == "o22":
+            requirement = (
+                f"Các bạn có {rules['limit_time']} giây để hoàn thành lượt khởi động"
             )
-            if end_time is not None:
-                assert (
-                    remaining is not None
-                )  # we know it is not None if there is "the END" (before the "BEGINNING")
-                embed.add_field(name="Thời gian", value=round(remaining))
-            if question.image_url:
-                embed.set_image(url=question.image_url)
+        else:
+            requirement = f"Các bạn sẽ phải trả lời {rules['limit_count']} câu hỏi"
+        embed = Embed(
+            title=f"Lượt khởi động {rnd}",
+            description=f"Lượt khởi động sẽ bắt đầu <t:{round(time() + delay)}:R>. {requirement}. Chúc các bạn thành công!",
+            color=Color.blurple(),
+        )
+        await self.send(priority=Priority.COSMETIC, embed=embed)
 
-            if lqanswer is not None:
-                embed.add_field(name="Đáp án câu trước", value=lqanswer)
+    async def question(
+        self,
+        number: int,
+        question: StartQuestion,
+        remaining: Optional[float],
+        last_state: LastQuestionState,
+        last_answer: Optional[str],
+        scores: dict[int, int],
+        players: dict[int, str],
+    ) -> Message:
+        match last_state:
+            case LastQuestionState.Correct:
+                embed_color = Color.green()
+            case LastQuestionState.Incorrect:
+                embed_color = Color.red()
+            case LastQuestionState.Timeout:
+                embed_color = Color.yellow()
+            case _:
+                embed_color = Color.blurple()
+        embed = Embed(
+            title=f"Câu hỏi thứ {number}",
+            description=question.question,
+            color=embed_color,
+        )
+        if remaining is not None:
+            embed.add_field(name="Thời gian", value=round(remaining))
+        asset = None
+        if question.image_url:
+            if self.assets is not None:
+                asset = await self.assets.get(question.image_url)
+            if asset is None:
+                embed.set_image(url=question.image_url)
+            elif cdn_url := asset.usable_cdn_url():
+                embed.set_image(url=cdn_url)
+                asset = None
             else:
-                embed.add_field(name="\u200B", value="\u200B")
+                embed.set_image(url=f"attachment://{asset.filename}")
 
+        if last_answer is not None:
+            embed.add_field(name="Đáp án câu trước", value=last_answer)
+        else:
             embed.add_field(name="\u200B", value="\u200B")
-            for (idx, (k, v)) in enumerate(results.items()):
-                if idx == 2:
-                    embed.add_field(name="\u200B", value="\u200B")
-                embed.add_field(name=limit_users[k], value=v)
-
-            questions.remove(question)
-            await ctx.send(embed=embed)
-            try:
-                if timeout and end_time is not None:
-                    assert (
-                        remaining is not None
-                    )  # we know it is not None if there is "the END" (before the "BEGINNING")
-                    to = min(remaining, timeout)
-                elif end_time is not None:
-                    to = remaining
-                else:
-                    to = timeout
-
-                msg: Message = await self.bot.wait_for(
-                    "message",
-                    check=lambda m: m.author.id in limit_users.keys(),
-                    timeout=to,
-                )
-                if match_answer(msg.content, question.answer):
-                    results[msg.author.id] += correct_awarded
-                    lqstate = LastQuestionState.Correct
-                else:
-                    results[msg.author.id] -= incorrect_deducted
-                    lqstate = LastQuestionState.Incorrect
-            except asyncio.TimeoutError:
-                lqstate = LastQuestionState.Timeout
-
-            if "~|" in question.answer:
-                lqanswer = question.answer.split("~|")[0]
-            elif "~>" or "~+" in question.answer:
-                lqanswer = question.answer.translate(str.maketrans("", "", "~>+"))
-        await ctx.send(content=f"Đáp án: {lqanswer}")
-        return results
-
-    async def _send_results(
-        self,
-        ctx: Context,
-        players: dict[int, str],
-        results: dict[int, int],
-        title: str = "Kết quả",
+
+        embed.add_field(name="\u200B", value="\u200B")
+        for (idx, (k, v)) in enumerate(scores.items()):
+            if idx == 2:
+                embed.add_field(name="\u200B", value="\u200B")
+            embed.add_field(name=players[k], value=v)
+        if asset is None:
+            return await self.send(priority=Priority.QUESTION, embed=embed)
+        message = await self.send(
+            priority=Priority.QUESTION, embed=embed, file=asset.file()
+        )
+        if message.embeds and message.embeds[0].image.url:
+            asset.remember_cdn_url(message.embeds[0].image.url)
+        return message
+
+    async def round_ended(self, last_answer: Optional[str]):
+        await self.send(priority=Priority.SCORE, content=f"Đáp án: {last_answer}")
+
+    async def turn_ended(self, name: str, score: int):
+        await self.send(
+            priority=Priority.SCORE,
+            content=f"Chúc mừng {name} đã kết thúc vòng thi khởi động với {score} điểm!",
+        )
+
+    async def results(
+        self, players: dict[int, str], results: dict[int, int], rnd: Optional[int]
     ):
+        title = f"Kết quả vòng {rnd}" if rnd is not None else "Kết quả"
         embed = Embed(title=title, color=Color.blurple())
         for (player_id, score) in dict(
             sorted(results.items(), key=lambda x: x[1], reverse=True)
         ).items():
             embed.add_field(name=players[player_id], value=score)
-        await ctx.send(embed=embed)
+        await self.send(priority=Priority.SCORE, embed=embed)
+
+
+class StartCog(commands.Cog, name="Start"):
+    def __init__(self, bot: MountainBot):
+        self.bot = bot
+        self.recovered = False
+        self.resumed: set[asyncio.Task] = set()
+        # seconds to wait for answers sent about as early as the first one
+        self.grace = GRACE if cfg.buzz_grace_ms is None else cfg.buzz_grace_ms / 1000
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready also fires on reconnects, when no game was interrupted
+        if self.recovered:
+            return
+        self.recovered = True
+        for saved in await self.bot.checkpoints.interrupted():
+            if not self.bot.owns(saved.guild_id):
+                continue  # another worker's
+            channel = self.bot.get_channel(saved.channel_id)
+            if channel is None:
+                self.bot.checkpoints.end(saved)
+            elif (
+                time() - saved.updated > RESUME_WINDOW
+                or saved.channel_id in self.bot.answers
+            ):
+                await self._finalize(saved, channel)
+            else:
+                task = asyncio.create_task(self._resume(saved, channel))
+                self.resumed.add(task)
+                task.add_done_callback(self.resumed.discard)
+
+    async def _resume(self, saved: SavedSession, channel: Any):
+        """Go on with a game interrupted by a restart."""
+        sink = EmbedSink(self.bot.outbound.sender(channel), self.bot.assets)
+        try:
+            with self.bot.answers.listen(channel.id) as inbox:
+                await sink.send(
+                    priority=Priority.COSMETIC,
+                    embed=Embed(
+                        title="Tiếp tục vòng khởi động",
+                        description="Vòng thi trong kênh này đã bị gián đoạn và sẽ được tiếp tục.",
+                        color=Color.blurple(),
+                    ),
+                )
+                session = saved.session(
+                    inbox,
+                    sink,
+                    WheelClock(self.bot.timers),
+                    self.bot.checkpoints,
+                    self.grace,
+                )
+                await self._run(session)
+        finally:
+            self.bot.outbound.prune()
+
+    async def _finalize(self, saved: SavedSession, channel: Any):
+        """End a game interrupted for too long, with the scores it had."""
+        sink = EmbedSink(self.bot.outbound.sender(channel), self.bot.assets)
+        await sink.send(
+            priority=Priority.SCORE,
+            embed=Embed(
+                title="Vòng khởi động đã kết thúc",
+                description="Vòng thi trong kênh này đã bị gián đoạn quá lâu và không thể tiếp tục.",
+                color=Color.yellow(),
+            ),
+        )
+        await sink.results(saved.players, saved.results, None)
+        self.bot.checkpoints.end(saved)
+
+    async def _run(self, session: GameSession):
+        try:
+            await session.run()
+        except Exception:
+            # broken rather than interrupted: not to be resumed
+            assert session.id is not None
+            await self.bot.checkpoints.delete(session.id)
+            raise
+
+    async def _fetch_questions(
+        self, pack_id: Optional[int] = None
+    ) -> list[StartQuestion]:
+        if pack_id is None:
+            # the whole bank is too large to load, draw a game's worth of questions
+            async with self.bot.db.read("sample_start_questions") as db:
+                return await sample_start_questions(db, GAME_QUESTIONS)
+        return list(await self.bot.decks.get_or_load(pack_id, self._load_deck))
+
+    async def _load_deck(self, pack_id: int) -> list[StartQuestion]:
+        async with self.bot.db.read("load_start_deck") as db:
+            cur = await (
+                await db.execute("SELECT * FROM starting WHERE pack_id = ?", (pack_id,))
+            ).fetchall()
+        return [StartQuestion(x[2], x[3], x[4], x[5]) for x in cur]
 
     @app_commands.guilds(cfg.guild_id)
     @app_commands.command(description="Bắt đầu một vòng Khởi động")
@@ -173,6 +254,25 @@ class StartCog(commands.Cog, name="Start"):
         ctx: Context,
         ruleset: Literal["o21", "o22", "o23"],
         pack_id: Optional[int] = None,
+    ):
+        if ctx.channel.id in self.bot.answers:
+            await ctx.send_warning(
+                "Kênh này đang có một vòng thi diễn ra.", ephemeral=True
+            )
+            return
+
+        try:
+            with self.bot.answers.listen(ctx.channel.id) as inbox:
+                await self._play(ctx, inbox, ruleset, pack_id)
+        finally:
+            self.bot.outbound.prune()
+
+    async def _play(
+        self,
+        ctx: Context,
+        inbox: AnswerInbox,
+        ruleset: Literal["o21", "o22", "o23"],
+        pack_id: Optional[int] = None,
     ):
         await ctx.defer()
 
@@ -191,77 +291,36 @@ class StartCog(commands.Cog, name="Start"):
         view = StartingMenu(ctx, players, timeout=ending_time - time())
 
         await ctx.respond_or_edit(embed=embed, view=view)
+        # answered: the lobby and the game aren't the command's latency, the
+        # session traces its questions instead
+        ctx.end_trace()
         await asyncio.sleep(ending_time - time())
 
         embed.description = "Một vòng khởi động đã bắt đầu!"
-        await ctx.respond_or_edit(embed=embed)
+        embed.set_field_at(1, name="Người chơi", value=", ".join(view.players.values()))
+        for child in view.children:
+            child.disabled = True  # type: ignore
+        view.stop()
+        # final: no lobby update still waiting to be merged can land after this
+        await ctx.edit_coalesced(final=True, embed=embed, view=view)
 
         players = view.players
-        results: dict[int, int] = {user: 0 for user in view.players.keys()}
         questions = await self._fetch_questions(pack_id)
         shuffle(questions)
-        if len(players) < 2:
-            if ruleset != "o21":
-                await ctx.send(
-                    embed=Embed(
-                        title="Chỉ có 1 người tham gia",
-                        description="Luật khởi động O21 sẽ được áp dụng.",
-                        color=Color.yellow(),
-                    )
-                )
-            results = await self._start(
-                ctx,
-                questions,
-                players,
-                incorrect_deducted=0,
-                timeout=None,
-                limit_time=60,
-            )
-        elif ruleset == "o21":
-            for (id, name) in players.items():
-                embed = Embed(
-                    title=f"Lượt khởi động của {name}",
-                    description=f"Lượt khởi động sẽ bắt đầu <t:{time() + 5}:R>. Bạn có 60 giây để hoàn thành lượt khởi động của mình. Chúc bạn thành công!",
-                    color=Color.blurple(),
-                )
-                await ctx.send(embed=embed)
-                await asyncio.sleep(5)
-                results.update(
-                    await self._start(
-                        ctx,
-                        questions,
-                        dict([(id, name)]),
-                        **rulesets[ruleset],
-                    )
-                )
-                await ctx.send(
-                    content=f"Chúc mừng {name} đã kết thúc vòng thi khởi động với {results[id]} điểm!"
-                )
-        elif ruleset == "o22" or ruleset == "o23":
-            for rnd in range(1, 4):
-                if ruleset == "o22":
-                    requirement = f"Các bạn có {60 if rnd <= 2 else 90} để hoàn thành lượt khởi động"
-                else:
-                    requirement = f"Các bạn sẽ phải trả lời {rulesets[f'{ruleset}_{rnd}']['limit_count']} câu hỏi"
-                embed = Embed(
-                    title=f"Lượt khởi động {rnd}",
-                    description=f"Lượt khởi động sẽ bắt đầu <t:{time() + 5}:R>. {requirement}. Chúc các bạn thành công!",
-                    color=Color.blurple(),
-                )
-                await ctx.send(embed=embed)
-                await asyncio.sleep(5)
-                await self._start(
-                    ctx,
-                    questions,
-                    players,
-                    results=results,
-                    **rulesets[f"{ruleset}_{rnd}"],
-                )
-                await self._send_results(
-                    ctx, players, results, title=f"Kết quả vòng {rnd}"
-                )
-
-        await self._send_results(ctx, players, results)
+        session = GameSession(
+            ruleset,
+            players,
+            questions,
+            inbox,
+            EmbedSink(self.bot.outbound.sender(ctx.channel), self.bot.assets),
+            WheelClock(self.bot.timers),
+            self.bot.checkpoints,
+            self.grace,
+        )
+        await self.bot.checkpoints.create(
+            session, ctx.channel.id, ctx.guild.id if ctx.guild else None
+        )
+        await self._run(session)
 
 
 async def setup(bot: MountainBot):
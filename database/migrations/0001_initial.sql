@@ -1,3 +1,6 @@
+-- Tables of the original schema.sql. IF NOT EXISTS, as databases created
+-- before migrations (user_version 0) already have them.
+
 CREATE TABLE IF NOT EXISTS managers(
     user INT
 );
@@ -0,0 +1,17 @@
+-- Indexes for sampling questions by pack and round, and loading a pack.
+
+CREATE INDEX IF NOT EXISTS starting_pack_round ON starting(pack_id, round);
+
+CREATE INDEX IF NOT EXISTS starting_round ON starting(round);
+
+CREATE INDEX IF NOT EXISTS finish_pack_rnd_score ON finish(pack_id, rnd, score);
+
+CREATE INDEX IF NOT EXISTS obstacle_questions_obstacle ON obstacle_questions(obstacle_id);
+
+CREATE INDEX IF NOT EXISTS acceleration_images_acceleration ON acceleration_images(acceleration_id);
+
+CREATE INDEX IF NOT EXISTS chp_pack ON chp(pack_id);
+
+CREATE INDEX IF NOT EXISTS obstacle_pack ON obstacle(pack_id);
+
+CREATE INDEX IF NOT EXISTS acceleration_pack ON acceleration(pack_id);
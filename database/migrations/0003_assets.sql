@@ -0,0 +1,9 @@
+-- Downloaded question images, see utils/assets.py.
+
+CREATE TABLE IF NOT EXISTS assets(
+    url TEXT PRIMARY KEY,
+    hash TEXT, -- sha256 of the image, file assets/<2 first characters>/<hash>; NULL if the download failed
+    content_type TEXT,
+    size INTEGER,
+    error TEXT
+);
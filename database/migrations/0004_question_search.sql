@@ -0,0 +1,194 @@
+-- Full-text index of the questions and answers of every round, for /search.
+--
+-- Contentless: the text stays in the question tables, the index only maps
+-- words to rows. The rowid of a question is id * 8 + the number of its table
+-- (1 starting, 2 finish, 3 chp, 4 obstacle_questions, 5 acceleration), see
+-- utils/search.py. unicode61 strips the diacritics, except from đ, which isn't
+-- a d with a mark in Unicode: it is folded to d before indexing and searching.
+
+CREATE VIRTUAL TABLE question_search USING fts5(
+    question,
+    answer,
+    content = '',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- starting
+INSERT INTO question_search(rowid, question, answer)
+    SELECT id * 8 + 1, replace(replace(question, 'đ', 'd'), 'Đ', 'D'), replace(replace(answer, 'đ', 'd'), 'Đ', 'D')
+    FROM starting;
+
+CREATE TRIGGER starting_search_insert AFTER INSERT ON starting BEGIN
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 1,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER starting_search_delete AFTER DELETE ON starting BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 1,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER starting_search_update AFTER UPDATE OF question, answer ON starting BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 1,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 1,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+-- finish
+INSERT INTO question_search(rowid, question, answer)
+    SELECT id * 8 + 2, replace(replace(question, 'đ', 'd'), 'Đ', 'D'), replace(replace(answer, 'đ', 'd'), 'Đ', 'D')
+    FROM finish;
+
+CREATE TRIGGER finish_search_insert AFTER INSERT ON finish BEGIN
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 2,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER finish_search_delete AFTER DELETE ON finish BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 2,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER finish_search_update AFTER UPDATE OF question, answer ON finish BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 2,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 2,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+-- chp
+INSERT INTO question_search(rowid, question, answer)
+    SELECT id * 8 + 3, replace(replace(question, 'đ', 'd'), 'Đ', 'D'), replace(replace(answer, 'đ', 'd'), 'Đ', 'D')
+    FROM chp;
+
+CREATE TRIGGER chp_search_insert AFTER INSERT ON chp BEGIN
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 3,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER chp_search_delete AFTER DELETE ON chp BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 3,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER chp_search_update AFTER UPDATE OF question, answer ON chp BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 3,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 3,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+-- obstacle_questions
+INSERT INTO question_search(rowid, question, answer)
+    SELECT id * 8 + 4, replace(replace(question, 'đ', 'd'), 'Đ', 'D'), replace(replace(answer, 'đ', 'd'), 'Đ', 'D')
+    FROM obstacle_questions;
+
+CREATE TRIGGER obstacle_questions_search_insert AFTER INSERT ON obstacle_questions BEGIN
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 4,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER obstacle_questions_search_delete AFTER DELETE ON obstacle_questions BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 4,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER obstacle_questions_search_update AFTER UPDATE OF question, answer ON obstacle_questions BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 4,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 4,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+-- acceleration
+INSERT INTO question_search(rowid, question, answer)
+    SELECT id * 8 + 5, replace(replace(question, 'đ', 'd'), 'Đ', 'D'), replace(replace(answer, 'đ', 'd'), 'Đ', 'D')
+    FROM acceleration;
+
+CREATE TRIGGER acceleration_search_insert AFTER INSERT ON acceleration BEGIN
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 5,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER acceleration_search_delete AFTER DELETE ON acceleration BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 5,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
+
+CREATE TRIGGER acceleration_search_update AFTER UPDATE OF question, answer ON acceleration BEGIN
+    INSERT INTO question_search(question_search, rowid, question, answer) VALUES (
+        'delete',
+        old.id * 8 + 5,
+        replace(replace(old.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(old.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+    INSERT INTO question_search(rowid, question, answer) VALUES (
+        new.id * 8 + 5,
+        replace(replace(new.question, 'đ', 'd'), 'Đ', 'D'),
+        replace(replace(new.answer, 'đ', 'd'), 'Đ', 'D')
+    );
+END;
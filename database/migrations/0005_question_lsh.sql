@@ -0,0 +1,18 @@
+-- Locality-sensitive hashing index of the questions of the starting, finish
+-- and chp tables, for finding near-duplicates at /import, see utils/dedup.py.
+--
+-- Each question has one row per band of its MinHash signature, and questions
+-- sharing a bucket are likely similar. Signatures can't be computed in SQL, so
+-- the index is filled by utils/dedup.py, which indexes the questions whose id
+-- is above the last one indexed for their table.
+
+CREATE TABLE question_lsh(
+    bucket INTEGER, -- hash of one band of a signature
+    key INTEGER, -- id * 8 + the number of the question's table, like question_search's rowid
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+
+CREATE TABLE question_lsh_progress(
+    kind INTEGER PRIMARY KEY, -- table number (1 starting, 2 finish, 3 chp)
+    last_id INTEGER -- the questions up to this id are indexed
+);
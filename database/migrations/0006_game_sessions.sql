@@ -0,0 +1,17 @@
+-- Checkpoints of the Khởi động games being played, to resume them after a
+-- restart, see utils/rounds/checkpoint.py. A game's row is deleted when it ends.
+
+CREATE TABLE game_sessions(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild INTEGER,
+    channel INTEGER,
+    ruleset TEXT,
+    players TEXT, -- JSON object of player ID: display name, in turn order
+    questions TEXT, -- JSON array of the game's questions, [rnd, question, answer, image_url]
+    stage INTEGER DEFAULT 0, -- O21 turn or O22/O23 round being played, from 0
+    number INTEGER DEFAULT 0, -- questions asked in the stage
+    drawn INTEGER DEFAULT 0, -- questions of `questions` used so far
+    remaining REAL, -- seconds left in a timed stage, at its last question
+    results TEXT, -- JSON object of player ID: score
+    updated REAL -- UNIX time of the last checkpoint
+);
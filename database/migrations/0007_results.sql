@@ -0,0 +1,41 @@
+-- Final scores of Khởi động games, with per-guild and per-player aggregates
+-- kept up to date in the same transaction as each game's rows, see
+-- utils/leaderboard.py. The leaderboard reads the aggregates through their
+-- indexes and never the results themselves.
+
+CREATE TABLE results(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    game INTEGER, -- game_sessions id of the game
+    guild INTEGER, -- 0 outside guilds
+    player INTEGER,
+    ruleset TEXT,
+    score INTEGER,
+    finished REAL -- UNIX time
+);
+
+CREATE TABLE player_stats(
+    guild INTEGER,
+    player INTEGER,
+    name TEXT, -- display name in the player's last game
+    games INTEGER,
+    total INTEGER,
+    best INTEGER,
+    average REAL, -- rolling average of the scores, exponentially weighted
+    last_played REAL,
+    PRIMARY KEY (guild, player)
+) WITHOUT ROWID;
+
+CREATE INDEX player_stats_total ON player_stats(guild, total DESC, player);
+
+CREATE INDEX player_stats_average ON player_stats(guild, average DESC, player);
+
+CREATE INDEX player_stats_best ON player_stats(guild, best DESC, player);
+
+CREATE TABLE guild_stats(
+    guild INTEGER PRIMARY KEY,
+    games INTEGER,
+    total INTEGER,
+    best INTEGER,
+    average REAL, -- rolling average of the games' mean scores, exponentially weighted
+    last_played REAL
+);
@@ -0,0 +1,172 @@
+"""
+Import question packs into the bot's database from the command line.
+
+Usage: python import_packs.py [--db PATH] [--workers N] [--batch N] [--no-assets] SOURCE...
+
+Each SOURCE is a .xlsx pack (filled in from "resources/Form nhập đề thi.xlsx"), a
+directory of them or a .zip archive of them. Packs are named after their file.
+Workbooks are parsed in parallel on a process pool, and the results are written
+by a single writer, committing every `--batch` packs. The images the packs
+reference are then downloaded into the asset store (see utils/assets.py).
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional
+
+from utils.assets import AssetStore
+from utils.database import Database
+from utils.dedup import update_index
+from utils.migrations import migrate
+from utils.packs import ParsedPack, parse_workbook, store_pack
+
+BOT_DIR = Path(__file__).absolute().parent
+
+
+def find_workbooks(sources: list[Path]) -> Iterator[tuple[str, str, bytes]]:
+    """Yield (label, pack name, contents) of every workbook in `sources`."""
+    for source in sources:
+        if source.is_dir():
+            for path in sorted(source.rglob("*.xlsx")):
+                yield (str(path), path.stem, path.read_bytes())
+        elif source.suffix.lower() == ".zip":
+            with zipfile.ZipFile(source) as archive:
+                for member in sorted(archive.namelist()):
+                    if member.endswith(".xlsx") and not member.startswith("__MACOSX"):
+                        yield (
+                            f"{source}:{member}",
+                            Path(member).stem,
+                            archive.read(member),
+                        )
+        else:
+            yield (str(source), source.stem, source.read_bytes())
+
+
+def parse_timed(data: bytes) -> tuple[Optional[ParsedPack], Optional[str], float]:
+    """Parse a workbook in a worker process, returning (pack, error, seconds)."""
+    started = time.perf_counter()
+    try:
+        return (parse_workbook(data), None, time.perf_counter() - started)
+    except Exception as e:
+        return (None, f"{type(e).__name__}: {e}", time.perf_counter() - started)
+
+
+async def run(args: argparse.Namespace) -> int:
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    imported = failed = questions = 0
+    size = 0
+
+    urls: set[str] = set()
+
+    # the bot may be running, and writing, meanwhile
+    async with Database(args.db, readers=1, shared=True) as db:
+        await migrate(db)
+
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            jobs = []
+            for (label, name, data) in find_workbooks(args.sources):
+                size += len(data)
+                jobs.append(
+                    (label, name, loop.run_in_executor(pool, parse_timed, data))
+                )
+
+            batch: list[tuple[str, str, ParsedPack, float]] = []
+
+            async def commit():
+                nonlocal imported, questions
+                write_started = time.perf_counter()
+                async with db.transaction("store_pack") as conn:
+                    ids = [
+                        await store_pack(conn, name, pack)
+                        for (_, name, pack, _) in batch
+                    ]
+                write_time = (time.perf_counter() - write_started) / len(batch)
+                for ((label, _, pack, parse_time), pack_id) in zip(batch, ids):
+                    print(
+                        f"{label}: pack {pack_id}, {pack.question_count} questions, "
+                        f"parse {parse_time * 1000:.0f} ms, write {write_time * 1000:.1f} ms"
+                    )
+                    questions += pack.question_count
+                    urls.update(pack.image_urls())
+                imported += len(batch)
+                batch.clear()
+
+            for (label, name, job) in jobs:
+                (pack, error, parse_time) = await job
+                if pack is None:
+                    print(f"{label}: skipped, {error}", file=sys.stderr)
+                    failed += 1
+                    continue
+                batch.append((label, name, pack, parse_time))
+                if len(batch) >= args.batch:
+                    await commit()
+            if batch:
+                await commit()
+
+        # so that /import doesn't have to, when checking for duplicates
+        indexed = await update_index(db)
+        print(f"Indexed {indexed} questions for duplicate detection")
+
+        if args.assets and urls:
+            assets = AssetStore(BOT_DIR / "assets", db)
+            try:
+                report = await assets.fetch_all(urls)
+            finally:
+                await assets.close()
+            print(
+                f"Images: {report.downloaded} downloaded "
+                f"({report.bytes / 1024 / 1024:.1f} MiB), {report.cached} already stored"
+            )
+            for (url, error) in report.failed.items():
+                print(f"{url}: {error}", file=sys.stderr)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"\nImported {imported} packs ({questions} questions, {size / 1024 / 1024:.1f} MiB) "
+        f"in {elapsed:.2f}s: {imported / elapsed:.1f} packs/s, "
+        f"{questions / elapsed:.0f} questions/s"
+        + (f", {failed} failed" if failed else "")
+    )
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nhập các bộ đề vào cơ sở dữ liệu")
+    parser.add_argument(
+        "sources", nargs="+", type=Path, help=".xlsx files, directories or .zip files"
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=BOT_DIR / "database" / "database.sqlite3",
+        help="database to import into (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of parser processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=50,
+        help="packs written per transaction (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-assets",
+        dest="assets",
+        action="store_false",
+        help="do not download the images referenced by the packs",
+    )
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure the bot's cold-start import time with `python -X importtime`.
+
+Usage: python importtime.py [--runs N] [--budget MS] [--top N]
+
+Imports `bot` and every cog in a fresh interpreter `--runs` times, and reports
+the median total and the slowest modules of the median run. Exits with 1 if
+the median total is over `--budget` milliseconds, or if any of `LAZY`, which
+must only be imported on first use, got imported.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BOT_DIR = Path(__file__).absolute().parent
+# heavy dependencies that must not be imported at startup
+LAZY = ("PIL", "pylightxl", "jishaku", "pyjion")
+
+
+def measure() -> dict[str, tuple[int, int]]:
+    """Import the bot in a new interpreter, returning (self, cumulative) µs of every module."""
+    cogs = [f"cogs.{file.stem}" for file in sorted((BOT_DIR / "cogs").glob("*.py"))]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import bot, {', '.join(cogs)}"],
+        cwd=BOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        sys.exit(result.stderr)
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        (own, cumulative, name) = line[len("import time:") :].split("|")
+        # nested imports are indented, top-level ones count towards the total
+        modules[name.rstrip()] = (int(own), int(cumulative))
+    return modules
+
+
+def total(modules: dict[str, tuple[int, int]]) -> int:
+    return sum(
+        cumulative for (name, (_, cumulative)) in modules.items() if name[1] != " "
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Đo thời gian import khi khởi động bot"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="interpreters to start (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=500,
+        help="maximum median import time in ms (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="slowest modules to list (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    runs = sorted((measure() for _ in range(args.runs)), key=total)
+    median = runs[len(runs) // 2]
+    totals = [total(run) / 1000 for run in runs]
+
+    print(f"{'self ms':>8} {'cumul. ms':>9}  module")
+    slowest = sorted(median.items(), key=lambda item: item[1][1], reverse=True)
+    for (name, (own, cumulative)) in slowest[: args.top]:
+        print(f"{own / 1000:8.1f} {cumulative / 1000:9.1f}  {name}")
+    print(
+        f"\nimport time over {args.runs} runs: median {statistics.median(totals):.0f} ms, "
+        f"min {totals[0]:.0f} ms, max {totals[-1]:.0f} ms (budget {args.budget:.0f} ms)"
+    )
+
+    failed = False
+    eager = sorted({name.strip().split(".")[0] for name in median} & set(LAZY))
+    if eager:
+        print(f"imported at startup, should be lazy: {', '.join(eager)}")
+        failed = True
+    if statistics.median(totals) > args.budget:
+        print("over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Run the bot as a cluster of worker processes.
+
+Usage: python launcher.py [--workers N] [--shards N] [--db PATH] [--fake-gateway GUILDS]
+
+Each worker runs `bot.run_worker` on a contiguous range of the gateway shards
+(see utils/cluster.py). By default there are as many shards as Discord
+recommends, and a worker per core, up to one per shard. The launcher migrates
+the database before starting the workers, relays their IPC and paces their
+identifies (see utils/ipc.py), and restarts the workers that crash. SIGINT or
+SIGTERM stops them all.
+
+With --fake-gateway, the workers connect to a local `FakeDiscord` with GUILDS
+guilds instead of Discord, to try a cluster out without a bot token.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from discord.http import HTTPClient
+
+from bot import BOT_DIR, cfg, run_worker
+from utils.cluster import Supervisor, WorkerSpec, shard_ranges
+from utils.database import Database
+from utils.fake_gateway import FakeDiscord
+from utils.ipc import Hub
+from utils.migrations import migrate
+
+
+async def gateway_info(token: str) -> tuple[int, int]:
+    """The number of shards Discord recommends, and how many may identify at once."""
+    http = HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        (shards, _, limits) = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return (shards, limits["max_concurrency"])
+
+
+async def run(args: argparse.Namespace):
+    loop = asyncio.get_running_loop()
+    fake: Optional[FakeDiscord] = None
+    if args.fake_gateway:
+        fake = FakeDiscord(shard_count=args.shards or 1, guilds=args.fake_gateway)
+        await fake.start()
+        (shard_count, max_concurrency) = (fake.shard_count, fake.max_concurrency)
+        print(f"Fake gateway on {fake.url}")
+    else:
+        (recommended, max_concurrency) = await gateway_info(cfg.token)
+        shard_count = args.shards or recommended
+
+    # once, before the workers open the database
+    async with Database(args.db, readers=1, shared=True) as db:
+        for migration in await migrate(db):
+            print(f"Applied migration {migration}")
+
+    ranges = shard_ranges(shard_count, args.workers or os.cpu_count() or 1)
+    print(f"{shard_count} shards on {len(ranges)} workers: {ranges}")
+    with tempfile.TemporaryDirectory() as tmp:
+        hub = Hub(str(Path(tmp) / "ipc.sock"), max_concurrency)
+        await hub.start()
+        specs = [
+            WorkerSpec(
+                id,
+                shards,
+                shard_count,
+                hub.path,
+                str(args.db),
+                fake.api_base if fake else None,
+                fake.gateway_url if fake else None,
+            )
+            for (id, shards) in enumerate(ranges)
+        ]
+        supervisor = Supervisor(specs, run_worker)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(
+                signum, lambda: asyncio.ensure_future(supervisor.stop())
+            )
+        try:
+            await supervisor.run()
+        finally:
+            await hub.close()
+            if fake is not None:
+                await fake.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chạy bot trên nhiều tiến trình")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes (default: one per core, at most one per shard)",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="gateway shards (default: as many as Discord recommends)",
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=BOT_DIR / "database" / "database.sqlite3",
+        help="database of the bot (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fake-gateway",
+        type=int,
+        metavar="GUILDS",
+        default=0,
+        help="connect to a local fake Discord with this many guilds",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[launcher] %(message)s")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Local copies of question images.
+
+Images referenced by a pack are downloaded once, when the pack is imported, and
+stored under the assets directory by the SHA-256 of their content, so a picture
+used by several packs is only stored once. Games send the local file as an
+attachment instead of having Discord fetch the original URL, then reuse the
+attachment's CDN URL until it expires.
+
+Any member importing a pack chooses the URLs the bot fetches, so only public
+addresses are fetched: host names resolving to loopback, private or link-local
+addresses are refused by the resolver, IP addresses when requested, redirects
+included. Failures are reported with a short reason, never the raw error.
+"""
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import os
+import socket
+import time
+from typing import Any, Iterable, Optional, Union
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver, ResolveResult
+from aiohttp.resolver import DefaultResolver
+from discord import File
+
+from utils.database import Database
+
+CONCURRENCY = 8  # simultaneous downloads
+MAX_SIZE = 8 * 1024 * 1024  # 8 MiB, Discord's attachment size limit
+TIMEOUT = 30  # seconds per download
+CDN_MARGIN = 600  # stop reusing a CDN URL this many seconds before it expires
+EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+
+log = logging.getLogger(__name__)
+
+
+class AssetError(Exception):
+    pass
+
+
+class PrivateAddressError(OSError):
+    pass
+
+
+def is_public(address: str) -> bool:
+    """Whether `address`, an IP address, is reachable on the internet."""
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(AbstractResolver):
+    """Resolves host names to their public addresses, refusing those without any."""
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(
+        self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET
+    ) -> list[ResolveResult]:
+        hosts = await self._resolver.resolve(host, port, family)
+        public = [h for h in hosts if is_public(h["host"])]
+        if not public:
+            raise PrivateAddressError(f"{host} has no public address")
+        return public
+
+    async def close(self):
+        await self._resolver.close()
+
+
+async def _check_address(session: Any, context: Any, params: Any):
+    # IP addresses don't go through the resolver, e.g. http://127.0.0.1:9000/
+    host = params.url.raw_host or ""
+    try:
+        public = is_public(host)
+    except ValueError:
+        return  # a host name
+    if not public:
+        raise PrivateAddressError(f"{host} is not a public address")
+
+
+class Asset:
+    """A downloaded image."""
+
+    __slots__ = ("url", "hash", "content_type", "size", "path", "cdn_url", "cdn_expiry")
+
+    def __init__(self, url: str, hash: str, content_type: str, size: int, path):
+        self.url = url
+        self.hash = hash
+        self.content_type = content_type
+        self.size = size
+        self.path = path
+        self.cdn_url: Optional[str] = None
+        self.cdn_expiry = 0.0
+
+    @property
+    def filename(self) -> str:
+        return self.hash[:16] + EXTENSIONS.get(self.content_type, "")
+
+    def file(self) -> File:
+        return File(self.path, filename=self.filename)
+
+    def usable_cdn_url(self) -> Optional[str]:
+        """The CDN URL of a previous upload, if it is still valid."""
+        if self.cdn_url is not None and time.time() < self.cdn_expiry - CDN_MARGIN:
+            return self.cdn_url
+        return None
+
+    def remember_cdn_url(self, url: str):
+        """Reuse `url`, the CDN URL Discord gave an upload of this asset, until it expires."""
+        # signed attachment URLs carry their expiry as a hex timestamp in "ex"
+        expiry = parse_qs(urlsplit(url).query).get("ex")
+        try:
+            self.cdn_expiry = int(expiry[0], 16) if expiry else time.time() + 3600
+        except ValueError:
+            return
+        self.cdn_url = url
+
+
+class FetchReport:
+    __slots__ = ("downloaded", "cached", "failed", "bytes")
+
+    def __init__(self):
+        self.downloaded = 0  # new URLs
+        self.cached = 0  # URLs fetched by an earlier import
+        self.failed: dict[str, str] = {}  # URL: error
+        self.bytes = 0  # bytes downloaded
+
+
+class AssetStore:
+    def __init__(
+        self,
+        root: os.PathLike,
+        db: Database,
+        concurrency: int = CONCURRENCY,
+        max_size: int = MAX_SIZE,
+        timeout: float = TIMEOUT,
+        allow_private: bool = False,
+    ):
+        """
+        Downloads images into `root`, recording them in the assets table of `db`.
+
+        Optional parameters
+        -------------------
+        concurrency: Maximum number of simultaneous downloads (default 8)
+        max_size: Largest accepted image, in bytes (default 8 MiB)
+        timeout: Seconds allowed per download (default 30)
+        allow_private: Also fetch from loopback, private and link-local
+            addresses, for tests against a local server (default False)
+        """
+        self.root = root
+        self.db = db
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.allow_private = allow_private
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # URL: asset, or None if it has not been downloaded
+        self._known: dict[str, Optional[Asset]] = {}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _path(self, hash: str) -> str:
+        return os.path.join(self.root, hash[:2], hash)
+
+    def _asset(self, url: str, hash: str, content_type: str, size: int) -> Asset:
+        return Asset(url, hash, content_type, size, self._path(hash))
+
+    async def get(self, url: str) -> Optional[Asset]:
+        """The local copy of the image at `url`, if there is one."""
+        try:
+            return self._known[url]
+        except KeyError:
+            pass
+        async with self.db.read("get_asset") as db:
+            async with db.execute(
+                "SELECT hash, content_type, size FROM assets WHERE url = ? AND hash IS NOT NULL",
+                (url,),
+            ) as cursor:
+                row = await cursor.fetchone()
+        asset = self._asset(url, *row) if row is not None else None
+        self._known[url] = asset
+        return asset
+
+    async def fetch_all(self, urls: Iterable[Optional[str]]) -> FetchReport:
+        """
+        Download the images at `urls` that have not been downloaded yet.
+
+        Failed downloads are recorded and retried by the next call.
+        """
+        report = FetchReport()
+        urls = {
+            url
+            for url in urls
+            if isinstance(url, str) and url.startswith(("http://", "https://"))
+        }
+        if not urls:
+            return report
+
+        async with self.db.read("find_assets") as db:
+            async with db.execute(
+                f"SELECT url FROM assets WHERE hash IS NOT NULL AND url IN ({', '.join('?' for _ in urls)})",
+                tuple(urls),
+            ) as cursor:
+                done = {row[0] for row in await cursor.fetchall()}
+        report.cached = len(done)
+
+        if self._session is None:
+            self._session = self._open_session()
+        pending = sorted(urls - done)
+        results = await asyncio.gather(*(self._download(url) for url in pending))
+
+        rows = []
+        for (url, result) in zip(pending, results):
+            self._known.pop(url, None)
+            if isinstance(result, Asset):
+                report.downloaded += 1
+                report.bytes += result.size
+                rows.append((url, result.hash, result.content_type, result.size, None))
+            else:
+                report.failed[url] = result
+                rows.append((url, None, None, None, result))
+        async with self.db.transaction("store_assets") as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO assets(url, hash, content_type, size, error) VALUES(?, ?, ?, ?, ?)",
+                rows,
+            )
+        return report
+
+    def _open_session(self) -> aiohttp.ClientSession:
+        if self.allow_private:
+            return aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+        checks = aiohttp.TraceConfig()
+        checks.on_request_start.append(_check_address)  # every redirect too
+        return aiohttp.ClientSession(
+            timeout=self.timeout,
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency, resolver=PublicResolver()
+            ),
+            trace_configs=[checks],
+        )
+
+    async def _download(self, url: str) -> Union[Asset, str]:
+        """Download one image, returning the asset or an error message."""
+        assert self._session is not None
+        async with self._semaphore:
+            try:
+                async with self._session.get(url) as resp:
+                    if resp.status != 200:
+                        raise AssetError(f"HTTP {resp.status}")
+                    content_type = resp.content_type
+                    if not content_type.startswith("image/"):
+                        raise AssetError(f"not an image ({content_type})")
+                    if (resp.content_length or 0) > self.max_size:
+                        raise AssetError("image too large")
+                    digest = hashlib.sha256()
+                    chunks = []
+                    size = 0
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_size:
+                            raise AssetError("image too large")
+                        digest.update(chunk)
+                        chunks.append(chunk)
+            except AssetError as e:
+                return str(e)
+            except PrivateAddressError:
+                return "address not allowed"
+            except aiohttp.ClientConnectorError as e:
+                if isinstance(e.os_error, PrivateAddressError):
+                    return "address not allowed"
+                log.debug("downloading %s failed: %s", url, e)
+                return "could not connect"
+            except asyncio.TimeoutError:
+                return "timed out"
+            except aiohttp.ClientError as e:
+                log.debug("downloading %s failed: %s", url, e)
+                return "download failed"
+
+        hash = digest.hexdigest()
+        await asyncio.to_thread(self._write, hash, b"".join(chunks))
+        return self._asset(url, hash, content_type, size)
+
+    def _write(self, hash: str, data: bytes):
+        path = self._path(hash)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    # Self-check against a local HTTP server: downloads are deduplicated by
+    # content, bounded in concurrency, recorded, and not repeated.
+    import io
+    import sqlite3
+    import tempfile
+    from pathlib import Path
+
+    from aiohttp import web
+    from PIL import Image
+
+    from utils.migrations import migrate_sync
+
+    def png(color: str) -> bytes:
+        fp = io.BytesIO()
+        Image.new("RGB", (64, 64), color).save(fp, "PNG")
+        return fp.getvalue()
+
+    async def main():
+        red, blue = png("red"), png("blue")
+        active = peak = requests = 0
+
+        async def image(request: web.Request) -> web.Response:
+            nonlocal active, peak, requests
+            requests += 1
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.02)
+            active -= 1
+            data = red if request.match_info["name"].startswith("red") else blue
+            return web.Response(body=data, content_type="image/png")
+
+        async def huge(request: web.Request) -> web.Response:
+            return web.Response(body=b"\0" * (MAX_SIZE + 1), content_type="image/png")
+
+        app = web.Application()
+        app.router.add_get("/img/{name}", image)
+        app.router.add_get("/huge.png", huge)
+        app.router.add_get(
+            "/page", lambda _: web.Response(text="<html>", content_type="text/html")
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(Path(tmp) / "db.sqlite3")
+            migrate_sync(conn)
+            conn.close()
+            async with Database(Path(tmp) / "db.sqlite3", readers=1) as db:
+                store = AssetStore(
+                    Path(tmp) / "assets", db, concurrency=4, allow_private=True
+                )
+                urls = [f"{base}/img/red{x}.png" for x in range(20)]
+                urls += [f"{base}/img/blue{x}.png" for x in range(20)]
+                broken = [f"{base}/missing.png", f"{base}/page", f"{base}/huge.png"]
+
+                started = time.perf_counter()
+                report = await store.fetch_all([*urls, *broken, None, 42, ""])
+                elapsed = time.perf_counter() - started
+                assert report.downloaded == 40 and report.cached == 0
+                assert set(report.failed) == set(broken), report.failed
+                assert peak <= 4, peak
+                files = list((Path(tmp) / "assets").rglob("*"))
+                assert len([f for f in files if f.is_file()]) == 2, files
+                print(
+                    f"40 URLs of 2 images in {elapsed * 1000:.0f} ms, "
+                    f"at most {peak} downloads at once; failures: {report.failed}"
+                )
+
+                asset = await store.get(urls[0])
+                assert asset is not None and Path(asset.path).read_bytes() == red
+                assert asset.filename.endswith(".png")
+                assert await store.get(broken[0]) is None
+
+                # a second import only retries the failures
+                before = requests
+                report = await store.fetch_all(urls + broken)
+                assert report.cached == 40 and requests == before
+                assert len(report.failed) == 3
+
+                expiry = int(time.time()) + 86400
+                asset.remember_cdn_url(
+                    f"https://cdn.discordapp.com/attachments/1/2/a.png?ex={expiry:x}&is=0&hm=0"
+                )
+                assert asset.usable_cdn_url() is not None
+                asset.remember_cdn_url(
+                    f"https://cdn.discordapp.com/attachments/1/2/a.png?ex={int(time.time()):x}"
+                )
+                assert asset.usable_cdn_url() is None
+                await store.close()
+
+                # by default, nothing is fetched from this machine or its network
+                strict = AssetStore(Path(tmp) / "assets", db)
+                before = requests
+                port = site._server.sockets[0].getsockname()[1]
+                local = [
+                    f"http://127.0.0.1:{port}/img/red-loopback.png",
+                    f"http://localhost:{port}/img/red-localhost.png",
+                    f"http://[::ffff:127.0.0.1]:{port}/img/red-mapped.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/img/red.png",
+                ]
+                report = await strict.fetch_all(local)
+                assert requests == before, "a private address was fetched"
+                assert set(report.failed.values()) == {"address not allowed"}, report
+                assert len(report.failed) == len(local)
+                assert not any(
+                    is_public(a) for a in ("127.0.0.1", "192.168.1.1", "::1")
+                )
+                assert is_public("1.1.1.1") and is_public("2606:4700:4700::1111")
+                print(f"{len(local)} private URLs refused")
+                await strict.close()
+
+        await runner.cleanup()
+
+    asyncio.run(main())
@@ -0,0 +1,271 @@
+"""
+Running the bot as a cluster of worker processes, each owning a range of
+gateway shards (see launcher.py).
+
+A process runs its shards on one event loop, so a single process is capped at
+one core. The launcher splits the shards into contiguous ranges with
+`shard_ranges`, and a `Supervisor` runs one `bot.run_worker` process per range,
+restarting those that die. The workers share the SQLite database (opened with
+`Database(shared=True)`) and talk through the launcher's `utils.ipc.Hub`.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from dataclasses import dataclass
+from multiprocessing.process import BaseProcess
+from typing import Callable, Optional
+
+RESTART_DELAY = 1.0  # seconds before restarting a worker, doubled on each crash
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0  # seconds of uptime after which a crash isn't a crash loop
+STOP_TIMEOUT = 30.0  # seconds a worker has to shut down before being killed
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class WorkerSpec:
+    """What a worker process runs, passed to `bot.run_worker`."""
+
+    id: int
+    shard_ids: tuple[int, ...]
+    shard_count: int
+    ipc_path: str  # socket of the launcher's hub
+    database: str
+    api_base: Optional[str] = None  # a `FakeDiscord`'s, instead of Discord
+    gateway_url: Optional[str] = None
+
+
+def shard_ranges(shard_count: int, workers: int) -> list[tuple[int, ...]]:
+    """Split shards 0 to `shard_count` - 1 into `workers` contiguous ranges, as even as possible."""
+    workers = max(1, min(workers, shard_count))
+    (size, extra) = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for worker in range(workers):
+        end = start + size + (worker < extra)
+        ranges.append(tuple(range(start, end)))
+        start = end
+    return ranges
+
+
+def shard_of(guild_id: Optional[int], shard_count: int) -> int:
+    """The shard receiving the events of a guild; direct messages go to shard 0."""
+    return 0 if guild_id is None else (guild_id >> 22) % shard_count
+
+
+class Supervisor:
+    def __init__(self, specs: list[WorkerSpec], target: Callable[[WorkerSpec], None]):
+        """
+        Runs a process per worker and restarts the ones that exit with an error.
+
+        Parameters
+        ----------
+        specs: The workers to run
+        target: Function run by each worker process, `bot.run_worker`
+        """
+        self.specs = specs
+        self.target = target
+        self.restarts = 0
+        self.processes: dict[int, BaseProcess] = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._started: dict[int, float] = {}
+        self._delays = {spec.id: RESTART_DELAY for spec in specs}
+        self._stopping = False
+
+    def start(self, spec: WorkerSpec):
+        process = self._context.Process(
+            target=self.target, args=(spec,), name=f"worker-{spec.id}"
+        )
+        process.start()
+        self.processes[spec.id] = process
+        self._started[spec.id] = time.monotonic()
+        log.info(
+            "worker %d started with shards %s, pid %s",
+            spec.id,
+            spec.shard_ids,
+            process.pid,
+        )
+
+    async def run(self):
+        """Run the workers until they all exit, or until `stop`."""
+        for spec in self.specs:
+            self.start(spec)
+        watchers = [asyncio.create_task(self._watch(spec)) for spec in self.specs]
+        try:
+            await asyncio.gather(*watchers)
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+
+    async def _watch(self, spec: WorkerSpec):
+        loop = asyncio.get_running_loop()
+        while True:
+            process = self.processes[spec.id]
+            exited = loop.create_future()
+            loop.add_reader(
+                process.sentinel, lambda: exited.done() or exited.set_result(None)
+            )
+            try:
+                await exited
+            finally:
+                loop.remove_reader(process.sentinel)
+            process.join()
+            if self._stopping or process.exitcode == 0:
+                log.info("worker %d exited with %s", spec.id, process.exitcode)
+                return
+            uptime = time.monotonic() - self._started[spec.id]
+            if uptime > STABLE_AFTER:
+                self._delays[spec.id] = RESTART_DELAY
+            delay = self._delays[spec.id]
+            self._delays[spec.id] = min(delay * 2, MAX_RESTART_DELAY)
+            log.warning(
+                "worker %d exited with %s after %.0fs, restarting in %.0fs",
+                spec.id,
+                process.exitcode,
+                uptime,
+                delay,
+            )
+            await asyncio.sleep(delay)
+            if self._stopping:
+                return
+            self.restarts += 1
+            self.start(spec)
+
+    async def stop(self, timeout: float = STOP_TIMEOUT):
+        """Ask every worker to shut down, killing those still running after `timeout` seconds."""
+        self._stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM: the worker closes the bot and exits
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            while process.is_alive() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if process.is_alive():
+                log.warning("%s did not stop in time, killing it", process.name)
+                process.kill()
+            process.join()
+
+
+if __name__ == "__main__":
+    # Runs a cluster against a local fake gateway, on a copy of the database:
+    # every shard identifies once, paced by the hub, in the worker owning it,
+    # an invalidation reaches every worker, a killed worker is restarted and
+    # its shards come back, and SIGTERM stops the workers cleanly.
+    import os
+    import shutil
+    import signal
+    import tempfile
+    from pathlib import Path
+
+    from bot import BOT_DIR, run_worker
+    from utils.database import Database
+    from utils.fake_gateway import FakeDiscord
+    from utils.ipc import Hub, Peer
+    from utils.migrations import migrate
+
+    SHARDS = 6
+    WORKERS = 3
+    INTERVAL = 0.5  # seconds between identifies, instead of Discord's 5
+
+    async def until(condition: Callable[[], bool], timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, "timed out"
+            await asyncio.sleep(0.1)
+
+    def check_pacing(identified: list[tuple[int, float]], max_concurrency: int):
+        for bucket in range(max_concurrency):
+            times = [
+                t for (shard, t) in identified if shard % max_concurrency == bucket
+            ]
+            gaps = [b - a for (a, b) in zip(times, times[1:])]
+            assert all(gap >= INTERVAL * 0.99 for gap in gaps), gaps
+
+    async def statuses(peer: Peer) -> dict[int, dict]:
+        return {
+            worker: status
+            for (worker, status) in (await peer.gather("status", timeout=10)).items()
+            if status is not None
+        }
+
+    async def main():
+        fake = FakeDiscord(shard_count=SHARDS, guilds=30, max_concurrency=2)
+        await fake.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "database.sqlite3"
+            shutil.copy(BOT_DIR / "database" / "database.sqlite3", path)
+            async with Database(path, readers=1, shared=True) as db:
+                await migrate(db)
+            hub = Hub(str(Path(tmp) / "ipc.sock"), fake.max_concurrency, INTERVAL)
+            await hub.start()
+            ranges = shard_ranges(SHARDS, WORKERS)
+            specs = [
+                WorkerSpec(
+                    id,
+                    shards,
+                    SHARDS,
+                    hub.path,
+                    str(path),
+                    fake.api_base,
+                    fake.gateway_url,
+                )
+                for (id, shards) in enumerate(ranges)
+            ]
+            supervisor = Supervisor(specs, run_worker)
+            running = asyncio.create_task(supervisor.run())
+            started = time.monotonic()
+            await until(lambda: fake.connected == set(range(SHARDS)))
+            print(
+                f"{SHARDS} shards on {WORKERS} workers up in {time.monotonic() - started:.1f}s"
+            )
+            assert sorted(s for (s, _) in fake.identified) == list(range(SHARDS))
+            check_pacing(hub.identified, fake.max_concurrency)
+
+            controller = Peer(-1, hub.path)
+            await controller.connect()
+            expected = {
+                shard: sum(1 for g in fake.guilds if fake.shard_of(g) == shard)
+                for shard in range(SHARDS)
+            }
+            await until(lambda: hub.workers >= set(range(WORKERS)))
+            for (worker, status) in sorted((await statuses(controller)).items()):
+                shards = {s["id"]: s["guilds"] for s in status["shards"]}
+                assert tuple(shards) == ranges[worker], (worker, shards)
+                assert all(shards[s] == expected[s] for s in shards), shards
+                print(
+                    f"worker {worker}: shards {shards}, "
+                    f"loop lag {status['loop_lag'] * 1000:.1f} ms"
+                )
+            handled = await controller.gather("invalidate_pack", 1)
+            assert set(handled) == {-1, *range(WORKERS)}, handled
+
+            # a crash: the worker is restarted and its shards identify again
+            os.kill(supervisor.processes[1].pid, signal.SIGKILL)  # type: ignore
+            await until(lambda: not set(ranges[1]) <= fake.connected, 10)
+            started = time.monotonic()
+            await until(
+                lambda: len(fake.identified) == SHARDS + len(ranges[1])
+                and fake.connected == set(range(SHARDS))
+            )
+            assert supervisor.restarts == 1
+            await until(lambda: 1 in hub.workers)
+            assert set(await statuses(controller)) == set(range(WORKERS))
+            print(
+                f"worker 1 killed and restarted, its shards back in "
+                f"{time.monotonic() - started:.1f}s"
+            )
+            check_pacing(hub.identified, fake.max_concurrency)
+
+            await controller.close()
+            await supervisor.stop()
+            await running
+            codes = [p.exitcode for p in supervisor.processes.values()]
+            assert codes == [0] * WORKERS, codes
+            print("stopped with SIGTERM, exit codes", codes)
+            await hub.close()
+        await fake.close()
+
+    asyncio.run(main())
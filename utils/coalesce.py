@@ -0,0 +1,182 @@
+"""
+Merging bursts of edits to the same message.
+
+Every edit of a message costs an HTTP request and rate-limit budget, but only
+the last state of a message is ever seen. `EditCoalescer` holds edits for a
+short window, merges them, and sends a single edit with the latest value of
+each field.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+WINDOW = 0.5  # seconds an edit may wait for others to merge with
+
+log = logging.getLogger(__name__)
+
+
+class EditCoalescer:
+    def __init__(self, edit: Callable[..., Awaitable[Any]], window: float = WINDOW):
+        """
+        Merges edits submitted within `window` seconds into one call to `edit`.
+
+        Edits are sent one at a time, in the order they were merged, so an older
+        state never overwrites a newer one. Once a final edit has been submitted,
+        later edits are dropped.
+
+        Parameters
+        ----------
+        edit: Coroutine function editing the message, e.g. `Interaction.edit_original_response`
+
+        Optional parameters
+        -------------------
+        window: Seconds to wait for more edits before sending (default 0.5)
+        """
+        self.edit = edit
+        self.window = window
+        self.submitted = 0  # calls to `submit`
+        self.sent = 0  # calls to `edit`
+        self.dropped = 0  # edits submitted after the final one
+        self.closed = False
+        self._pending: dict[str, Any] = {}
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    @property
+    def saved(self) -> int:
+        """Edits that did not need their own request."""
+        return self.submitted - self.sent
+
+    async def submit(self, final: bool = False, **kwargs: Any):
+        """
+        Schedule an edit of the message, taking the same keyword arguments as `edit`.
+
+        Non-final edits return immediately. A final edit is sent right away,
+        after any edit already in progress, and returns once it is done.
+        """
+        self.submitted += 1
+        if self.closed:
+            self.dropped += 1
+            return
+        self._pending.update(kwargs)
+
+        if final:
+            self.closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """Send the pending edit now, if there is one."""
+        async with self._lock:
+            if not self._pending:
+                return
+            (kwargs, self._pending) = (self._pending, {})
+            self.sent += 1
+            await self.edit(**kwargs)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("coalesced edit failed")
+
+
+if __name__ == "__main__":
+    # Self-check with a fake interaction layer: a burst of lobby joins becomes
+    # a couple of edits, and nothing lands after the final state.
+    import random
+    import time
+    from types import SimpleNamespace
+
+    import discord
+
+    from utils.context import Context
+    from utils.views.start import StartingMenu
+
+    class FakeResponse:
+        def __init__(self):
+            self.done = False
+
+        def is_done(self) -> bool:
+            return self.done
+
+        async def defer(self):
+            self.done = True
+
+    class FakeMessage:
+        def __init__(self, embed: discord.Embed):
+            self.embeds = [embed]
+            self.edits: list[dict[str, Any]] = []
+
+        async def edit(self, **kwargs: Any):
+            await asyncio.sleep(random.uniform(0.01, 0.05))  # HTTP round trip
+            if "embed" in kwargs:
+                self.embeds = [discord.Embed.from_dict(kwargs["embed"].to_dict())]
+            self.edits.append(kwargs)
+
+    def interaction(user_id: int, message: FakeMessage) -> Any:
+        return SimpleNamespace(
+            user=SimpleNamespace(id=user_id, display_name=f"Người chơi {user_id}"),
+            message=message,
+            response=FakeResponse(),
+            edit_original_response=message.edit,
+        )
+
+    async def lobby(clicks: int, spread: float) -> tuple[FakeMessage, EditCoalescer]:
+        embed = discord.Embed(title="Bắt đầu vòng khởi động")
+        embed.add_field(name="Luật chơi", value="O22")
+        embed.add_field(name="Người chơi", value="Người chơi 0")
+        message = FakeMessage(embed)
+        ctx = Context(interaction(0, message))  # type: ignore
+        view = StartingMenu(ctx, {0: "Người chơi 0"}, timeout=None)
+        button = view.children[0]
+
+        async def click(user_id: int):
+            await asyncio.sleep(random.uniform(0, spread))
+            await button.callback(interaction(user_id, message))  # type: ignore
+
+        # every join arrives within `spread` seconds
+        await asyncio.gather(*(click(user_id) for user_id in range(1, clicks + 1)))
+        embed.description = "Một vòng khởi động đã bắt đầu!"
+        embed.set_field_at(1, name="Người chơi", value=", ".join(view.players.values()))
+        await ctx.edit_coalesced(final=True, embed=embed, view=view)
+        await ctx.edit_coalesced(view=view)  # e.g. a late on_timeout
+        await asyncio.sleep(WINDOW * 2)
+        assert ctx._edits is not None
+        return (message, ctx._edits)
+
+    async def main():
+        random.seed(1)
+        started = time.perf_counter()
+        (message, edits) = await lobby(10, 1.0)
+        final = message.embeds[0]
+        assert final.description == "Một vòng khởi động đã bắt đầu!"
+        assert final.fields[1].value.count("Người chơi") == 11
+        assert "view" in message.edits[-1]
+        assert edits.dropped == 1 and edits.sent == len(message.edits)
+        print(
+            f"10 joins in 1s: {edits.submitted} edits submitted, {edits.sent} sent, "
+            f"{edits.saved} saved, {edits.dropped} dropped after the final state "
+            f"({time.perf_counter() - started:.2f}s)"
+        )
+
+        # the final edit waits for an edit in flight and always lands last
+        for _ in range(200):
+            message = FakeMessage(discord.Embed())
+            coalescer = EditCoalescer(message.edit, window=0.001)
+            for x in range(5):
+                await coalescer.submit(embed=discord.Embed(title=str(x)))
+                await asyncio.sleep(random.uniform(0, 0.003))
+            await coalescer.submit(final=True, embed=discord.Embed(title="final"))
+            await coalescer.submit(embed=discord.Embed(title="late"))
+            await asyncio.sleep(0.01)
+            assert message.embeds[0].title == "final", message.edits
+        print("final state never overtaken in 200 randomised runs")
+
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+"""
+Syncing the application command tree only when it changed.
+
+`CommandTree.sync` replaces every command of a scope with one rate-limited
+HTTP call, and `on_ready` fires again on every gateway reconnect. The payload a
+sync would upload is hashed instead, and the hash of the last successful sync of
+each scope is kept in `SIGNATURE_FILE`: when they match, the commands Discord
+has are already the ones we have, and the sync is skipped.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+from discord import Object, app_commands
+
+SIGNATURE_FILE = "command_tree.json"
+
+
+def _scope(guild: Optional[Object]) -> str:
+    return "global" if guild is None else str(guild.id)
+
+
+def tree_payload(
+    tree: app_commands.CommandTree, guild: Optional[Object] = None
+) -> list[dict[str, Any]]:
+    """The commands `tree.sync(guild=guild)` would upload, in a stable order."""
+    commands = tree._get_all_commands(guild=guild)
+    return sorted(
+        (command.to_dict(tree) for command in commands),
+        key=lambda command: (command.get("type", 1), command["name"]),
+    )
+
+
+def tree_signature(
+    tree: app_commands.CommandTree, guild: Optional[Object] = None
+) -> str:
+    """
+    SHA-256 of the commands of a scope: names, parameters, descriptions,
+    permissions and the application they belong to.
+
+    Stable across processes, since it only depends on the commands' payload.
+    """
+    document = {
+        "application_id": tree.client.application_id,
+        "scope": _scope(guild),
+        "commands": tree_payload(tree, guild),
+    }
+    encoded = json.dumps(
+        document, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class TreeSyncer:
+    def __init__(self, tree: app_commands.CommandTree, path: Path):
+        """
+        Syncs the scopes of `tree` whose signature differs from the one stored in `path`.
+
+        Parameters
+        ----------
+        tree: The bot's command tree
+        path: JSON file mapping each scope to the signature of its last sync
+        """
+        self.tree = tree
+        self.path = path
+
+    def _load(self) -> dict[str, str]:
+        try:
+            with self.path.open() as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, signatures: dict[str, str]):
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            json.dump(signatures, f, indent=2)
+        tmp.replace(self.path)
+
+    def is_synced(self, guild: Optional[Object] = None) -> bool:
+        return self._load().get(_scope(guild)) == tree_signature(self.tree, guild)
+
+    async def sync(self, guild: Optional[Object] = None, force: bool = False) -> bool:
+        """
+        Sync the commands of `guild` (global commands if None) if they changed
+        since the last sync, or if `force`.
+
+        Returns
+        -------
+        Whether the commands were synced.
+        """
+        signatures = self._load()
+        signature = tree_signature(self.tree, guild)
+        if not force and signatures.get(_scope(guild)) == signature:
+            return False
+        await self.tree.sync(guild=guild)
+        # only remembered once Discord accepted the commands
+        signatures[_scope(guild)] = signature
+        self._save(signatures)
+        return True
+
+
+if __name__ == "__main__":
+    # The signature is the same across processes and registration orders and
+    # changes with any change of a command; unchanged trees skip the sync.
+    import asyncio
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    import time
+
+    from discord import Intents
+    from discord.ext import commands
+
+    GUILD = Object(id=1)
+
+    def make_tree(reverse: bool = False, description: str = "Bắt đầu một trận"):
+        bot = commands.Bot(
+            command_prefix="!", intents=Intents.default(), application_id=42
+        )
+
+        @app_commands.command(description=description)
+        @app_commands.describe(pack="ID bộ đề")
+        async def start(interaction, pack: int = 0):
+            pass
+
+        @app_commands.command(description="Lấy form nhập đề mẫu")
+        async def template(interaction):
+            pass
+
+        for command in (template, start) if reverse else (start, template):
+            bot.tree.add_command(command, guild=GUILD)
+        return bot.tree
+
+    if sys.argv[1:] == ["--print"]:
+        print(tree_signature(make_tree(), GUILD))
+        sys.exit()
+
+    signature = tree_signature(make_tree(), GUILD)
+    assert signature == tree_signature(make_tree(), GUILD)
+    assert signature == tree_signature(make_tree(reverse=True), GUILD)
+    assert signature != tree_signature(make_tree(description="Bắt đầu"), GUILD)
+    assert signature != tree_signature(make_tree())
+    for seed in ("1", "2"):
+        child = subprocess.run(
+            [sys.executable, "-m", "utils.command_sync", "--print"],
+            capture_output=True,
+            text=True,
+            env={**os.environ, "PYTHONHASHSEED": seed},
+        )
+        assert child.stdout.strip() == signature, (child.stdout, child.stderr)
+    print(f"signature {signature[:16]}... stable across processes")
+
+    async def main():
+        tree = make_tree()
+        synced = 0
+
+        async def fake_sync(guild=None):
+            nonlocal synced
+            synced += 1
+            await asyncio.sleep(0.5)  # a bulk upsert, before any rate limit
+
+        tree.sync = fake_sync  # type: ignore
+        with tempfile.TemporaryDirectory() as tmp:
+            syncer = TreeSyncer(tree, Path(tmp) / SIGNATURE_FILE)
+            assert await syncer.sync(GUILD) and synced == 1
+            started = time.perf_counter()
+            for _ in range(100):  # reconnects
+                assert not await syncer.sync(GUILD)
+            skipped = (time.perf_counter() - started) / 100
+            assert synced == 1 and syncer.is_synced(GUILD)
+            assert await syncer.sync(GUILD, force=True) and synced == 2
+        print(f"unchanged tree: sync skipped in {skipped * 1000:.2f} ms")
+
+    asyncio.run(main())
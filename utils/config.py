@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 from dotenv import dotenv_values
 
@@ -11,6 +11,8 @@ class BotConfig:
     token: str
     sync_commands_globally: bool
     dev: bool
+    metrics_port: Optional[int] = None
+    buzz_grace_ms: Optional[int] = None
 
     def __init__(self, cfg: dict[str, str | None]):
         for (key, value) in cfg.items():
@@ -18,7 +20,13 @@ class BotConfig:
             if value is None:
                 print(f"[WARN] Empty key: {key}")
                 continue
-            if key in ["GUILD_ID", "APPLICATION_ID", "OWNER_ID"]:
+            if key in [
+                "GUILD_ID",
+                "APPLICATION_ID",
+                "OWNER_ID",
+                "METRICS_PORT",
+                "BUZZ_GRACE_MS",
+            ]:
                 val = int(value)
             elif value.lower() in ["true", "false"]:
                 val = value.lower() == "true"
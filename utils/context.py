@@ -4,6 +4,8 @@ from typing import Optional
 
 import discord
 
+from utils import tracing
+from utils.coalesce import EditCoalescer
 from utils.typings import CommandCallback
 
 
@@ -11,7 +13,12 @@ def transform_context(func: CommandCallback):
     @functools.wraps(func)
     async def decorator(self, interaction, *args, **kwargs):
         ctx = Context(interaction)
-        return await func(self, ctx, *args, **kwargs)
+        command = interaction.command
+        name = command.qualified_name if command is not None else func.__name__
+        with tracing.trace(
+            f"/{name}", user=interaction.user.id, guild=interaction.guild_id
+        ) as ctx.trace:
+            return await func(self, ctx, *args, **kwargs)
 
     return decorator
 
@@ -20,6 +27,8 @@ class Context:
     def __init__(self, interaction: discord.Interaction):
         self.interaction: discord.Interaction = interaction
         self.whisper = False
+        self.trace: Optional[tracing.Span] = None
+        self._edits: Optional[EditCoalescer] = None
 
     @property
     def guild(self):
@@ -64,6 +73,11 @@ class Context:
     def send(self):
         return self.interaction.channel.send  # type: ignore
 
+    def end_trace(self):
+        """End the trace of the command, for one that goes on after answering."""
+        if self.trace is not None:
+            tracing.finish(self.trace)
+
     async def respond_or_edit(self, *args, **kwargs):
         """Respond to an interaction if not already responded, otherwise edit the original response.
         Takes in the same args and kwargs as `respond`.
@@ -160,6 +174,14 @@ class Context:
                     self.delay_delete(self.interaction, delete_after)
                 )
 
+    async def edit_coalesced(self, final: bool = False, **kwargs):
+        """Edit the original response, merging edits made in quick succession.
+        Takes in the same kwargs as `edit`. See `EditCoalescer.submit`.
+        """
+        if self._edits is None:
+            self._edits = EditCoalescer(self.edit)
+        await self._edits.submit(final=final, **kwargs)
+
     async def delay_delete(self, ctx: discord.Interaction, delay: int):
         try:
             await asyncio.sleep(delay)
@@ -0,0 +1,349 @@
+"""
+Database access for the bot.
+
+The database runs in WAL mode, so readers never wait for a write transaction to
+finish. All writes go through a single writer connection, one transaction at a
+time (`Database.transaction`), while game-time reads borrow one of a few
+read-only connections (`Database.read`).
+
+The workers of a cluster (see launcher.py) open the same file from several
+processes: WAL works across processes on one machine, and their writers take
+turns through SQLite's own lock, which `BEGIN IMMEDIATE` takes up front. With
+`shared`, a writer waits up to `SHARED_BUSY_TIMEOUT` for the other processes'
+transactions, such as a large import, instead of failing with "database is
+locked". Migrations must still run in one process before the others start.
+"""
+import asyncio
+import contextlib
+import time
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import aiosqlite
+
+from utils import metrics, tracing
+
+DEFAULT_READERS = 4
+BUSY_TIMEOUT = 5000  # milliseconds
+SHARED_BUSY_TIMEOUT = 60000  # milliseconds, when other processes write too
+
+
+class PoolStats:
+    """Usage counters of a `Database`."""
+
+    __slots__ = (
+        "reads",
+        "read_wait",
+        "max_read_wait",
+        "readers_in_use",
+        "transactions",
+        "rollbacks",
+        "write_wait",
+        "max_write_wait",
+    )
+
+    def __init__(self):
+        self.reads = 0  # connections handed out by `read`
+        self.read_wait = 0.0  # total seconds spent waiting for a reader
+        self.max_read_wait = 0.0
+        self.readers_in_use = 0
+        self.transactions = 0  # transactions committed
+        self.rollbacks = 0
+        self.write_wait = 0.0  # total seconds spent waiting for the writer
+        self.max_write_wait = 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Database:
+    def __init__(
+        self, path: Path, readers: int = DEFAULT_READERS, shared: bool = False
+    ):
+        """
+        A writer connection and a pool of read-only connections to `path`.
+
+        Call `open` before use and `close` when done, or use `async with`.
+
+        Optional parameters
+        -------------------
+        readers: Number of read-only connections (default 4)
+        shared: Whether other processes write to `path` too (default False)
+        """
+        self.path = path
+        self.reader_count = readers
+        self.shared = shared
+        self.stats = PoolStats()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._all_readers: list[aiosqlite.Connection] = []
+
+    async def __aenter__(self) -> "Database":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        # autocommit mode, transactions are started explicitly by `transaction`
+        self._writer = await aiosqlite.connect(self.path, isolation_level=None)
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._writer.execute("PRAGMA synchronous=NORMAL")
+        timeout = SHARED_BUSY_TIMEOUT if self.shared else BUSY_TIMEOUT
+        await self._writer.execute(f"PRAGMA busy_timeout={timeout}")
+
+        uri = f"{Path(self.path).absolute().as_uri()}?mode=ro"
+        for _ in range(self.reader_count):
+            reader = await aiosqlite.connect(uri, uri=True, isolation_level=None)
+            await reader.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+            self._all_readers.append(reader)
+            self._readers.put_nowait(reader)
+
+    async def close(self):
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @property
+    def writer(self) -> aiosqlite.Connection:
+        """
+        The writer connection. Writes outside of `transaction` are committed
+        immediately and may interleave with other writers' statements.
+        """
+        assert self._writer is not None, "database is not open"
+        return self._writer
+
+    @contextlib.asynccontextmanager
+    async def read(self, name: str = "other") -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Borrow a read-only connection for the duration of the `with` block.
+
+        The time spent in the block is recorded as the latency of statement `name`,
+        and as a span of the current trace.
+        """
+        with tracing.span("db.read", statement=name):
+            started = time.perf_counter()
+            reader = await self._readers.get()
+            borrowed = time.perf_counter()
+            waited = borrowed - started
+            self.stats.reads += 1
+            self.stats.read_wait += waited
+            self.stats.max_read_wait = max(self.stats.max_read_wait, waited)
+            self.stats.readers_in_use += 1
+            try:
+                yield reader
+            finally:
+                self.stats.readers_in_use -= 1
+                self._readers.put_nowait(reader)
+                metrics.DB_QUERY_SECONDS.labels(name).observe(
+                    time.perf_counter() - borrowed
+                )
+
+    @contextlib.asynccontextmanager
+    async def transaction(
+        self, name: str = "other"
+    ) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Run the `with` block in a write transaction on the writer connection.
+
+        The transaction is committed when the block exits normally, and rolled
+        back if it raises. Transactions never overlap. The time from BEGIN to
+        COMMIT is recorded as the latency of statement `name`, and the whole
+        transaction as a span of the current trace.
+        """
+        with tracing.span("db.transaction", statement=name):
+            started = time.perf_counter()
+            async with self._write_lock:
+                waited = time.perf_counter() - started
+                self.stats.write_wait += waited
+                self.stats.max_write_wait = max(self.stats.max_write_wait, waited)
+
+                began = time.perf_counter()
+                await self.writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self.writer
+                except BaseException:
+                    await self.writer.rollback()
+                    self.stats.rollbacks += 1
+                    raise
+                else:
+                    await self.writer.commit()
+                    self.stats.transactions += 1
+                finally:
+                    metrics.DB_QUERY_SECONDS.labels(name).observe(
+                        time.perf_counter() - began
+                    )
+
+    async def executescript(self, script: str):
+        """Run an SQL script on the writer, outside of any transaction."""
+        async with self._write_lock:
+            await self.writer.executescript(script)
+
+
+if __name__ == "__main__":
+    # Benchmark: read latency while large imports are being written, with a
+    # single shared connection (the old setup) and with the WAL reader pool.
+    # Then writes from several processes at once, while one of them holds a
+    # transaction longer than BUSY_TIMEOUT, as a large import would.
+    import multiprocessing
+    import sqlite3
+    import statistics
+    import tempfile
+
+    from utils.migrations import migrate_sync
+
+    IMPORT_ROWS = 200_000
+    INSERT = "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)"
+    SELECT = "SELECT * FROM starting WHERE pack_id = ?"
+
+    def rows(pack_id: int, count: int = IMPORT_ROWS):
+        return (
+            (pack_id, x % 3 + 1, f"Câu hỏi số {x}?", f"đáp án {x}", None)
+            for x in range(count)
+        )
+
+    def seed(path: Path):
+        conn = sqlite3.connect(path)
+        migrate_sync(conn)
+        conn.executemany(INSERT, rows(1, 45))
+        conn.commit()
+        conn.close()
+
+    async def game_starts(read, stop: asyncio.Event) -> list[float]:
+        latencies = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            await read()
+            latencies.append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(0.005)
+        return latencies
+
+    def report(name: str, latencies: list[float], elapsed: float):
+        latencies.sort()
+        print(
+            f"{name:>18}: {len(latencies)} reads, "
+            f"p50 {statistics.median(latencies):.2f} ms, "
+            f"p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms, "
+            f"max {latencies[-1]:.2f} ms, imports took {elapsed:.2f}s"
+        )
+
+    async def single_connection(path: Path):
+        async with aiosqlite.connect(path) as db:
+
+            async def read():
+                async with db.execute(SELECT, (1,)) as cursor:
+                    await cursor.fetchall()
+
+            async def imports():
+                for pack_id in range(2, 4):
+                    await db.executemany(INSERT, rows(pack_id))
+                    await db.commit()
+
+            stop = asyncio.Event()
+            readers = [asyncio.create_task(game_starts(read, stop)) for _ in range(4)]
+            started = time.perf_counter()
+            await imports()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            report(
+                "single connection", sum(await asyncio.gather(*readers), []), elapsed
+            )
+
+    async def pooled(path: Path):
+        async with Database(path) as db:
+
+            async def read():
+                async with db.read() as conn:
+                    async with conn.execute(SELECT, (1,)) as cursor:
+                        await cursor.fetchall()
+
+            async def imports():
+                for pack_id in range(2, 4):
+                    async with db.transaction() as conn:
+                        await conn.executemany(INSERT, rows(pack_id))
+
+            stop = asyncio.Event()
+            readers = [asyncio.create_task(game_starts(read, stop)) for _ in range(4)]
+            started = time.perf_counter()
+            await imports()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            report(
+                "WAL + reader pool", sum(await asyncio.gather(*readers), []), elapsed
+            )
+            print(f"{'pool stats':>18}: {db.stats.as_dict()}")
+
+    async def increment(path: Path, shared: bool, times: int, hold: float) -> int:
+        """Add 1 to every row `times` times, the first time holding the lock `hold` seconds."""
+        failed = 0
+        async with Database(path, readers=1, shared=shared) as db:
+            for i in range(times):
+                try:
+                    async with db.transaction() as conn:
+                        await conn.execute("UPDATE starting SET round = round + 1")
+                        if i == 0:
+                            await asyncio.sleep(hold)
+                except sqlite3.OperationalError:
+                    failed += 1
+        return failed
+
+    def process(path: Path, shared: bool, times: int, hold: float, failures):
+        failures.put(asyncio.run(increment(path, shared, times, hold)))
+
+    def processes(path: Path, shared: bool, count: int = 4, times: int = 50):
+        context = multiprocessing.get_context("fork")
+        failures = context.Queue()
+        started = time.perf_counter()
+        workers = [
+            context.Process(
+                target=process,
+                args=(
+                    path,
+                    shared,
+                    times,
+                    BUSY_TIMEOUT / 1000 + 1 if i == 0 else 0,
+                    failures,
+                ),
+            )
+            for i in range(count)
+        ]
+        workers[0].start()
+        time.sleep(0.2)  # let it take the lock first
+        for worker in workers[1:]:
+            worker.start()
+        failed = sum(failures.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        conn = sqlite3.connect(path)
+        ((rounds,),) = conn.execute(
+            "SELECT DISTINCT round - (id - 1) % 3 - 1 FROM starting"
+        )
+        conn.close()
+        assert rounds == count * times - failed
+        print(
+            f"{'shared' if shared else 'not shared':>18}: {count} processes, "
+            f"{rounds} transactions committed, {failed} failed with the database "
+            f"locked, in {time.perf_counter() - started:.1f}s"
+        )
+        return failed
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            for (name, bench) in (("single", single_connection), ("pooled", pooled)):
+                path = Path(tmp) / f"{name}.sqlite3"
+                seed(path)
+                await bench(path)
+
+    asyncio.run(main())
+    with tempfile.TemporaryDirectory() as tmp:
+        for shared in (False, True):
+            path = Path(tmp) / f"{shared}.sqlite3"
+            seed(path)
+            failed = processes(path, shared)
+            assert (failed == 0) == shared
@@ -0,0 +1,457 @@
+"""
+Finding near-duplicate questions with MinHash and locality-sensitive hashing.
+
+Packs from different authors often reuse questions with small rewordings. A
+question and its answer, folded like `utils.search.fold` does, are represented
+by their shingles, the pairs of consecutive words, and two questions are
+near-duplicates when the Jaccard similarity of their shingles is at least
+`SIMILARITY`.
+
+Comparing a pack with every question of the bank would take time linear in
+the bank, so each question gets a MinHash signature of `HASHES` values, cut
+into `BANDS` bands, and the hash of each band is stored in `question_lsh`
+(migration 0005). Questions sharing a bucket with a new question are its
+candidates, likely similar: only those are read back and compared exactly.
+With 10 bands of 3 values, a question at 0.6 similarity shares a bucket with
+probability 1 - (1 - 0.6^3)^10 ≈ 0.91 (0.996 at 0.75), one at 0.2 with
+probability 0.08, and unrelated questions almost never do.
+
+Only the questions of the starting, finish and chp tables are checked: those
+of obstacles and acceleration rounds belong to a set and can't be skipped alone.
+
+Indexing a whole bank takes close to a minute per 100k questions, of Python
+code holding the GIL. An existing bank is indexed by import_packs.py, or by the
+bot with `backfill_index` in the background, a `BATCH` at a time; /import
+only indexes a bounded batch besides its own pack, and checks against what is
+indexed so far.
+"""
+import asyncio
+import hashlib
+import logging
+import random
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+
+from utils.database import Database
+from utils.packs import ParsedPack
+from utils.search import KIND_BITS, WORD, SearchHit, fold, load_questions
+
+SIMILARITY = 0.6  # Jaccard similarity of near-duplicates
+BANDS = 10
+ROWS = 3  # MinHash values per band
+HASHES = BANDS * ROWS
+PRIME = (1 << 61) - 1
+BATCH = 500  # questions indexed at a time in the background, about 0.25 s
+BACKFILL_PAUSE = 1.0  # seconds between batches, leaving the event loop the GIL
+
+log = logging.getLogger(__name__)
+
+# kind: (table and ParsedPack attribute, question column, answer column)
+COLUMNS = {
+    1: ("starting", 1, 2),
+    2: ("finish", 2, 3),
+    3: ("chp", 0, 1),
+}
+
+
+def _permutations(seed: int) -> list[tuple[int, int]]:
+    # fixed, since the buckets are stored: changing them means reindexing
+    rng = random.Random(seed)
+    return [(rng.getrandbits(61) | 1, rng.getrandbits(61)) for _ in range(HASHES)]
+
+
+PERMUTATIONS = _permutations(0x6D6F756E)
+
+
+def _text(question: Any, answer: Any) -> str:
+    return " ".join(str(value) for value in (question, answer) if value is not None)
+
+
+def shingles(question: Any, answer: Any) -> set[str]:
+    """The pairs of consecutive words of a question and its answer, folded."""
+    tokens = WORD.findall(fold(_text(question, answer)))
+    if len(tokens) < 2:
+        return set(tokens)
+    return {f"{a} {b}" for (a, b) in zip(tokens, tokens[1:])}
+
+
+def signature(shingles: set[str]) -> tuple[int, ...]:
+    """MinHash signature of a set of shingles (empty for an empty set)."""
+    if not shingles:
+        return ()
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+    return tuple(min((a * h + b) % PRIME for h in hashes) for (a, b) in PERMUTATIONS)
+
+
+def buckets(signature: tuple[int, ...]) -> list[int]:
+    """The LSH bucket of each band of `signature`, as signed 64-bit integers."""
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                struct.pack(
+                    f"<B{ROWS}Q", band, *signature[band * ROWS : (band + 1) * ROWS]
+                ),
+                digest_size=8,
+            ).digest(),
+            "little",
+            signed=True,
+        )
+        for band in range(BANDS if signature else 0)
+    ]
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+@dataclass
+class PackQuestion:
+    """A question of a pack being imported."""
+
+    kind: int  # key of COLUMNS
+    index: int  # row in its list of the ParsedPack
+    question: Any
+    answer: Any
+    shingles: set[str]
+    signature: tuple[int, ...]
+
+
+@dataclass
+class Duplicate:
+    question: PackQuestion
+    similarity: float
+    # the question it duplicates: already stored, or earlier in the same pack
+    existing: Optional[SearchHit] = None
+    earlier: Optional[PackQuestion] = None
+
+
+def pack_questions(pack: ParsedPack) -> list[PackQuestion]:
+    """The checked questions of `pack`, with their signatures. CPU-bound."""
+    questions = []
+    for (kind, (attribute, question_column, answer_column)) in COLUMNS.items():
+        for (index, row) in enumerate(getattr(pack, attribute)):
+            question = row[question_column]
+            answer = row[answer_column]
+            words = shingles(question, answer)
+            questions.append(
+                PackQuestion(kind, index, question, answer, words, signature(words))
+            )
+    return questions
+
+
+async def find_duplicates(
+    db: Database, questions: list[PackQuestion]
+) -> list[Duplicate]:
+    """
+    The near-duplicates among `questions`, of questions of the bank or of
+    earlier ones of the list, with the most similar question for each.
+
+    The bank's questions must be indexed (see `update_index`).
+    """
+    question_buckets = [buckets(question.signature) for question in questions]
+    wanted = sorted({bucket for group in question_buckets for bucket in group})
+    stored: dict[int, set[int]] = {}
+    async with db.read("find_duplicates") as conn:
+        for start in range(0, len(wanted), 500):
+            chunk = wanted[start : start + 500]
+            async with conn.execute(
+                "SELECT bucket, key FROM question_lsh "
+                f"WHERE bucket IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ) as cursor:
+                for (bucket, key) in await cursor.fetchall():
+                    stored.setdefault(bucket, set()).add(key)
+        candidates = [
+            {key for bucket in group for key in stored.get(bucket, ())}
+            for group in question_buckets
+        ]
+        hits = await load_questions(conn, set().union(*candidates))
+
+    hit_shingles = {
+        key: shingles(hit.question, hit.answer) for (key, hit) in hits.items()
+    }
+    duplicates = []
+    seen: dict[int, list[int]] = {}  # bucket: earlier questions of the list
+    for (i, (question, group)) in enumerate(zip(questions, question_buckets)):
+        best: Optional[Duplicate] = None
+        for key in candidates[i]:
+            if key not in hits:  # deleted since indexed
+                continue
+            similarity = jaccard(question.shingles, hit_shingles[key])
+            if similarity >= SIMILARITY and (
+                best is None or similarity > best.similarity
+            ):
+                best = Duplicate(question, similarity, existing=hits[key])
+        for j in {j for bucket in group for j in seen.get(bucket, ())}:
+            similarity = jaccard(question.shingles, questions[j].shingles)
+            if similarity >= SIMILARITY and (
+                best is None or similarity > best.similarity
+            ):
+                best = Duplicate(question, similarity, earlier=questions[j])
+        for bucket in group:
+            seen.setdefault(bucket, []).append(i)
+        if best is not None:
+            duplicates.append(best)
+    return duplicates
+
+
+def remove_duplicates(pack: ParsedPack, duplicates: list[Duplicate]):
+    """Remove the questions of `duplicates` from `pack`."""
+    for (kind, (attribute, _, _)) in COLUMNS.items():
+        skipped = {d.question.index for d in duplicates if d.question.kind == kind}
+        rows = getattr(pack, attribute)
+        setattr(
+            pack, attribute, [row for (i, row) in enumerate(rows) if i not in skipped]
+        )
+
+
+async def update_index(
+    db: Database, known: Iterable[PackQuestion] = (), limit: Optional[int] = None
+) -> int:
+    """
+    Index the questions added since the last update, returning how many.
+
+    Optional parameters
+    -------------------
+    known: Questions whose signatures are already computed, such as those of a
+        pack just stored
+    limit: Index at most this many questions, the oldest first (default all)
+    """
+    signatures = {
+        (question.kind, _text(question.question, question.answer)): question.signature
+        for question in known
+    }
+    rows = []
+    async with db.read("update_index") as conn:
+        for (kind, (table, _, _)) in COLUMNS.items():
+            if limit is not None and len(rows) >= limit:
+                break
+            async with conn.execute(
+                f"SELECT id, question, answer FROM {table} WHERE id > ("
+                "SELECT coalesce(max(last_id), 0) FROM question_lsh_progress WHERE kind = ?"
+                ") ORDER BY id LIMIT ?",
+                (kind, -1 if limit is None else limit - len(rows)),
+            ) as cursor:
+                rows += [(kind, *row) for row in await cursor.fetchall()]
+    if not rows:
+        return 0
+
+    def entries() -> list[tuple[int, int]]:
+        result = []
+        for (kind, id, question, answer) in rows:
+            minhash = signatures.get((kind, _text(question, answer)))
+            if minhash is None:
+                minhash = signature(shingles(question, answer))
+            result += [(bucket, id << KIND_BITS | kind) for bucket in buckets(minhash)]
+        return result
+
+    indexed = await asyncio.to_thread(entries)
+    # rows are in id order: the last one of each kind is the new progress
+    progress = {kind: id for (kind, id, _, _) in rows}
+    async with db.transaction("update_index") as conn:
+        await conn.executemany(
+            "INSERT OR IGNORE INTO question_lsh(bucket, key) VALUES (?, ?)", indexed
+        )
+        await conn.executemany(
+            "INSERT INTO question_lsh_progress(kind, last_id) VALUES (?, ?) "
+            "ON CONFLICT (kind) DO UPDATE SET last_id = max(last_id, excluded.last_id)",
+            progress.items(),
+        )
+    return len(rows)
+
+
+async def backfill_index(
+    db: Database, batch: int = BATCH, pause: float = BACKFILL_PAUSE
+) -> int:
+    """
+    Index every question not indexed yet, `batch` at a time with `pause`
+    seconds in between, returning how many. Stops at the first error, logged:
+    the next call goes on from there.
+    """
+    total = 0
+    try:
+        while indexed := await update_index(db, limit=batch):
+            total += indexed
+            await asyncio.sleep(pause)
+    except Exception:
+        log.exception("indexing questions for duplicate detection failed")
+    return total
+
+
+if __name__ == "__main__":
+    # Benchmark: overhead of the duplicate check when importing packs into a
+    # bank of 100k questions, and recall on planted rewordings and copies,
+    # against comparing each question of a pack with the whole bank.
+    import itertools
+    import sqlite3
+    import statistics
+    import tempfile
+    import time
+    from pathlib import Path
+
+    from utils.migrations import migrate_sync
+    from utils.packs import store_pack
+
+    BANK = 100_000
+    IMPORTS = 20
+
+    a = shingles("Thủ đô của nước Việt Nam là thành phố nào?", "Hà Nội")
+    b = shingles("Thủ đô nước Việt Nam là thành phố nào", "Hà Nội")
+    c = shingles("Thủ đô của nước Lào là thành phố nào?", "Viêng Chăn")
+    print(f"rewording: {jaccard(a, b):.2f}, other question: {jaccard(a, c):.2f}")
+    assert jaccard(a, b) >= SIMILARITY > jaccard(a, c)
+
+    ONSETS = "b c ch d đ g gi h k kh l m n ng nh ph qu r s t th tr v x".split()
+    RHYMES = "a à á ả ã ạ ăn ân ên ơn ưa ươ iêng uôn oai ương inh ông ước ai ao".split()
+    RNG = random.Random(0)
+    VOCABULARY = [
+        f"{RNG.choice(ONSETS)}{RNG.choice(RHYMES)}{RNG.choice(ONSETS)}{RNG.choice(RHYMES)}"
+        for _ in range(30_000)
+    ]
+    CUMULATIVE = list(
+        itertools.accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1))
+    )
+
+    def sentence(length: int) -> str:
+        return " ".join(RNG.choices(VOCABULARY, cum_weights=CUMULATIVE, k=length))
+
+    def reword(text: str) -> str:
+        words = text.split()
+        words[RNG.randrange(len(words))] = RNG.choice(VOCABULARY)
+        return " ".join(words)
+
+    def build(path: Path):
+        conn = sqlite3.connect(path)
+        migrate_sync(conn)
+        conn.executemany(
+            "INSERT INTO starting(pack_id, round, question, answer) VALUES (?, ?, ?, ?)",
+            ((x // 45, x % 3 + 1, sentence(14), sentence(2)) for x in range(BANK // 2)),
+        )
+        conn.executemany(
+            "INSERT INTO finish(pack_id, rnd, score, question, answer) VALUES (?, ?, ?, ?, ?)",
+            ((x // 12, 1, 20, sentence(18), sentence(3)) for x in range(BANK // 2)),
+        )
+        conn.commit()
+        conn.close()
+
+    def make_pack(bank: list[tuple[str, str]]) -> tuple[ParsedPack, int]:
+        """A pack of 66 questions, with 8 rewordings, 3 copies and 1 repeat."""
+        pack = ParsedPack()
+        planted = RNG.sample(bank, 11)
+        for (question, answer) in planted[:8]:
+            pack.starting.append((1, reword(question), answer, None))
+        for (question, answer) in planted[8:]:
+            pack.starting.append((2, question, answer, None))
+        while len(pack.starting) < 44:
+            pack.starting.append((3, sentence(14), sentence(2), None))
+        pack.starting.append(
+            (3, reword(pack.starting[-1][1]), pack.starting[-1][2], None)
+        )
+        pack.finish = [
+            (1, 20, sentence(18), sentence(3), None, None) for _ in range(18)
+        ]
+        pack.chp = [(sentence(12), sentence(2)) for _ in range(3)]
+        return (pack, 12)
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "bank.sqlite3"
+            build(path)
+            conn = sqlite3.connect(path)
+            bank = conn.execute("SELECT question, answer FROM starting").fetchall()
+            conn.close()
+
+            async with Database(path, readers=1) as db:
+                # in the background, as the bot does: how long is the loop held?
+                stalls = [0.0]
+
+                async def probe():
+                    loop = asyncio.get_running_loop()
+                    while True:
+                        before = loop.time()
+                        await asyncio.sleep(0.01)
+                        stalls[0] = max(stalls[0], loop.time() - before - 0.01)
+
+                probing = asyncio.create_task(probe())
+                started = time.perf_counter()
+                assert await update_index(db, limit=BATCH) == BATCH
+                assert await backfill_index(db, pause=0) == BANK - BATCH
+                elapsed = time.perf_counter() - started
+                probing.cancel()
+                print(
+                    f"indexed {BANK} questions in {elapsed:.1f}s, {BATCH} at a time; "
+                    f"event loop held up to {stalls[0] * 1000:.0f} ms"
+                )
+
+                timings: dict[str, list[float]] = {
+                    "sign": [],
+                    "check": [],
+                    "store": [],
+                    "index": [],
+                }
+                found = planted = false_positives = 0
+                for _ in range(IMPORTS):
+                    (pack, count) = make_pack(bank)
+                    planted += count
+
+                    started = time.perf_counter()
+                    questions = await asyncio.to_thread(pack_questions, pack)
+                    timings["sign"].append(time.perf_counter() - started)
+
+                    started = time.perf_counter()
+                    await update_index(db, limit=BATCH)
+                    duplicates = await find_duplicates(db, questions)
+                    timings["check"].append(time.perf_counter() - started)
+                    flagged = {(d.question.kind, d.question.index) for d in duplicates}
+                    found += len(flagged & {(1, i) for i in (*range(11), 44)})
+                    false_positives += len(flagged - {(1, i) for i in (*range(11), 44)})
+
+                    started = time.perf_counter()
+                    async with db.transaction("store_pack") as conn:
+                        await store_pack(conn, "benchmark", pack)
+                    timings["store"].append(time.perf_counter() - started)
+
+                    started = time.perf_counter()
+                    indexed = await update_index(
+                        db, questions, limit=len(questions) + BATCH
+                    )
+                    assert indexed == len(questions)
+                    timings["index"].append(time.perf_counter() - started)
+
+            def linear() -> int:
+                # the whole bank, against one pack
+                conn = sqlite3.connect(path)
+                rows = conn.execute(
+                    "SELECT question, answer FROM starting UNION ALL "
+                    "SELECT question, answer FROM finish"
+                ).fetchall()
+                conn.close()
+                stored = [shingles(question, answer) for (question, answer) in rows]
+                return sum(
+                    any(jaccard(q.shingles, s) >= SIMILARITY for s in stored)
+                    for q in questions
+                )
+
+            started = time.perf_counter()
+            linear()
+            brute = time.perf_counter() - started
+
+        medians = {name: statistics.median(t) * 1000 for (name, t) in timings.items()}
+        overhead = medians["sign"] + medians["check"] + medians["index"]
+        print(
+            "per 66-question pack: "
+            + ", ".join(f"{name} {ms:.1f} ms" for (name, ms) in medians.items())
+        )
+        print(
+            f"duplicate check overhead {overhead:.1f} ms "
+            f"(comparing with the whole bank: {brute * 1000:.0f} ms)"
+        )
+        print(
+            f"recall {found}/{planted} planted duplicates, "
+            f"{false_positives} false positives"
+        )
+        assert found >= 0.95 * planted and false_positives == 0
+
+    asyncio.run(main())
@@ -0,0 +1,305 @@
+"""
+A local stand-in for Discord's gateway and the REST routes a bot needs to log
+in, for running a cluster of workers without touching Discord.
+
+`FakeDiscord` serves both on one port. The bot is pointed at it by replacing
+`discord.http.Route.BASE` and `DiscordWebSocket.DEFAULT_GATEWAY` (see
+`FakeDiscord.install`). Every shard that identifies gets a READY and the
+GUILD_CREATE of the guilds it owns, by Discord's rule `(guild_id >> 22) %
+shard_count`; heartbeats are acknowledged and resumes accepted. Identifies are
+recorded with their time, to check how a cluster spreads and paces them, and
+`send_message` dispatches a MESSAGE_CREATE on the shard owning the channel.
+"""
+import itertools
+import json
+import time
+from typing import Any, Optional
+
+from aiohttp import WSMsgType, web
+
+# gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+BOT_ID = 1_000_000 << 22
+OWNER_ID = 1_000_001 << 22
+
+
+def user(id: int, name: str, bot: bool = False) -> dict[str, Any]:
+    return {
+        "id": str(id),
+        "username": name,
+        "discriminator": "0",
+        "global_name": None,
+        "avatar": None,
+        "bot": bot,
+    }
+
+
+def _json(data: Any, status: int = 200) -> web.Response:
+    # exactly this content type, or discord.py reads the body as text
+    return web.Response(
+        body=json.dumps(data).encode(),
+        status=status,
+        headers={"Content-Type": "application/json"},
+    )
+
+
+class FakeDiscord:
+    def __init__(
+        self,
+        shard_count: int = 1,
+        guilds: int = 4,
+        heartbeat_interval: float = 41.25,
+        max_concurrency: int = 1,
+    ):
+        """
+        Parameters
+        ----------
+        shard_count: Shards recommended by GET /gateway/bot, and expected in identifies
+        guilds: Number of guilds the bot is in, with one text channel each
+        heartbeat_interval: Seconds between heartbeats asked in HELLO
+        max_concurrency: Identifies allowed at once, reported by GET /gateway/bot
+        """
+        self.shard_count = shard_count
+        self.heartbeat_interval = heartbeat_interval
+        self.max_concurrency = max_concurrency
+        # consecutive snowflakes, so that consecutive guilds go to consecutive shards
+        self.guilds = {
+            (2_000_000 + i) << 22: (3_000_000 + i) << 22 for i in range(guilds)
+        }
+        self.identified: list[tuple[int, float]] = []  # shard, time.monotonic()
+        self.requests: list[tuple[str, str]] = []  # method, path of REST calls
+        self.url = ""
+        self._shards: dict[int, tuple[web.WebSocketResponse, itertools.count]] = {}
+        self._ids = itertools.count(4_000_000 << 22, 1 << 22)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def api_base(self) -> str:
+        return f"{self.url}/api/v10"
+
+    @property
+    def gateway_url(self) -> str:
+        return f"{self.url.replace('http', 'ws', 1)}/gateway"
+
+    def shard_of(self, guild_id: int) -> int:
+        return (guild_id >> 22) % self.shard_count
+
+    @property
+    def connected(self) -> set[int]:
+        """The shards currently connected."""
+        return set(self._shards)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_get("/gateway", self._gateway)
+        app.router.add_get("/api/v10/users/@me", self._me)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self._application)
+        app.router.add_get("/api/v10/gateway/bot", self._gateway_bot)
+        app.router.add_post("/api/v10/channels/{channel}/messages", self._post_message)
+        app.router.add_route("*", "/{path:.*}", self._other)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        (host, port) = site._server.sockets[0].getsockname()[:2]  # type: ignore
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        for (ws, _) in list(self._shards.values()):
+            await ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @staticmethod
+    def install(api_base: str, gateway_url: str):
+        """Point discord.py, in this process, at a `FakeDiscord` serving on `api_base`."""
+        import yarl
+        from discord.gateway import DiscordWebSocket
+        from discord.http import Route
+
+        Route.BASE = api_base
+        DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(gateway_url)
+
+    async def send_message(self, channel_id: int, content: str, author_id: int) -> int:
+        """Dispatch a message sent in `channel_id` to the shard owning it, returning its ID."""
+        guild_id = next(g for (g, c) in self.guilds.items() if c == channel_id)
+        message = self._message(
+            channel_id, content, user(author_id, f"user{author_id}")
+        )
+        message["guild_id"] = str(guild_id)
+        await self._dispatch(self.shard_of(guild_id), "MESSAGE_CREATE", message)
+        return int(message["id"])
+
+    async def _dispatch(self, shard: int, event: str, data: Any):
+        (ws, sequence) = self._shards[shard]
+        await ws.send_json({"op": DISPATCH, "t": event, "s": next(sequence), "d": data})
+
+    def _message(self, channel_id: int, content: str, author: dict) -> dict[str, Any]:
+        return {
+            "id": str(next(self._ids)),
+            "channel_id": str(channel_id),
+            "author": author,
+            "content": content,
+            "timestamp": "2024-01-01T00:00:00+00:00",
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+
+    def _guild(self, guild_id: int) -> dict[str, Any]:
+        return {
+            "id": str(guild_id),
+            "name": f"guild {guild_id >> 22}",
+            "icon": None,
+            "owner_id": str(OWNER_ID),
+            "roles": [
+                {
+                    "id": str(guild_id),
+                    "name": "@everyone",
+                    "permissions": "0",
+                    "position": 0,
+                    "color": 0,
+                    "hoist": False,
+                    "managed": False,
+                    "mentionable": False,
+                }
+            ],
+            "channels": [
+                {
+                    "id": str(self.guilds[guild_id]),
+                    "type": 0,
+                    "name": "general",
+                    "position": 0,
+                    "permission_overwrites": [],
+                }
+            ],
+            "members": [],
+            "member_count": 1,
+            "emojis": [],
+            "stickers": [],
+            "features": [],
+            "threads": [],
+            "presences": [],
+            "voice_states": [],
+            "stage_instances": [],
+            "guild_scheduled_events": [],
+            "large": False,
+            "unavailable": False,
+            "premium_tier": 0,
+            "joined_at": "2024-01-01T00:00:00+00:00",
+        }
+
+    async def _gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json(
+            {"op": HELLO, "d": {"heartbeat_interval": self.heartbeat_interval * 1000}}
+        )
+        shard: Optional[int] = None
+        sequence = itertools.count(1)
+        try:
+            async for message in ws:
+                if message.type is not WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+                if payload["op"] == HEARTBEAT:
+                    await ws.send_json({"op": HEARTBEAT_ACK})
+                elif payload["op"] == IDENTIFY:
+                    (shard, count) = payload["d"].get("shard", (0, 1))
+                    if count != self.shard_count or shard in self._shards:
+                        await ws.close(code=4010)  # invalid shard
+                        break
+                    self.identified.append((shard, time.monotonic()))
+                    self._shards[shard] = (ws, sequence)
+                    await self._ready(shard)
+                elif payload["op"] == RESUME:
+                    # a resume is only attempted by a shard that identified before
+                    shard = int(payload["d"]["session_id"].split("-")[1])
+                    self._shards[shard] = (ws, sequence)
+                    await self._dispatch(shard, "RESUMED", {})
+        finally:
+            if shard is not None and self._shards.get(shard, (None,))[0] is ws:
+                del self._shards[shard]
+        return ws
+
+    async def _ready(self, shard: int):
+        owned = [g for g in self.guilds if self.shard_of(g) == shard]
+        await self._dispatch(
+            shard,
+            "READY",
+            {
+                "v": 10,
+                "user": user(BOT_ID, "Mountain", bot=True),
+                "guilds": [{"id": str(g), "unavailable": True} for g in owned],
+                "session_id": f"session-{shard}",
+                "resume_gateway_url": self.gateway_url,
+                "shard": [shard, self.shard_count],
+                "application": {"id": str(BOT_ID), "flags": 0},
+            },
+        )
+        for guild_id in owned:
+            await self._dispatch(shard, "GUILD_CREATE", self._guild(guild_id))
+
+    async def _me(self, request: web.Request) -> web.Response:
+        self.requests.append((request.method, request.path))
+        return _json(user(BOT_ID, "Mountain", bot=True))
+
+    async def _application(self, request: web.Request) -> web.Response:
+        self.requests.append((request.method, request.path))
+        return _json(
+            {
+                "id": str(BOT_ID),
+                "name": "Mountain",
+                "icon": None,
+                "description": "",
+                "bot_public": False,
+                "bot_require_code_grant": False,
+                "owner": user(OWNER_ID, "owner"),
+                "verify_key": "0" * 64,
+                "flags": 0,
+            }
+        )
+
+    async def _gateway_bot(self, request: web.Request) -> web.Response:
+        self.requests.append((request.method, request.path))
+        return _json(
+            {
+                "url": self.gateway_url,
+                "shards": self.shard_count,
+                "session_start_limit": {
+                    "total": 1000,
+                    "remaining": 1000,
+                    "reset_after": 0,
+                    "max_concurrency": self.max_concurrency,
+                },
+            }
+        )
+
+    async def _post_message(self, request: web.Request) -> web.Response:
+        self.requests.append((request.method, request.path))
+        body = await request.json()
+        channel_id = int(request.match_info["channel"])
+        message = self._message(
+            channel_id, body.get("content") or "", user(BOT_ID, "Mountain", bot=True)
+        )
+        message["embeds"] = body.get("embeds") or []
+        return _json(message)
+
+    async def _other(self, request: web.Request) -> web.Response:
+        # e.g. syncing application commands: accepted, as if nothing changed
+        self.requests.append((request.method, request.path))
+        if "/commands" in request.path:
+            return _json([])
+        return _json({"message": "Unknown", "code": 0}, status=404)
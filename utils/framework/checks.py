@@ -13,3 +13,18 @@ def always_whisper(func: CommandCallback):
         await func(self, ctx, *args, **kwargs)
 
     return decorator
+
+
+def owner_only(func: CommandCallback):
+    """Only let the bot owner run the command"""
+
+    @functools.wraps(func)
+    async def decorator(self, ctx: Context, *args, **kwargs):
+        if ctx.author.id != ctx.bot.cfg.owner_id:
+            await ctx.send_warning(
+                "Chỉ chủ bot mới dùng được lệnh này.", ephemeral=True
+            )
+            return
+        await func(self, ctx, *args, **kwargs)
+
+    return decorator
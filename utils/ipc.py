@@ -0,0 +1,299 @@
+"""
+Local IPC between the worker processes of a cluster (see launcher.py).
+
+The launcher runs a `Hub` on a Unix socket and every worker connects a `Peer`
+to it. Messages are JSON objects, one per line. A worker `broadcast`s an
+operation, such as dropping the cached deck of a pack that was just imported:
+the hub forwards it to every other worker, and each one runs its handler for
+it. `gather` does the same and collects what the handlers return, e.g. the
+status of every shard for an owner command.
+
+The hub also paces identifies: Discord allows `max_concurrency` of them every
+`IDENTIFY_INTERVAL` seconds for the whole bot, and the workers identify their
+shards at the same time, so each shard asks the hub for its turn instead of
+only waiting on the other shards of its own process.
+
+A `Peer` without a socket path runs its handlers locally and nothing else, so
+a bot running alone uses the same calls.
+"""
+import asyncio
+import inspect
+import itertools
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional, Union
+
+IDENTIFY_INTERVAL = 5.0  # seconds between identifies of the same bucket
+TIMEOUT = 5.0  # seconds to wait for the replies of `gather`
+
+Handler = Callable[[Any], Union[Any, Awaitable[Any]]]
+
+log = logging.getLogger(__name__)
+
+
+class IPCError(Exception):
+    pass
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict[str, Any]):
+    writer.write(json.dumps(message, ensure_ascii=False).encode() + b"\n")
+    await writer.drain()
+
+
+class Hub:
+    def __init__(
+        self,
+        path: str,
+        max_concurrency: int = 1,
+        identify_interval: float = IDENTIFY_INTERVAL,
+    ):
+        """
+        Relays messages between the workers connected to the Unix socket `path`.
+
+        Optional parameters
+        -------------------
+        max_concurrency: Identify buckets, from GET /gateway/bot (default 1)
+        identify_interval: Seconds between identifies of a bucket (default 5)
+        """
+        self.path = path
+        self.max_concurrency = max_concurrency
+        self.identify_interval = identify_interval
+        self.identified: list[tuple[int, float]] = []  # shard, time.monotonic()
+        self._peers: dict[int, asyncio.StreamWriter] = {}
+        self._buckets = [asyncio.Lock() for _ in range(max_concurrency)]
+        self._last_identify = [float("-inf")] * max_concurrency
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def workers(self) -> set[int]:
+        """The workers connected."""
+        return set(self._peers)
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._peers.values()):
+            writer.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker: Optional[int] = None
+        try:
+            hello = json.loads(await reader.readline())
+            worker = int(hello["worker"])
+            previous = self._peers.get(worker)
+            if previous is not None:
+                # a restarted worker, whose old connection isn't closed yet
+                previous.close()
+            self._peers[worker] = writer
+            while line := await reader.readline():
+                message = json.loads(line)
+                message["from"] = worker
+                await self._route(worker, message)
+        except (ConnectionError, json.JSONDecodeError, KeyError, ValueError):
+            pass
+        finally:
+            if worker is not None and self._peers.get(worker) is writer:
+                del self._peers[worker]
+            writer.close()
+
+    async def _route(self, worker: int, message: dict[str, Any]):
+        op = message["op"]
+        if op == "_reply":
+            writer = self._peers.get(message["to"])
+            if writer is not None:
+                await _send(writer, message)
+        elif op == "_identify":
+            # waiting for the bucket must not hold up the worker's other messages
+            task = asyncio.create_task(self._identify(worker, message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            others = [w for (id, w) in self._peers.items() if id != worker]
+            if message.get("nonce") is not None:
+                reply = {
+                    "op": "_expect",
+                    "nonce": message["nonce"],
+                    "data": len(others),
+                }
+                await _send(self._peers[worker], reply)
+            for writer in others:
+                try:
+                    await _send(writer, message)
+                except ConnectionError:
+                    pass
+
+    async def _identify(self, worker: int, message: dict[str, Any]):
+        shard = int(message["data"])
+        bucket = shard % self.max_concurrency
+        async with self._buckets[bucket]:
+            wait = self._last_identify[bucket] + self.identify_interval
+            await asyncio.sleep(wait - time.monotonic())
+            self._last_identify[bucket] = time.monotonic()
+            self.identified.append((shard, self._last_identify[bucket]))
+            writer = self._peers.get(worker)
+            if writer is not None:
+                reply = {"op": "_reply", "nonce": message["nonce"], "data": None}
+                await _send(writer, {**reply, "from": None})
+
+
+class Peer:
+    def __init__(self, worker: int, path: Optional[str] = None):
+        """
+        A worker's connection to the `Hub` listening on `path`.
+
+        Parameters
+        ----------
+        worker: ID of this worker, unique in the cluster
+
+        Optional parameters
+        -------------------
+        path: Socket of the hub, or None to only run handlers locally
+        """
+        self.worker = worker
+        self.path = path
+        self._handlers: dict[str, Handler] = {}
+        self._nonces = itertools.count()
+        self._waiting: dict[int, tuple[asyncio.Future, dict[int, Any], list[int]]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    def handle(self, op: str, handler: Handler):
+        """Run `handler` with the data of every `op` broadcast, by this worker or another."""
+        self._handlers[op] = handler
+
+    async def connect(self):
+        if self.path is None:
+            return
+        (reader, self._writer) = await asyncio.open_unix_connection(self.path)
+        await _send(self._writer, {"worker": self.worker})
+        self._reader_task = asyncio.create_task(self._read(reader))
+
+    async def close(self):
+        (writer, self._writer) = (self._writer, None)
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if writer is not None:
+            writer.close()
+
+    async def broadcast(self, op: str, data: Any = None):
+        """Run the handlers of `op` in every worker, this one first."""
+        await self._run(op, data)
+        if self._writer is not None:
+            await _send(self._writer, {"op": op, "data": data})
+
+    async def gather(
+        self, op: str, data: Any = None, timeout: float = TIMEOUT
+    ) -> dict[int, Any]:
+        """
+        Run the handlers of `op` in every worker, and return their results by
+        worker ID. Workers that don't answer within `timeout` seconds are left out.
+        """
+        results = {self.worker: await self._run(op, data)}
+        if self._writer is None:
+            return results
+        (nonce, future, replies, expected) = self._wait()
+        try:
+            await _send(self._writer, {"op": op, "data": data, "nonce": nonce})
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            log.warning("%s: no reply from %d workers", op, expected[0] - len(replies))
+        finally:
+            del self._waiting[nonce]
+        for (worker, reply) in replies.items():
+            if isinstance(reply, dict) and "_error" in reply:
+                raise IPCError(f"{op} failed in worker {worker}: {reply['_error']}")
+            results[worker] = reply
+        return results
+
+    async def identify(self, shard_id: int):
+        """Wait for the hub to let `shard_id` identify."""
+        if self._writer is None:
+            raise IPCError("not connected to a hub")
+        (nonce, future, _, _) = self._wait()
+        try:
+            await _send(
+                self._writer, {"op": "_identify", "data": shard_id, "nonce": nonce}
+            )
+            await future
+        finally:
+            del self._waiting[nonce]
+
+    def _wait(self) -> tuple[int, asyncio.Future, dict[int, Any], list[int]]:
+        nonce = next(self._nonces)
+        future = asyncio.get_running_loop().create_future()
+        replies: dict[int, Any] = {}
+        expected = [-1]  # set by the hub's "_expect"
+        self._waiting[nonce] = (future, replies, expected)
+        return (nonce, future, replies, expected)
+
+    async def _run(self, op: str, data: Any) -> Any:
+        handler = self._handlers.get(op)
+        if handler is None:
+            return None
+        result = handler(data)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                op = message["op"]
+                if op in ("_reply", "_expect"):
+                    self._on_reply(message)
+                else:
+                    task = asyncio.create_task(self._answer(message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            # else closed on purpose
+            if self._writer is not None:
+                log.warning("connection to the hub lost")
+            self._writer = None
+            # nothing will come for the requests in flight
+            for (future, _, _) in self._waiting.values():
+                if not future.done():
+                    future.set_exception(IPCError("connection to the hub lost"))
+
+    def _on_reply(self, message: dict[str, Any]):
+        entry = self._waiting.get(message["nonce"])
+        if entry is None:
+            return  # timed out
+        (future, replies, expected) = entry
+        if message["op"] == "_expect":
+            expected[0] = message["data"]
+        elif message["from"] is None:
+            future.set_result(message["data"])  # from the hub itself
+            return
+        else:
+            replies[message["from"]] = message["data"]
+        if len(replies) == expected[0] and not future.done():
+            future.set_result(replies)
+
+    async def _answer(self, message: dict[str, Any]):
+        try:
+            result = await self._run(message["op"], message.get("data"))
+        except Exception as e:
+            log.exception("handling %s from worker %s", message["op"], message["from"])
+            result = {"_error": f"{type(e).__name__}: {e}"}
+        if message.get("nonce") is not None and self._writer is not None:
+            reply = {"op": "_reply", "to": message["from"], "nonce": message["nonce"]}
+            try:
+                await _send(self._writer, {**reply, "data": result})
+            except ConnectionError:
+                pass
@@ -0,0 +1,311 @@
+"""
+Persistent results of Khởi động games and the leaderboard built on them.
+
+`record_game` inserts a game's scores into `results` (migration 0007) and
+updates `player_stats` and `guild_stats` in the same transaction, with upserts
+that only touch the rows of the game's players and guild. The rolling averages
+are exponentially weighted (`ALPHA`), so updating them needs nothing but the
+previous average; a window of the last N games would need the score leaving it.
+
+`top_players` reads the first players of a guild from the index of the chosen
+column, in the index's order: it costs the rows returned, however long the
+history of results.
+"""
+from dataclasses import dataclass
+from typing import Literal, Optional
+
+import aiosqlite
+
+TOP = 10
+ALPHA = 0.2  # weight of the latest game in the rolling averages, about 10 games' worth
+
+Order = Literal["total", "average", "best"]
+
+RECORD_RESULT = (
+    "INSERT INTO results(game, guild, player, ruleset, score, finished) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+# parameters: guild, player, name, score, finished
+UPDATE_PLAYER = f"""
+INSERT INTO player_stats(guild, player, name, games, total, best, average, last_played)
+VALUES (?1, ?2, ?3, 1, ?4, ?4, ?4, ?5)
+ON CONFLICT (guild, player) DO UPDATE SET
+    name = excluded.name,
+    games = games + 1,
+    total = total + excluded.total,
+    best = max(best, excluded.best),
+    average = average + {ALPHA} * (excluded.average - average),
+    last_played = excluded.last_played
+"""
+# parameters: guild, the game's total, best and mean score, finished
+UPDATE_GUILD = f"""
+INSERT INTO guild_stats(guild, games, total, best, average, last_played)
+VALUES (?1, 1, ?2, ?3, ?4, ?5)
+ON CONFLICT (guild) DO UPDATE SET
+    games = games + 1,
+    total = total + excluded.total,
+    best = max(best, excluded.best),
+    average = average + {ALPHA} * (excluded.average - average),
+    last_played = excluded.last_played
+"""
+
+
+@dataclass
+class GameResult:
+    game: int  # game_sessions id
+    ruleset: str
+    players: dict[int, str]
+    scores: dict[int, int]
+    finished: float  # UNIX time
+
+
+@dataclass
+class PlayerStats:
+    player: int
+    name: str
+    games: int
+    total: int
+    best: int
+    average: float
+
+
+@dataclass
+class GuildStats:
+    games: int
+    total: int
+    best: int
+    average: float
+
+
+async def record_game(conn: aiosqlite.Connection, guild: int, result: GameResult):
+    """
+    Store the scores of a game and update the aggregates.
+
+    Should be called inside a transaction (see `Database.transaction`).
+    """
+    if not result.scores:
+        return
+    scores = result.scores
+    await conn.executemany(
+        RECORD_RESULT,
+        [
+            (result.game, guild, player, result.ruleset, score, result.finished)
+            for (player, score) in scores.items()
+        ],
+    )
+    await conn.executemany(
+        UPDATE_PLAYER,
+        [
+            (
+                guild,
+                player,
+                result.players.get(player, str(player)),
+                score,
+                result.finished,
+            )
+            for (player, score) in scores.items()
+        ],
+    )
+    await conn.execute(
+        UPDATE_GUILD,
+        (
+            guild,
+            sum(scores.values()),
+            max(scores.values()),
+            sum(scores.values()) / len(scores),
+            result.finished,
+        ),
+    )
+
+
+async def top_players(
+    conn: aiosqlite.Connection, guild: int, order: Order = "total", limit: int = TOP
+) -> list[PlayerStats]:
+    """The `limit` best players of `guild` by `order`, best first."""
+    if order not in ("total", "average", "best"):
+        raise ValueError(f"unknown order {order!r}")
+    async with conn.execute(
+        "SELECT player, name, games, total, best, average FROM player_stats "
+        f"WHERE guild = ? ORDER BY {order} DESC, player LIMIT ?",
+        (guild, limit),
+    ) as cursor:
+        return [PlayerStats(*row) for row in await cursor.fetchall()]
+
+
+async def guild_stats(conn: aiosqlite.Connection, guild: int) -> Optional[GuildStats]:
+    async with conn.execute(
+        "SELECT games, total, best, average FROM guild_stats WHERE guild = ?", (guild,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return None if row is None else GuildStats(*row)
+
+
+if __name__ == "__main__":
+    # Benchmark: records games into a history of millions of results, reads
+    # the leaderboard from the aggregates against grouping the results, and
+    # checks the aggregates against a recomputation from the results.
+    import asyncio
+    import random
+    import sqlite3
+    import statistics
+    import tempfile
+    import time
+    from pathlib import Path
+
+    from utils.database import Database
+    from utils.migrations import migrate_sync
+
+    GUILDS = 20
+    PLAYERS = 5_000  # per guild
+
+    def games(rng: random.Random, count: int, start: int = 0):
+        for game in range(start, start + count):
+            guild = rng.randrange(GUILDS)
+            players = rng.sample(range(PLAYERS), rng.randint(1, 4))
+            yield (
+                guild,
+                GameResult(
+                    game,
+                    rng.choice(("o21", "o22", "o23")),
+                    {p: f"Người chơi {p}" for p in players},
+                    {p: rng.randrange(0, 200, 10) for p in players},
+                    time.time(),
+                ),
+            )
+
+    def build(path: Path, count: int):
+        """`record_game`, with plain sqlite3 in batches, for `count` games."""
+        conn = sqlite3.connect(path)
+        migrate_sync(conn)
+        rng = random.Random(count)
+        batch = []
+        for (i, (guild, result)) in enumerate(games(rng, count), 1):
+            batch.append((guild, result))
+            if i % 10_000 and i != count:
+                continue
+            conn.executemany(
+                RECORD_RESULT,
+                [
+                    (r.game, g, p, r.ruleset, s, r.finished)
+                    for (g, r) in batch
+                    for (p, s) in r.scores.items()
+                ],
+            )
+            conn.executemany(
+                UPDATE_PLAYER,
+                [
+                    (g, p, r.players[p], s, r.finished)
+                    for (g, r) in batch
+                    for (p, s) in r.scores.items()
+                ],
+            )
+            conn.executemany(
+                UPDATE_GUILD,
+                [
+                    (
+                        g,
+                        sum(r.scores.values()),
+                        max(r.scores.values()),
+                        sum(r.scores.values()) / len(r.scores),
+                        r.finished,
+                    )
+                    for (g, r) in batch
+                ],
+            )
+            conn.commit()
+            batch.clear()
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.close()
+
+    def check(path: Path):
+        conn = sqlite3.connect(path)
+        for order in ("total", "average", "best"):
+            (plan,) = [
+                row[-1]
+                for row in conn.execute(
+                    "EXPLAIN QUERY PLAN SELECT player FROM player_stats "
+                    f"WHERE guild = 3 ORDER BY {order} DESC, player LIMIT 10"
+                )
+            ]
+            assert f"player_stats_{order}" in plan and "TEMP" not in plan, plan
+        mismatched = conn.execute(
+            """
+            SELECT COUNT(*) FROM player_stats AS s JOIN (
+                SELECT guild, player, COUNT(*) AS games, SUM(score) AS total,
+                    MAX(score) AS best
+                FROM results GROUP BY guild, player
+            ) AS r USING (guild, player)
+            WHERE s.games != r.games OR s.total != r.total OR s.best != r.best
+            """
+        ).fetchone()[0]
+        assert mismatched == 0, mismatched
+        for (guild, player, average) in conn.execute(
+            "SELECT guild, player, average FROM player_stats ORDER BY random() LIMIT 20"
+        ).fetchall():
+            scores = conn.execute(
+                "SELECT score FROM results WHERE guild = ? AND player = ? ORDER BY id",
+                (guild, player),
+            ).fetchall()
+            expected = float(scores[0][0])
+            for (score,) in scores[1:]:
+                expected += ALPHA * (score - expected)
+            assert abs(expected - average) < 1e-6, (expected, average)
+        conn.close()
+
+    def grouped(conn: sqlite3.Connection, guild: int) -> list[tuple[int, int]]:
+        """The leaderboard without aggregates."""
+        return conn.execute(
+            "SELECT player, SUM(score) AS total FROM results WHERE guild = ? "
+            "GROUP BY player ORDER BY total DESC, player LIMIT ?",
+            (guild, TOP),
+        ).fetchall()
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            for count in (100_000, 1_000_000):
+                path = Path(tmp) / f"{count}.sqlite3"
+                started = time.perf_counter()
+                build(path, count)
+                built = time.perf_counter() - started
+                check(path)
+
+                async with Database(path, readers=1) as db:
+                    rng = random.Random(0)
+                    recording = []
+                    for (guild, result) in games(rng, 200, start=count):
+                        started = time.perf_counter()
+                        async with db.transaction("record_game") as conn:
+                            await record_game(conn, guild, result)
+                        recording.append((time.perf_counter() - started) * 1000)
+                    reading = []
+                    for i in range(200):
+                        started = time.perf_counter()
+                        async with db.read("leaderboard") as conn:
+                            top = await top_players(
+                                conn, i % GUILDS, ("total", "average", "best")[i % 3]
+                            )
+                            await guild_stats(conn, i % GUILDS)
+                        reading.append((time.perf_counter() - started) * 1000)
+                        assert len(top) == TOP
+                    async with db.read() as conn:
+                        top = await top_players(conn, 7)
+                check(path)
+
+                conn = sqlite3.connect(path)
+                (rows,) = conn.execute("SELECT COUNT(*) FROM results").fetchone()
+                scans = []
+                for guild in range(3):
+                    started = time.perf_counter()
+                    grouped(conn, guild + 7)
+                    scans.append((time.perf_counter() - started) * 1000)
+                assert grouped(conn, 7) == [(p.player, p.total) for p in top]
+                conn.close()
+                print(
+                    f"{rows:>9} results (built in {built:.0f}s): record_game "
+                    f"p50 {statistics.median(recording):.2f} ms; top {TOP} from "
+                    f"aggregates p50 {statistics.median(reading):.2f} ms, "
+                    f"grouping results {statistics.median(scans):.0f} ms"
+                )
+
+    asyncio.run(main())
@@ -0,0 +1,251 @@
+"""
+Versioned schema migrations.
+
+Migrations are the SQL scripts in database/migrations, named
+`NNNN_description.sql` and numbered from 1 without gaps. The number of the last
+one applied is the database's `PRAGMA user_version`, so a boot only runs the
+scripts it has not seen. Each migration runs in its own transaction, together
+with the bump of `user_version`: a failing migration leaves the database as it
+was before it. After applying migrations, `ANALYZE` and `PRAGMA optimize`
+refresh the query planner's statistics for the new tables and indexes (except
+those of FTS5's shadow tables, see `ANALYZABLE`).
+
+Migrations are never edited once released; changes go in a new migration.
+"""
+import re
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from utils.database import Database
+
+MIGRATIONS_DIR = Path(__file__).parents[1] / "database" / "migrations"
+FILENAME = re.compile(r"(\d{4})_(\w+)\.sql")
+# tables to ANALYZE: not the shadow tables of virtual tables (FTS5), whose
+# statistics, taken while they are still small, make FTS5's own lookups scan
+ANALYZABLE = r"""
+SELECT name FROM sqlite_master AS t
+WHERE type = 'table' AND name NOT LIKE 'sqlite\_%' ESCAPE '\'
+    AND sql NOT LIKE 'CREATE VIRTUAL TABLE%'
+    AND NOT EXISTS (
+        SELECT 1 FROM sqlite_master AS v
+        WHERE v.type = 'table' AND v.sql LIKE 'CREATE VIRTUAL TABLE%'
+            AND t.name LIKE v.name || '\_%' ESCAPE '\'
+    )
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    sql: str
+
+    def __str__(self) -> str:
+        return f"{self.version:04d}_{self.name}"
+
+    def script(self) -> str:
+        """The migration and the bump of `user_version` as one transaction."""
+        return (
+            f"BEGIN IMMEDIATE;\n{self.sql}\n;\n"
+            f"PRAGMA user_version = {self.version};\nCOMMIT;"
+        )
+
+
+def analyze_script(tables: list[str]) -> str:
+    """Refresh the query planner's statistics of `tables`."""
+    analyze = "".join(f'ANALYZE "{table}";\n' for table in tables)
+    return f"{analyze}PRAGMA optimize;"
+
+
+def discover(directory: Path = MIGRATIONS_DIR) -> list[Migration]:
+    """The migrations in `directory`, in order."""
+    migrations = []
+    for path in sorted(directory.glob("*.sql")):
+        match = FILENAME.fullmatch(path.name)
+        if match is None:
+            raise MigrationError(f"{path.name}: not named NNNN_description.sql")
+        migrations.append(
+            Migration(int(match[1]), match[2], path.read_text(encoding="utf-8"))
+        )
+    for (expected, migration) in enumerate(migrations, 1):
+        if migration.version != expected:
+            raise MigrationError(f"{migration}: expected migration number {expected}")
+    return migrations
+
+
+def pending(version: int, migrations: list[Migration]) -> list[Migration]:
+    """The migrations a database at `user_version` `version` still needs."""
+    if version > len(migrations):
+        raise MigrationError(
+            f"database is at version {version}, newer than the last migration "
+            f"({len(migrations)})"
+        )
+    return migrations[version:]
+
+
+async def migrate(
+    db: Database, migrations: Optional[list[Migration]] = None
+) -> list[Migration]:
+    """
+    Apply the pending migrations to `db`.
+
+    Optional parameters
+    -------------------
+    migrations: Migrations to apply (default: those in database/migrations)
+
+    Returns
+    -------
+    The migrations applied, oldest first.
+    """
+    if migrations is None:
+        migrations = discover()
+    async with db.writer.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()  # type: ignore
+    todo = pending(version, migrations)
+    for migration in todo:
+        try:
+            await db.executescript(migration.script())
+        except sqlite3.Error as e:
+            if db.writer.in_transaction:
+                await db.writer.rollback()
+            raise MigrationError(f"{migration}: {e}") from e
+    if todo:
+        async with db.writer.execute(ANALYZABLE) as cursor:
+            tables = [name for (name,) in await cursor.fetchall()]
+        await db.executescript(analyze_script(tables))
+    return todo
+
+
+def migrate_sync(
+    conn: sqlite3.Connection, migrations: Optional[list[Migration]] = None
+) -> list[Migration]:
+    """`migrate`, for a plain sqlite3 connection (scripts and benchmarks)."""
+    if migrations is None:
+        migrations = discover()
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    todo = pending(version, migrations)
+    for migration in todo:
+        try:
+            conn.executescript(migration.script())
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            raise MigrationError(f"{migration}: {e}") from e
+    if todo:
+        tables = [name for (name,) in conn.execute(ANALYZABLE)]
+        conn.executescript(analyze_script(tables))
+    return todo
+
+
+if __name__ == "__main__":
+    # Migrates a copy of the checked-in database, then checks that a failing
+    # migration leaves no trace, and compares a boot with nothing to migrate
+    # against running the whole schema again.
+    import asyncio
+    import shutil
+    import tempfile
+    import time
+
+    SOURCE = Path(__file__).parents[1] / "database" / "database.sqlite3"
+    TABLES = (
+        "packs",
+        "starting",
+        "obstacle",
+        "obstacle_questions",
+        "acceleration",
+        "acceleration_images",
+        "finish",
+        "chp",
+    )
+
+    def counts(path: Path) -> dict[str, int]:
+        conn = sqlite3.connect(path)
+        result = {
+            t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in TABLES
+        }
+        conn.close()
+        return result
+
+    async def main():
+        migrations = discover()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "database.sqlite3"
+            shutil.copy(SOURCE, path)
+            before = counts(path)
+
+            async with Database(path) as db:
+                started = time.perf_counter()
+                applied = await migrate(db)
+                elapsed = time.perf_counter() - started
+                print(
+                    f"applied {', '.join(map(str, applied))} in {elapsed * 1000:.1f} ms"
+                )
+                assert len(applied) == len(migrations)
+                async with db.read() as conn:
+                    async with conn.execute("PRAGMA user_version") as cursor:
+                        assert (await cursor.fetchone())[0] == len(migrations)
+                    async with conn.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'index'"
+                    ) as cursor:
+                        indexes = {name for (name,) in await cursor.fetchall()}
+                    assert "starting_pack_round" in indexes, indexes
+                    async with conn.execute(
+                        "SELECT COUNT(*) FROM sqlite_stat1"
+                    ) as cursor:
+                        assert (await cursor.fetchone())[0] > 0  # ANALYZE ran
+                assert await migrate(db) == []
+            assert counts(path) == before
+
+            # a migration failing halfway is rolled back entirely
+            broken = [
+                *migrations,
+                Migration(
+                    len(migrations) + 1,
+                    "broken",
+                    "CREATE TABLE half(x); INSERT INTO nowhere VALUES (1);",
+                ),
+            ]
+            async with Database(path) as db:
+                try:
+                    await migrate(db, broken)
+                except MigrationError as e:
+                    print(f"failed as expected: {e}")
+                else:
+                    raise AssertionError("the broken migration was applied")
+                async with db.read() as conn:
+                    async with conn.execute("PRAGMA user_version") as cursor:
+                        assert (await cursor.fetchone())[0] == len(migrations)
+                    async with conn.execute(
+                        "SELECT COUNT(*) FROM sqlite_master WHERE name = 'half'"
+                    ) as cursor:
+                        assert (await cursor.fetchone())[0] == 0
+                try:
+                    await migrate(db, migrations[:-1])
+                except MigrationError as e:
+                    print(f"refused to downgrade: {e}")
+                else:
+                    raise AssertionError("migrated a newer database")
+
+            # boot cost: nothing pending vs schema.sql (migrations 1-3) on every start
+            schema = "\n".join(m.sql for m in migrations[:3])
+            async with Database(path) as db:
+                started = time.perf_counter()
+                for _ in range(100):
+                    await db.executescript(schema)
+                rerun = (time.perf_counter() - started) / 100
+                started = time.perf_counter()
+                for _ in range(100):
+                    await migrate(db, migrations)
+                noop = (time.perf_counter() - started) / 100
+            print(
+                f"boot: schema script {rerun * 1000:.2f} ms, "
+                f"migrations up to date {noop * 1000:.2f} ms"
+            )
+
+    asyncio.run(main())
@@ -0,0 +1,273 @@
+"""
+Scheduling of outgoing messages per channel.
+
+Discord lets a bot send about 5 messages per 5 seconds to a channel. Rather
+than letting every `send` race for that budget in arrival order (and sit in
+discord.py's rate-limit sleep), each channel gets an outbox: messages are queued
+by priority, questions first, and sent by a single worker that never sends more
+than the channel's limit within any window of its length. The time from queueing each
+message to its delivery is recorded, so a saturated channel shows up as a
+growing delay.
+"""
+import asyncio
+import bisect
+import collections
+import heapq
+import itertools
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Optional
+
+from discord import Message
+
+from utils import metrics, tracing
+
+RATE = 5  # messages...
+PER = 5.0  # ...per this many seconds, per channel
+# delivery delay histogram buckets, upper bounds in seconds
+DELAY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Priority(IntEnum):
+    QUESTION = 0
+    SCORE = 1
+    COSMETIC = 2
+
+
+class DelayHistogram:
+    """Counts of delays between queueing and delivering messages, bucketed by `DELAY_BUCKETS`."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(DELAY_BUCKETS) + 1)  # last bucket: above 10s
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, delay: float):
+        self.counts[bisect.bisect_left(DELAY_BUCKETS, delay)] += 1
+        self.count += 1
+        self.total += delay
+        self.max = max(self.max, delay)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile (inf if above all buckets)."""
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip((*DELAY_BUCKETS, float("inf")), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+    def __str__(self) -> str:
+        if not self.count:
+            return "no messages"
+        return (
+            f"{self.count} messages, mean {self.total / self.count * 1000:.0f} ms, "
+            f"p50 <= {self.quantile(0.5) * 1000:.0f} ms, "
+            f"p99 <= {self.quantile(0.99) * 1000:.0f} ms, max {self.max * 1000:.0f} ms"
+        )
+
+
+# series per priority, looked up once
+_SEND_SECONDS = {
+    p: metrics.MESSAGE_SEND_SECONDS.labels(p.name.lower()) for p in Priority
+}
+_DELIVERY_SECONDS = {
+    p: metrics.MESSAGE_DELIVERY_SECONDS.labels(p.name.lower()) for p in Priority
+}
+
+
+class Outbox:
+    def __init__(
+        self,
+        send: Callable[..., Awaitable[Message]],
+        rate: int = RATE,
+        per: float = PER,
+        histogram: Optional[DelayHistogram] = None,
+    ):
+        """
+        Sends messages through `send` in priority order, at most `rate` per `per` seconds.
+
+        Optional parameters
+        -------------------
+        rate, per: Rate limit of the channel (default 5 per 5 seconds)
+        histogram: Histogram shared with other outboxes, also fed with the delivery delays
+        """
+        self._send = send
+        self.rate = rate
+        self.per = per
+        self.histogram = DelayHistogram()
+        self._shared = histogram
+        self._sent: collections.deque[float] = collections.deque()  # send times
+        # (priority, seq, enqueued, future, span, kwargs)
+        self._queue: list[
+            tuple[int, int, float, asyncio.Future, Optional[tracing.Span], dict]
+        ] = []
+        self._seq = itertools.count()
+        self._worker: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    async def send(
+        self, priority: Priority = Priority.COSMETIC, **kwargs: Any
+    ) -> Message:
+        """Queue a message, taking the same keyword arguments as `send`, and wait until it is sent."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(
+            self._queue,
+            (priority, next(self._seq), loop.time(), future, tracing.current(), kwargs),
+        )
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    def idle(self, now: float) -> bool:
+        """Whether nothing is queued and the rate limit budget is full again."""
+        return not self._queue and (not self._sent or now - self._sent[-1] >= self.per)
+
+    def close(self):
+        """Stop sending, failing the queued messages."""
+        if self._worker is not None:
+            self._worker.cancel()
+        for (_, _, _, future, _, _) in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    async def _acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._sent and now - self._sent[0] >= self.per:
+                self._sent.popleft()
+            if len(self._sent) < self.rate:
+                self._sent.append(now)
+                return
+            await asyncio.sleep(self._sent[0] + self.per - now)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            await self._acquire()
+            # pick the message only once a slot is free, so a question queued
+            # while waiting still goes before older, less important messages
+            (priority, _, enqueued, future, span, kwargs) = heapq.heappop(self._queue)
+            if future.done():  # the sender gave up waiting
+                self._sent.pop()
+                continue
+            started = loop.time()
+            # the send belongs to the trace of whoever queued the message
+            with tracing.resume(span), tracing.span(
+                "outbox.send", priority=priority.name.lower()
+            ):
+                try:
+                    future.set_result(await self._send(**kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            delivered = loop.time()
+            _SEND_SECONDS[priority].observe(delivered - started)
+            _DELIVERY_SECONDS[priority].observe(delivered - enqueued)
+            delay = delivered - enqueued
+            self.histogram.observe(delay)
+            if self._shared is not None:
+                self._shared.observe(delay)
+
+
+class OutboundScheduler:
+    def __init__(self, rate: int = RATE, per: float = PER):
+        """One `Outbox` per channel, with a histogram of delivery delays across all of them."""
+        self.rate = rate
+        self.per = per
+        self.histogram = DelayHistogram()
+        self._outboxes: dict[int, Outbox] = {}
+
+    def outbox(self, channel: Any) -> Outbox:
+        """The outbox of `channel`, any object with an `id` and a `send` method."""
+        outbox = self._outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self._outboxes[channel.id] = Outbox(
+                channel.send, self.rate, self.per, self.histogram
+            )
+        return outbox
+
+    def sender(self, channel: Any) -> Callable[..., Awaitable[Message]]:
+        """A `send` function for `channel` that goes through its outbox."""
+        return self.outbox(channel).send
+
+    def prune(self):
+        """Forget the outboxes of channels that are idle and have their whole budget back."""
+        now = asyncio.get_running_loop().time()
+        for (channel_id, outbox) in list(self._outboxes.items()):
+            if outbox.idle(now):
+                del self._outboxes[channel_id]
+
+
+if __name__ == "__main__":
+    # Benchmark: a channel getting bursts of cosmetic updates while a game sends
+    # a question every 0.3s, on a clock sped up 10x (5 messages per 0.5s).
+    # Compares question delivery with priorities against plain arrival order.
+    import random
+
+    PER_FAST = PER / 10
+
+    class FakeChannel:
+        id = 1
+
+        def __init__(self):
+            self.sent: collections.deque[float] = collections.deque()
+            self.violations = 0
+
+        async def send(self, **kwargs: Any) -> Any:
+            now = asyncio.get_running_loop().time()
+            while self.sent and now - self.sent[0] >= PER_FAST:
+                self.sent.popleft()
+            if len(self.sent) >= RATE:
+                self.violations += 1  # Discord would answer 429
+            self.sent.append(now)
+            await asyncio.sleep(random.uniform(0.01, 0.03))  # HTTP round trip
+            return kwargs
+
+    async def scenario(prioritised: bool) -> tuple[DelayHistogram, FakeChannel]:
+        channel = FakeChannel()
+        scheduler = OutboundScheduler(RATE, PER_FAST)
+        send = scheduler.sender(channel)
+        questions = DelayHistogram()
+        stop = asyncio.Event()
+
+        def priority(p: Priority) -> Priority:
+            return p if prioritised else Priority.COSMETIC
+
+        async def game():
+            for number in range(15):
+                started = asyncio.get_running_loop().time()
+                await send(priority(Priority.QUESTION), content=f"Câu hỏi {number}")
+                questions.observe(asyncio.get_running_loop().time() - started)
+                await send(priority(Priority.SCORE), content="Đúng!")
+                await asyncio.sleep(0.3)
+            stop.set()
+
+        async def cosmetic():
+            while not stop.is_set():
+                # e.g. a status update per player
+                for _ in range(10):
+                    asyncio.create_task(send(Priority.COSMETIC, content="Đồng hồ"))
+                await asyncio.sleep(1.5)
+
+        await asyncio.gather(game(), cosmetic())
+        scheduler.outbox(channel).close()
+        return (questions, channel)
+
+    async def main():
+        random.seed(1)
+        for prioritised in (False, True):
+            (questions, channel) = await scenario(prioritised)
+            print(
+                f"{'priorities' if prioritised else 'arrival order':>13}: "
+                f"questions {questions}; rate limit violations: {channel.violations}"
+            )
+            assert channel.violations == 0
+
+    asyncio.run(main())
@@ -0,0 +1,421 @@
+"""
+Reading question packs from the "Form nhập đề thi.xlsx" template and storing them.
+
+`parse_workbook` is plain CPU-bound work with no I/O or event loop, producing
+row tuples ready for insertion, so it can run in a worker thread or process.
+`store_pack` then writes a parsed pack with one `executemany` per table.
+"""
+import io
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+import aiosqlite
+
+if TYPE_CHECKING:
+    # imported by parse_workbook, only /import and import_packs.py need it
+    from pylightxl.pylightxl import Worksheet
+
+START_O23_MARKER = "LƯỢT 1 (8 CÂU)"
+START_O22_MARKER = "LƯỢT 1 (60 GIÂY)"
+
+
+@dataclass
+class ParsedAcceleration:
+    # (question, answer, answer_image_url, first_image_with_question)
+    question: tuple[Any, ...]
+    # (ord, image_url, image_time)
+    images: list[tuple[Any, ...]]
+
+
+@dataclass
+class ParsedPack:
+    # (round, question, answer, image_url)
+    starting: list[tuple[Any, ...]] = field(default_factory=list)
+    # (answer, image_url, display_type)
+    obstacle: Optional[tuple[Any, ...]] = None
+    # (row, question, answer)
+    obstacle_questions: list[tuple[Any, ...]] = field(default_factory=list)
+    acceleration: list[ParsedAcceleration] = field(default_factory=list)
+    # (rnd, score, question, answer, image_url, explanation)
+    finish: list[tuple[Any, ...]] = field(default_factory=list)
+    # (question, answer)
+    chp: list[tuple[Any, ...]] = field(default_factory=list)
+
+    @property
+    def question_count(self) -> int:
+        return (
+            len(self.starting)
+            + len(self.obstacle_questions)
+            + len(self.acceleration)
+            + len(self.finish)
+            + len(self.chp)
+        )
+
+    def image_urls(self) -> set[str]:
+        """Every image URL referenced by the pack."""
+        urls = {row[3] for row in self.starting}
+        urls |= {row[4] for row in self.finish}
+        if self.obstacle is not None:
+            urls.add(self.obstacle[1])
+        for acceleration in self.acceleration:
+            urls.add(acceleration.question[2])
+            urls |= {image[1] for image in acceleration.images}
+        urls.discard(None)
+        return urls
+
+
+class Sheet:
+    """The first `max_row` rows of a worksheet, read once, addressed by column letter and row number."""
+
+    def __init__(self, ws: "Worksheet", max_row: int):
+        # Worksheet.rows would build every row of the sheet, we only need the top
+        self.rows = [ws.row(r) for r in range(1, min(max_row, ws.maxrow) + 1)]
+
+    def __call__(self, col: str, row: int) -> Any:
+        try:
+            return self.rows[row - 1][ord(col) - 65]
+        except IndexError:
+            return ""
+
+
+def _parse_start_o23(sheet: Sheet) -> list[tuple[Any, ...]]:
+    return [
+        (rnd, sheet("B", x), sheet("C", x), sheet("D", x))
+        for (rnd, rows) in ((1, range(6, 14)), (2, range(16, 28)), (3, range(30, 46)))
+        for x in rows
+        if str(sheet("B", x)).strip()  # import only if there's a question
+    ]
+
+
+def _parse_start_o22(sheet: Sheet) -> list[tuple[Any, ...]]:
+    return [
+        (x, sheet("B", y), sheet("C", y), sheet("D", y))
+        for x in range(1, 4)
+        for y in range((x - 1) * 27 + 6, (x - 1) * 27 + 31)
+        if str(sheet("B", y)).strip()  # import only if there's a question
+    ]
+
+
+def _parse_obstacle(sheet: Sheet, pack: ParsedPack):
+    if not sheet("C", 3):
+        return
+    pack.obstacle = (sheet("C", 3), sheet("B", 3), int(sheet("D", 3)))
+    pack.obstacle_questions = [
+        (row - 4 if row != 9 else 0, sheet("B", row), sheet("C", row))
+        for row in range(5, 10)
+    ]
+
+
+def _parse_acceleration(ws: "Worksheet") -> list[ParsedAcceleration]:
+    sheet = Sheet(ws, 12)
+    questions = [row for row in range(4, 8) if sheet("B", row)]
+    # image sets are in column B, D, F, H, with their lengths in row 12
+    imgcounts = {row: int(sheet(chr((row - 4) * 2 + 66), 12)) for row in questions}
+    sheet = Sheet(ws, 12 + max(imgcounts.values(), default=0))
+
+    parsed = []
+    for row in questions:
+        imgset_column = chr((row - 4) * 2 + 66)
+        time_column = chr((row - 4) * 2 + 67)
+        imgcount = imgcounts[row]
+        parsed.append(
+            ParsedAcceleration(
+                (
+                    sheet("B", row),
+                    sheet("C", row),
+                    sheet("D", row),
+                    sheet("E", row) == 1,
+                ),
+                [
+                    (
+                        imgrow - 13,
+                        sheet(imgset_column, imgrow),
+                        float(time)
+                        if (time := str(sheet(time_column, imgrow)).strip())
+                        else 0,
+                    )
+                    for imgrow in range(13, 13 + imgcount)
+                ],
+            )
+        )
+    return parsed
+
+
+def _parse_finish(sheet: Sheet, pack: ParsedPack):
+    pack.finish = [
+        (
+            rnd,
+            20 if row <= (rnd - 1) * 8 + 7 else 30,
+            sheet("B", row),
+            sheet("C", row),
+            sheet("D", row),
+            sheet("E", row),
+        )
+        for rnd in range(1, 4)
+        for row in range((rnd - 1) * 8 + 5, (rnd - 1) * 8 + 11)
+        if sheet("B", row)
+    ]
+    pack.chp = [
+        (sheet("B", row), sheet("C", row)) for row in range(38, 41) if sheet("B", row)
+    ]
+
+
+def parse_workbook(data: Union[bytes, str]) -> ParsedPack:
+    """
+    Parse a filled-in pack template.
+
+    Parameters
+    ----------
+    data: Contents of the .xlsx file, or a path to it
+    """
+    import pylightxl as xl
+
+    wb = xl.readxl(io.BytesIO(data) if isinstance(data, bytes) else data)
+    pack = ParsedPack()
+
+    start = Sheet(wb.ws("Khởi động"), 85)
+    if start("A", 4) == START_O23_MARKER:
+        pack.starting = _parse_start_o23(start)
+    elif start("A", 4) == START_O22_MARKER:
+        pack.starting = _parse_start_o22(start)
+
+    _parse_obstacle(Sheet(wb.ws("Vượt chướng ngại vật"), 9), pack)
+    pack.acceleration = _parse_acceleration(wb.ws("Tăng tốc"))
+    _parse_finish(Sheet(wb.ws("Về đích"), 40), pack)
+    return pack
+
+
+async def store_pack(db: aiosqlite.Connection, name: str, pack: ParsedPack) -> int:
+    """
+    Insert a parsed pack, returning its ID.
+
+    Should be called inside a transaction (see `Database.transaction`).
+    """
+    async with db.cursor() as cursor:
+        await cursor.execute("INSERT INTO packs(name) VALUES(?)", (name,))
+        pack_id = cursor.lastrowid
+        assert pack_id is not None
+
+        await cursor.executemany(
+            "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)",
+            [(pack_id, *row) for row in pack.starting],
+        )
+
+        if pack.obstacle is not None:
+            await cursor.execute(
+                "INSERT INTO obstacle(pack_id, answer, image_url, display_type) VALUES(?,?,?,?)",
+                (pack_id, *pack.obstacle),
+            )
+            obstacle_id = cursor.lastrowid
+            await cursor.executemany(
+                "INSERT INTO obstacle_questions(obstacle_id, row, question, answer) VALUES(?,?,?,?)",
+                [(obstacle_id, *row) for row in pack.obstacle_questions],
+            )
+
+        images = []
+        for acceleration in pack.acceleration:
+            await cursor.execute(
+                "INSERT INTO acceleration(pack_id, question, answer, answer_image_url, first_image_with_question) VALUES(?,?,?,?,?)",
+                (pack_id, *acceleration.question),
+            )
+            images += [(cursor.lastrowid, *image) for image in acceleration.images]
+        await cursor.executemany(
+            "INSERT INTO acceleration_images(acceleration_id, ord, image_url, image_time) VALUES(?,?,?,?)",
+            images,
+        )
+
+        await cursor.executemany(
+            "INSERT INTO finish(pack_id, rnd, score, question, answer, image_url, explanation) VALUES(?,?,?,?,?,?,?)",
+            [(pack_id, *row) for row in pack.finish],
+        )
+        await cursor.executemany(
+            "INSERT INTO chp(pack_id, question, answer) VALUES(?,?,?)",
+            [(pack_id, *row) for row in pack.chp],
+        )
+    return pack_id
+
+
+if __name__ == "__main__":
+    # Benchmark: event loop stall and total time of importing a large workbook,
+    # the old way (parsing on the event loop, cell lookups through
+    # Worksheet.address, one execute per obstacle/acceleration row) against
+    # parse_workbook in a thread and store_pack.
+    import asyncio
+    import sqlite3
+    import tempfile
+    import time
+    from pathlib import Path
+
+    import pylightxl as xl
+
+    from utils.migrations import migrate_sync
+
+    ROOT = Path(__file__).parents[1]
+    FILLER_ROWS = 20_000
+
+    def generate(path: Path):
+        wb = xl.readxl(ROOT / "resources" / "Form nhập đề thi.xlsx")
+        start = wb.ws("Khởi động")
+        for x in [*range(6, 14), *range(16, 28), *range(30, 46)]:
+            start.update_address(f"B{x}", f"Câu hỏi khởi động số {x}?")
+            start.update_address(f"C{x}", f"đáp án {x}")
+        obstacle = wb.ws("Vượt chướng ngại vật")
+        obstacle.update_address("B3", "https://example.com/vcnv.png")
+        obstacle.update_address("C3", "OLYMPIA")
+        for x in range(5, 10):
+            obstacle.update_address(f"B{x}", f"Hàng ngang {x}?")
+            obstacle.update_address(f"C{x}", f"HANG{x}")
+        acceleration = wb.ws("Tăng tốc")
+        for x in range(4, 8):
+            acceleration.update_address(f"B{x}", f"Tăng tốc {x}?")
+            acceleration.update_address(f"C{x}", f"tt{x}")
+        for col in "BDFH":
+            acceleration.update_address(f"{col}12", 10)
+            for x in range(13, 23):
+                acceleration.update_address(
+                    f"{col}{x}", f"https://example.com/{col}{x}.png"
+                )
+        finish = wb.ws("Về đích")
+        for x in [*range(5, 11), *range(13, 19), *range(21, 27), *range(38, 41)]:
+            finish.update_address(f"B{x}", f"Về đích {x}?")
+            finish.update_address(f"C{x}", f"vd{x}")
+        # notes and scratch work far below the template, as seen in real packs
+        for name in wb.ws_names:
+            ws = wb.ws(name)
+            for x in range(100, 100 + FILLER_ROWS):
+                ws.update_address(f"A{x}", f"ghi chú {x}")
+                ws.update_address(f"B{x}", x)
+        xl.writexl(wb, str(path))
+
+    async def legacy_import(db: aiosqlite.Connection, name: str, data: bytes) -> int:
+        wb = xl.readxl(io.BytesIO(data))
+        async with db.cursor() as cursor:
+            await cursor.execute("INSERT INTO packs(name) VALUES(?)", (name,))
+            pack_id = cursor.lastrowid
+            ws = wb.ws("Khởi động")
+            await cursor.executemany(
+                "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)",
+                [
+                    (
+                        pack_id,
+                        r,
+                        ws.address(f"B{x}"),
+                        ws.address(f"C{x}"),
+                        ws.address(f"D{x}"),
+                    )
+                    for (r, rows) in (
+                        (1, range(6, 14)),
+                        (2, range(16, 28)),
+                        (3, range(30, 46)),
+                    )
+                    for x in rows
+                    if ws.address(f"B{x}").strip()
+                ],
+            )
+            ws = wb.ws("Vượt chướng ngại vật")
+            await cursor.execute(
+                "INSERT INTO obstacle(pack_id, answer, image_url, display_type) VALUES(?,?,?,?)",
+                (pack_id, ws.address("C3"), ws.address("B3"), int(ws.address("D3"))),
+            )
+            obstacle_id = cursor.lastrowid
+            for row in range(5, 10):
+                await cursor.execute(
+                    "INSERT INTO obstacle_questions(obstacle_id, row, question, answer) VALUES(?,?,?,?)",
+                    (
+                        obstacle_id,
+                        row - 4 if row != 9 else 0,
+                        ws.address(f"B{row}"),
+                        ws.address(f"C{row}"),
+                    ),
+                )
+            ws = wb.ws("Tăng tốc")
+            for row in range(4, 8):
+                await cursor.execute(
+                    "INSERT INTO acceleration(pack_id, question, answer, answer_image_url, first_image_with_question) VALUES(?,?,?,?,?)",
+                    (
+                        pack_id,
+                        ws.address(f"B{row}"),
+                        ws.address(f"C{row}"),
+                        ws.address(f"D{row}"),
+                        ws.address(f"E{row}") == 1,
+                    ),
+                )
+                acceleration_id = cursor.lastrowid
+                column = chr((row - 4) * 2 + 66)
+                for imgrow in range(13, 13 + int(ws.address(f"{column}12"))):
+                    await cursor.execute(
+                        "INSERT INTO acceleration_images(acceleration_id, ord, image_url, image_time) VALUES(?,?,?,?)",
+                        (
+                            acceleration_id,
+                            imgrow - 13,
+                            ws.address(f"{column}{imgrow}"),
+                            0,
+                        ),
+                    )
+            ws = wb.ws("Về đích")
+            await cursor.executemany(
+                "INSERT INTO finish(pack_id, rnd, score, question, answer, image_url, explanation) VALUES(?,?,?,?,?,?,?)",
+                [
+                    (
+                        pack_id,
+                        rnd,
+                        20 if row <= (rnd - 1) * 8 + 7 else 30,
+                        ws.address(f"B{row}"),
+                        ws.address(f"C{row}"),
+                        ws.address(f"D{row}"),
+                        ws.address(f"E{row}"),
+                    )
+                    for rnd in range(1, 4)
+                    for row in range((rnd - 1) * 8 + 5, (rnd - 1) * 8 + 11)
+                    if ws.address(f"B{row}")
+                ],
+            )
+        await db.commit()
+        return pack_id
+
+    async def new_import(db: aiosqlite.Connection, name: str, data: bytes) -> int:
+        pack = await asyncio.to_thread(parse_workbook, data)
+        await db.execute("BEGIN")
+        pack_id = await store_pack(db, name, pack)
+        await db.commit()
+        return pack_id
+
+    async def measure(name: str, importer, db_path: Path, data: bytes):
+        stall = 0.0
+        done = False
+
+        async def ticker():
+            nonlocal stall
+            last = time.perf_counter()
+            while not done:
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                stall = max(stall, now - last - 0.001)
+                last = now
+
+        async with aiosqlite.connect(db_path, isolation_level=None) as db:
+            task = asyncio.create_task(ticker())
+            await asyncio.sleep(0.01)
+            started = time.perf_counter()
+            await importer(db, name, data)
+            elapsed = time.perf_counter() - started
+            done = True
+            await task
+        print(
+            f"{name:>7}: import {elapsed * 1000:.0f} ms, "
+            f"longest event loop stall {stall * 1000:.1f} ms"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workbook = Path(tmp) / "pack.xlsx"
+        generate(workbook)
+        data = workbook.read_bytes()
+        print(
+            f"workbook: {len(data) / 1024:.0f} KiB, {FILLER_ROWS} filler rows per sheet"
+        )
+        for (name, importer) in (("before", legacy_import), ("after", new_import)):
+            db_path = Path(tmp) / f"{name}.sqlite3"
+            conn = sqlite3.connect(db_path)
+            migrate_sync(conn)
+            conn.close()
+            asyncio.run(measure(name, importer, db_path, data))
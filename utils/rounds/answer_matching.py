@@ -11,12 +11,105 @@ For letter-based answers, e.g. C~>A~>B~>D and 2~>3~>1~>4, automatic conversion i
 
 Precedence: ~> and ~+ first, then ~|.
 Currently for ~> and ~+, there is a maximum of 9 answers.
+
+Answers are compiled once into a `CompiledAnswer` (see `compile_answer`), which
+is cached by answer string, so judging a player's message only normalizes the
+message once and checks it against precomputed sets and sequences.
+
+Tolerant matching
+-----------------
+Passing a `tolerance` to `CompiledAnswer.match` (or `match_answer`) enables a
+lenient mode for text answers: diacritics and Unicode normalization forms are
+folded away ("Đường" == "duong"), and up to `tolerance` edits (insertions,
+deletions, substitutions or swaps of adjacent letters) are accepted, capped to
+one edit per `TYPO_SPAN` characters of the expected answer. Answers containing
+digits and letter sequences (C~>A~>B~>D) are still matched exactly.
 """
+import functools
 import re
+import unicodedata
+from typing import Optional
 
 player_ans_transtable = str.maketrans("", "", ",. \t\r\n\v\u00A0\u2003")
 delims = re.compile(r"\bvà\b|,")
 
+COMPILED_ANSWER_CACHE_SIZE = 4096
+TYPO_SPAN = 5
+
+
+def fold_diacritics(text: str) -> str:
+    """Lowercase `text`, strip its diacritics and collapse whitespace."""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    return " ".join("".join(c for c in text if not unicodedata.combining(c)).split())
+
+
+def bounded_distance(a: str, b: str, limit: int) -> int:
+    """
+    Damerau-Levenshtein (optimal string alignment) distance between `a` and `b`.
+
+    Only the diagonal band of width `limit` is computed, and the computation stops
+    as soon as every cell in a row exceeds `limit`. Any distance above `limit` is
+    reported as `limit + 1`.
+    """
+    if a == b:
+        return 0
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) > len(b):
+        a, b = b, a
+
+    # shared prefixes and suffixes never contribute to the distance
+    start = 0
+    while start < len(a) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start : len(a) - end]
+    b = b[start : len(b) - end]
+    if not a:
+        return min(len(b), limit + 1)
+
+    over = limit + 1
+    len_b = len(b)
+    prev2: list[int] = []
+    prev = [min(j, over) for j in range(len_b + 1)]
+    for i in range(1, len(a) + 1):
+        char_a = a[i - 1]
+        lo = max(1, i - limit)
+        hi = min(len_b, i + limit)
+        cur = [over] * (len_b + 1)
+        cur[0] = min(i, over)
+        row_min = cur[0] if lo == 1 else over
+        for j in range(lo, hi + 1):
+            char_b = b[j - 1]
+            dist = min(
+                prev[j] + 1,
+                cur[j - 1] + 1,
+                prev[j - 1] + (char_a != char_b),
+            )
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                dist = min(dist, prev2[j - 2] + 1)
+            cur[j] = dist
+            if dist < row_min:
+                row_min = dist
+        if row_min > limit:
+            return over
+        prev2, prev = prev, cur
+    return min(prev[len_b], over)
+
+
+def _typo_budget(folded: str) -> int:
+    """Maximum number of edits a folded expected answer can absorb."""
+    if any(c.isdigit() for c in folded):
+        return 0
+    return len(folded) // TYPO_SPAN
+
+
+def _close_enough(player: str, expected: str, budget: int, tolerance: int) -> bool:
+    limit = min(budget, tolerance)
+    return bounded_distance(player, expected, limit) <= limit
+
 
 def convert_digit_to_letter(ans: str):
     if ans.isalpha():
@@ -25,9 +118,220 @@ def convert_digit_to_letter(ans: str):
     return "123456789"[: len(ans)].translate(str.maketrans(ans.ljust(9), "ABCDEFGHI"))
 
 
-def match_answer(player_ans: str, ans: str) -> bool:
+def _digits_to_letters(ans: str) -> Optional[str]:
+    """
+    Same as `convert_digit_to_letter`, without building a translation table.
+
+    Returns None for inputs longer than 9 characters, which
+    `convert_digit_to_letter` cannot translate.
+    """
+    if ans.isalpha():
+        return ans
+    ans = ans.upper()
+    if len(ans) > 9:
+        return None
+    return "".join(
+        "ABCDEFGHI"[pos] if (pos := ans.rfind(digit)) >= 0 else digit
+        for digit in "123456789"[: len(ans)]
+    )
+
+
+def _is_letter_sequence(sections: list[str]) -> bool:
+    return all(len(x) == 1 and x.isalpha() or x.isdigit() for x in sections)
+
+
+class CompiledAnswer:
+    """
+    An answer key parsed into precomputed lookups.
+
+    Use `compile_answer` instead of instantiating this directly, so that
+    compiled answers are shared between questions with the same answer.
+    """
+
+    __slots__ = (
+        "answer",
+        "_plain",
+        "_ordered_letters",
+        "_unordered_letters",
+        "_ordered",
+        "_unordered",
+        "_plain_folded",
+        "_ordered_folded",
+        "_unordered_folded",
+    )
+
+    def __init__(self, ans: str):
+        self.answer = ans
+        plain: set[str] = set()
+        ordered_letters: set[str] = set()
+        unordered_letters: set[str] = set()
+        ordered: list[tuple[str, ...]] = []
+        unordered: list[tuple[str, ...]] = []
+
+        alternatives = [x.strip() for x in ans.split("~|")] if "~|" in ans else [ans]
+        for alt in alternatives:
+            if "~>" in alt:
+                sections = [x.lower().strip() for x in alt.split("~>")]
+                if _is_letter_sequence(sections):
+                    letters = _digits_to_letters(
+                        alt.replace("~>", "").translate(player_ans_transtable)
+                    )
+                    if letters is not None:
+                        ordered_letters.add(letters.upper())
+                else:
+                    ordered.append(tuple(sections))
+            elif "~+" in alt:
+                sections = sorted([x.lower().strip() for x in alt.split("~+")])
+                if _is_letter_sequence(sections):
+                    unordered_letters.add(
+                        "".join(
+                            sorted(
+                                alt.replace("~+", "").translate(player_ans_transtable)
+                            )
+                        ).upper()
+                    )
+                else:
+                    unordered.append(tuple(sections))
+            else:
+                plain.add(alt.lower())
+
+        self._plain = frozenset(plain)
+        self._ordered_letters = frozenset(ordered_letters)
+        self._unordered_letters = frozenset(unordered_letters)
+        self._ordered = tuple(ordered)
+        self._unordered = tuple(unordered)
+
+        # (folded text, typo budget) pairs for tolerant matching
+        self._plain_folded = tuple(
+            (folded, _typo_budget(folded)) for folded in map(fold_diacritics, plain)
+        )
+        self._ordered_folded = tuple(
+            tuple((folded, _typo_budget(folded)) for folded in map(fold_diacritics, x))
+            for x in ordered
+        )
+        self._unordered_folded = tuple(
+            sorted(
+                ((folded, _typo_budget(folded)) for folded in map(fold_diacritics, x)),
+                key=lambda x: x[0],
+            )
+            for x in unordered
+        )
+
+    def __repr__(self) -> str:
+        return f"CompiledAnswer({self.answer!r})"
+
+    def match(self, player_ans: str, tolerance: Optional[int] = None) -> bool:
+        """
+        Check a player's answer against this answer key.
+
+        Parameters
+        ----------
+        player_ans: The player's answer
+
+        Optional parameters
+        -------------------
+        tolerance: Maximum number of typos to accept, after folding diacritics.
+            None (the default) only accepts exact matches.
+        """
+        if self._match_exact(player_ans):
+            return True
+        if tolerance is None:
+            return False
+        return self._match_tolerant(player_ans, tolerance)
+
+    def _match_exact(self, player_ans: str) -> bool:
+        if player_ans.lower() in self._plain:
+            return True
+
+        if self._ordered_letters or self._unordered_letters:
+            stripped = player_ans.translate(player_ans_transtable)
+            if self._ordered_letters:
+                letters = _digits_to_letters(stripped)
+                if letters is not None and letters.upper() in self._ordered_letters:
+                    return True
+            if (
+                self._unordered_letters
+                and "".join(sorted(stripped)).upper() in self._unordered_letters
+            ):
+                return True
+
+        if self._ordered:
+            player_sections = [x.lower().strip() for x in player_ans.split(",")]
+            for sections in self._ordered:
+                if all(
+                    player_section == section
+                    for (player_section, section) in zip(player_sections, sections)
+                ):
+                    return True
+
+        if self._unordered:
+            player_sections = sorted(
+                [x.lower().strip() for x in delims.split(player_ans)]
+            )
+            for sections in self._unordered:
+                if all(
+                    player_section == section
+                    for (player_section, section) in zip(player_sections, sections)
+                ):
+                    return True
+
+        return False
+
+    def _match_tolerant(self, player_ans: str, tolerance: int) -> bool:
+        folded = fold_diacritics(player_ans)
+        for (expected, budget) in self._plain_folded:
+            if _close_enough(folded, expected, budget, tolerance):
+                return True
+
+        if self._ordered_folded:
+            player_sections = [fold_diacritics(x) for x in player_ans.split(",")]
+            for sections in self._ordered_folded:
+                if all(
+                    _close_enough(player_section, expected, budget, tolerance)
+                    for (player_section, (expected, budget)) in zip(
+                        player_sections, sections
+                    )
+                ):
+                    return True
+
+        if self._unordered_folded:
+            player_sections = sorted(
+                fold_diacritics(x) for x in delims.split(player_ans)
+            )
+            for sections in self._unordered_folded:
+                if all(
+                    _close_enough(player_section, expected, budget, tolerance)
+                    for (player_section, (expected, budget)) in zip(
+                        player_sections, sections
+                    )
+                ):
+                    return True
+
+        return False
+
+
+@functools.lru_cache(maxsize=COMPILED_ANSWER_CACHE_SIZE)
+def compile_answer(ans: str) -> CompiledAnswer:
+    return CompiledAnswer(ans)
+
+
+def compile_cache_hit_ratio() -> float:
+    """Fraction of `compile_answer` calls served from its cache."""
+    info = compile_answer.cache_info()
+    lookups = info.hits + info.misses
+    return info.hits / lookups if lookups else 0.0
+
+
+def match_answer(player_ans: str, ans: str, tolerance: Optional[int] = None) -> bool:
+    return compile_answer(ans).match(player_ans, tolerance)
+
+
+def _match_answer_reference(player_ans: str, ans: str) -> bool:
+    """The original string-splitting matcher, kept to check `CompiledAnswer` against."""
     if "~|" in ans:
-        return any(match_answer(player_ans, x.strip()) for x in ans.split("~|"))
+        return any(
+            _match_answer_reference(player_ans, x.strip()) for x in ans.split("~|")
+        )
     elif "~>" in ans:
         sections = [x.lower().strip() for x in ans.split("~>")]
 
@@ -67,33 +371,88 @@ def match_answer(player_ans: str, ans: str) -> bool:
         return ans.lower() == player_ans.lower()
 
 
-if __name__ == "__main__":
-    assert match_answer("alan turing", "Alan Turing")
+# (player answer, answer key, expected result)
+PARITY_CORPUS = [
+    ("alan turing", "Alan Turing", True),
+    ("56", "56~|năm mươi sáu", True),
+    ("57", "56~|năm mươi sáu", False),
+    ("nĂm mƯƠi sáU", "56 ~| năm mươi sáu", True),
+    ("CABD", "C~>A~>B~>D", True),
+    ("cabd", "C~>A~>B~>D", True),
+    ("C,A,B,D", "C~>A~>B~>D", True),
+    ("2314", "C~>A~>B~>D", True),
+    ("Ong, thỏ", "ong~>thỏ", True),
+    ("BA", "ong~>thỏ", False),
+    ("1234", "C~>A~>B~>D", False),
+    ("2314", "ong~>thỏ", False),
+    ("ong, thỏ", "C~>A~>B~>D", False),
+    ("CAB", "C~+A~+B", True),
+    ("ABC", "C~+A~+B", True),
+    (
+        "ròng rọc cố định, ròng rọc động",
+        "ròng rọc~|ròng rọc cố định~+ròng rọc động",
+        True,
+    ),
+    (
+        "ròng rọc cố định và ròng rọc động",
+        "ròng rọc~|ròng rọc cố định~+ròng rọc động",
+        True,
+    ),
+    ("ong, thỏ", "ong và thỏ~|ong~+thỏ", True),
+    ("ong,thỏ", "ong và thỏ~|ong~+thỏ", True),
+    ("thỏ, ong", "ong và thỏ~|ong~+thỏ", True),
+    ("thỏ và ong", "ong và thỏ~|ong~+thỏ", True),
+]
+
 
-    assert match_answer("56", "56~|năm mươi sáu")
-    assert not match_answer("57", "56~|năm mươi sáu")
-    assert match_answer("nĂm mƯƠi sáU", "56 ~| năm mươi sáu")
+if __name__ == "__main__":
+    import itertools
+    import timeit
 
-    assert match_answer("CABD", "C~>A~>B~>D")
-    assert match_answer("cabd", "C~>A~>B~>D")
-    assert match_answer("C,A,B,D", "C~>A~>B~>D")
-    assert match_answer("2314", "C~>A~>B~>D")
-    assert match_answer("Ong, thỏ", "ong~>thỏ")
-    assert not match_answer("BA", "ong~>thỏ")
-    assert not match_answer("1234", "C~>A~>B~>D")
-    assert not match_answer("2314", "ong~>thỏ")
-    assert not match_answer("ong, thỏ", "C~>A~>B~>D")
+    for (player_ans, ans, expected) in PARITY_CORPUS:
+        assert match_answer(player_ans, ans) is expected, (player_ans, ans)
+        assert _match_answer_reference(player_ans, ans) is expected, (player_ans, ans)
 
-    assert match_answer("CAB", "C~+A~+B")
-    assert match_answer("ABC", "C~+A~+B")
+    # every player answer in the corpus against every answer key
+    player_answers = {x[0] for x in PARITY_CORPUS} | {"", "2 3 1 4", "c.a.b.d", "ong"}
+    answer_keys = {x[1] for x in PARITY_CORPUS}
+    for (player_ans, ans) in itertools.product(player_answers, answer_keys):
+        assert match_answer(player_ans, ans) == _match_answer_reference(
+            player_ans, ans
+        ), (player_ans, ans)
+    print(f"parity: {len(player_answers) * len(answer_keys)} pairs OK")
 
+    assert bounded_distance("turing", "turnig", 1) == 1
+    assert bounded_distance("kitten", "sitting", 3) == 3
+    assert bounded_distance("kitten", "sitting", 2) == 3
+    assert match_answer("duong len dinh olympia", "Đường lên đỉnh Olympia", 0)
+    assert match_answer("đường lên đỉnh olympia", "Đường lên đỉnh Olympia", 0)
+    assert not match_answer("duong len dinh olympia", "Đường lên đỉnh Olympia")
+    assert match_answer("alan turnig", "Alan Turing", 1)
+    assert not match_answer("alan turnig", "Alan Turing")
+    assert not match_answer("alan tunrig", "Alan Turing", 1)  # two transpositions
+    assert not match_answer("57", "56~|năm mươi sáu", 2)
+    assert match_answer("nam muoi sau", "56~|năm mươi sáu", 0)
+    assert not match_answer("ong", "bò", 1)  # too short for any typo
     assert match_answer(
-        "ròng rọc cố định, ròng rọc động", "ròng rọc~|ròng rọc cố định~+ròng rọc động"
+        "ròng rọc dong, rong roc co dinh", "ròng rọc cố định~+ròng rọc động", 1
     )
-    assert match_answer(
-        "ròng rọc cố định và ròng rọc động", "ròng rọc~|ròng rọc cố định~+ròng rọc động"
+    assert match_answer("Nguyen Du, Truyen Kieu", "nguyễn du~>truyện kiều", 1)
+    assert match_answer("\u0111u\u031bo\u031b\u0300ng", "đường", 0)  # NFD input
+
+    long_key = "~|".join(f"đáp án thứ {x} của câu hỏi" for x in "abcdefghijklmnopqrst")
+    elapsed = timeit.timeit(
+        lambda: match_answer("dap an thu z cua cau hoi", long_key, 2), number=20000
     )
-    assert match_answer("ong, thỏ", "ong và thỏ~|ong~+thỏ")
-    assert match_answer("ong,thỏ", "ong và thỏ~|ong~+thỏ")
-    assert match_answer("thỏ, ong", "ong và thỏ~|ong~+thỏ")
-    assert match_answer("thỏ và ong", "ong và thỏ~|ong~+thỏ")
+    print(f"tolerant, 20 alternatives: {elapsed / 20000 * 1e6:.2f} µs/match")
+
+    number = 20000
+    for (name, func) in (
+        ("reference", _match_answer_reference),
+        ("compiled", match_answer),
+    ):
+        elapsed = timeit.timeit(
+            lambda: [func(p, a) for (p, a, _) in PARITY_CORPUS], number=number
+        )
+        per_call = elapsed / (number * len(PARITY_CORPUS)) * 1e6
+        print(f"{name:>9}: {per_call:.2f} µs/match")
@@ -0,0 +1,484 @@
+"""
+Checkpoints of Khởi động games, so that they survive a restart of the bot.
+
+A game is stored once when it starts, with its questions, in `game_sessions`
+(migration 0006). Then, at every question boundary, `GameSession` saves its
+progress: the stage and question it is at, the time left and the scores.
+Saving is write-behind: `SessionStore.save` only keeps the latest progress of
+each game in memory, and the checkpoints of every game saved within `DELAY`
+seconds are written together in one transaction, retried with backoff if it
+fails. Answers are never written on their own, and a restart loses at most the
+question being played, which is asked again.
+
+When a game ends, its scores are recorded on the leaderboard (see
+utils/leaderboard.py) in the transaction that deletes its row, so they are
+recorded exactly once: a game that ended but wasn't written yet is resumed
+after its last question, shows its results again and is recorded then.
+
+On startup, games whose checkpoint is recent are resumed from it, the others
+are ended with the scores they had (see `StartCog`).
+"""
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from utils.database import Database
+from utils.leaderboard import GameResult, record_game
+from utils.rounds.router import AnswerInbox
+from utils.rounds.session import (
+    GRACE,
+    Clock,
+    GameSession,
+    SessionSink,
+    SessionState,
+)
+from utils.rounds.start import StartQuestion
+
+DELAY = 0.5  # seconds a checkpoint may wait for others to be written with
+MAX_RETRY_DELAY = 60.0  # seconds, the most a failed write waits to be retried
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class SavedSession:
+    """An interrupted game, as of its last checkpoint."""
+
+    id: int
+    guild_id: Optional[int]
+    channel_id: int
+    ruleset: str
+    players: dict[int, str]
+    questions: list[StartQuestion]  # not drawn yet
+    stage: int
+    number: int
+    drawn: int
+    remaining: Optional[float]
+    results: dict[int, int]
+    updated: float  # UNIX time
+
+    def session(
+        self,
+        inbox: AnswerInbox,
+        sink: SessionSink,
+        clock: Optional[Clock] = None,
+        checkpoints: Optional["SessionStore"] = None,
+        grace: float = GRACE,
+    ) -> GameSession:
+        """A `GameSession` going on from the checkpoint."""
+        session = GameSession(
+            self.ruleset,
+            self.players,
+            self.questions,
+            inbox,
+            sink,
+            clock,
+            checkpoints,
+            grace,
+        )
+        session.id = self.id
+        session.results.update(self.results)
+        session.stage = self.stage
+        session.number = self.number
+        session.drawn = self.drawn
+        session.remaining = self.remaining
+        return session
+
+
+class SessionStore:
+    def __init__(self, db: Database, delay: float = DELAY):
+        """
+        Stores games and writes their checkpoints behind them.
+
+        Parameters
+        ----------
+        db: Database with the game_sessions table
+
+        Optional parameters
+        -------------------
+        delay: Seconds to wait for more checkpoints before writing (default 0.5)
+        """
+        self.db = db
+        self.delay = delay
+        self.saved = 0  # calls to `save`
+        self.written = 0  # checkpoints written
+        self.transactions = 0
+        self.failures = 0  # writes failed in a row
+        # game ID: UPDATE parameters, or the results of a finished game
+        self._pending: dict[int, Union[tuple, GameResult]] = {}
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def create(
+        self, session: GameSession, channel_id: int, guild_id: Optional[int] = None
+    ) -> int:
+        """Store a game that is about to start, with its questions, and set its `id`."""
+        questions = [
+            [q.rnd, q.question, q.answer, q.image_url] for q in session.questions
+        ]
+        async with self.db.transaction("create_session") as conn:
+            async with conn.execute(
+                "INSERT INTO game_sessions(guild, channel, ruleset, players, questions, results, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    guild_id,
+                    channel_id,
+                    session.ruleset,
+                    json.dumps(session.players, ensure_ascii=False),
+                    json.dumps(questions, ensure_ascii=False),
+                    json.dumps(session.results),
+                    time.time(),
+                ),
+            ) as cursor:
+                session.id = cursor.lastrowid
+        assert session.id is not None
+        return session.id
+
+    def save(self, session: GameSession):
+        """Write the progress of `session` soon, replacing any pending checkpoint of it."""
+        assert session.id is not None
+        self.saved += 1
+        if session.state is SessionState.Finished:
+            self._pending[session.id] = GameResult(
+                session.id,
+                session.ruleset,
+                dict(session.players),
+                dict(session.results),
+                time.time(),
+            )
+        else:
+            self._pending[session.id] = (
+                session.stage,
+                session.number,
+                session.drawn,
+                session.remaining,
+                json.dumps(session.results),
+                time.time(),
+                session.id,
+            )
+        self._schedule()
+
+    def end(self, saved: SavedSession):
+        """End an interrupted game with the scores it had, without resuming it."""
+        self._pending[saved.id] = GameResult(
+            saved.id, saved.ruleset, saved.players, saved.results, time.time()
+        )
+        self._schedule()
+
+    def _schedule(self, delay: Optional[float] = None):
+        if self._timer is None:
+            self._timer = asyncio.create_task(
+                self._flush_later(self.delay if delay is None else delay)
+            )
+
+    async def flush(self):
+        """Write the pending checkpoints now."""
+        async with self._lock:
+            if not self._pending:
+                return
+            (pending, self._pending) = (self._pending, {})
+            updates = [row for row in pending.values() if isinstance(row, tuple)]
+            finished = [row for row in pending.values() if isinstance(row, GameResult)]
+            try:
+                async with self.db.transaction("checkpoint") as conn:
+                    await conn.executemany(
+                        "UPDATE game_sessions SET stage = ?, number = ?, drawn = ?, "
+                        "remaining = ?, results = ?, updated = ? WHERE id = ?",
+                        updates,
+                    )
+                    for result in finished:
+                        async with conn.execute(
+                            "DELETE FROM game_sessions WHERE id = ? RETURNING guild",
+                            (result.game,),
+                        ) as cursor:
+                            row = await cursor.fetchone()
+                        if row is not None:  # else already recorded
+                            await record_game(conn, row[0] or 0, result)
+            except BaseException:
+                # rolled back: keep them for the next flush, unless newer ones came
+                self._pending = {**pending, **self._pending}
+                raise
+            self.written += len(pending)
+            self.transactions += 1
+            self.failures = 0
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            # e.g. the database is busy: retry, or the results of a finished
+            # game would wait for another game's checkpoint to be written
+            self.failures += 1
+            retry = min(max(self.delay, 0.05) * 2**self.failures, MAX_RETRY_DELAY)
+            log.exception("writing checkpoints failed, retrying in %.1fs", retry)
+            self._schedule(retry)
+
+    async def delete(self, id: int):
+        """Forget a game right away, without recording it, so that it is never resumed."""
+        self._pending.pop(id, None)
+        async with self.db.transaction("delete_session") as conn:
+            await conn.execute("DELETE FROM game_sessions WHERE id = ?", (id,))
+
+    async def interrupted(self) -> list[SavedSession]:
+        """The games that did not end, as of their last checkpoint."""
+        async with self.db.read("interrupted_sessions") as conn:
+            async with conn.execute(
+                "SELECT id, guild, channel, ruleset, players, questions, stage, "
+                "number, drawn, remaining, results, updated FROM game_sessions"
+            ) as cursor:
+                rows = await cursor.fetchall()
+        saved = []
+        for row in rows:
+            (id, guild, channel, ruleset, players, questions, stage) = row[:7]
+            (number, drawn, remaining, results, updated) = row[7:]
+            saved.append(
+                SavedSession(
+                    id,
+                    guild,
+                    channel,
+                    ruleset,
+                    {int(k): v for (k, v) in json.loads(players).items()},
+                    [StartQuestion(*q) for q in json.loads(questions)[drawn:]],
+                    stage,
+                    number,
+                    drawn,
+                    remaining,
+                    {int(k): v for (k, v) in json.loads(results).items()},
+                    updated,
+                )
+            )
+        return saved
+
+    async def close(self):
+        """Write what is pending, e.g. the games cancelled by a shutdown."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+
+if __name__ == "__main__":
+    # Crashes games at random questions, losing the checkpoints not written
+    # yet, resumes them from the database and checks that they end with the
+    # same scores as the same games played without a crash, recorded once on
+    # the leaderboard. Then counts the transactions written for many
+    # concurrent games.
+    import random
+    import sqlite3
+    import statistics
+    import tempfile
+    from pathlib import Path
+    from types import SimpleNamespace
+
+    from utils.migrations import migrate
+    from utils.rounds.session import VirtualClock
+
+    class Crash(Exception):
+        pass
+
+    class FakeSink:
+        """Answers each question the same way whenever it is asked."""
+
+        def __init__(self, inbox: AnswerInbox, clock: VirtualClock, crash_at: int = 0):
+            self.inbox = inbox
+            self.clock = clock
+            self.crash_at = crash_at
+            self.asked = 0
+            self.final: Optional[dict[int, int]] = None
+
+        async def question(
+            self, number, question, remaining, last_state, last_answer, scores, players
+        ):
+            self.asked += 1
+            if self.asked == self.crash_at:
+                raise Crash
+            x = int(question.question[1:])
+            message = SimpleNamespace(
+                author=SimpleNamespace(id=list(players)[x % len(players)]),
+                content=question.answer if x % 3 else "sai",
+            )
+            asked = self.asked
+
+            def answer():
+                # too late if the question timed out: the answer is not carried
+                # over to the next one, which a resumed game wouldn't get
+                if self.asked == asked:
+                    self.inbox.queue.put_nowait(message)
+
+            self.clock.call_later(2 + x * 7 % 11, answer)
+
+        async def results(self, players, results, rnd):
+            if rnd is None:
+                self.final = dict(results)
+
+        async def single_player(self):
+            pass
+
+        async def turn_started(self, name, delay):
+            pass
+
+        async def round_started(self, ruleset, rnd, rules, delay):
+            pass
+
+        async def round_ended(self, last_answer):
+            pass
+
+        async def turn_ended(self, name, score):
+            pass
+
+    def game(seed: int) -> tuple[str, dict[int, str], list[StartQuestion]]:
+        rng = random.Random(seed)
+        players = {x: f"Người chơi {x}" for x in range(1, rng.randint(1, 4) + 1)}
+        questions = [StartQuestion(1, f"q{x}", f"đáp án {x}", None) for x in range(70)]
+        return (("o21", "o22", "o23")[seed % 3], players, questions)
+
+    async def play(
+        seed: int, store: Optional[SessionStore] = None
+    ) -> tuple[dict[int, int], int]:
+        """The scores of a game and the number of questions asked."""
+        (ruleset, players, questions) = game(seed)
+        clock = VirtualClock()
+        inbox = AnswerInbox(seed)
+        sink = FakeSink(inbox, clock)
+        session = GameSession(ruleset, players, questions, inbox, sink, clock, store)
+        if store is not None:
+            await store.create(session, seed)
+        return (await session.run(), sink.asked)
+
+    async def crash_and_resume(
+        path: Path, seed: int, crash_at: int
+    ) -> tuple[dict[int, int], SavedSession]:
+        async with Database(path) as db:
+            store = SessionStore(db, delay=0)
+            (ruleset, players, questions) = game(seed)
+            clock = VirtualClock()
+            inbox = AnswerInbox(seed)
+            sink = FakeSink(inbox, clock, crash_at)
+            session = GameSession(
+                ruleset, players, questions, inbox, sink, clock, store
+            )
+            await store.create(session, seed)
+            try:
+                await session.run()
+                raise AssertionError("the game did not crash")
+            except Crash:
+                pass
+            # the process dies: pending checkpoints are lost (a write in
+            # progress is left to commit, it could have)
+            if store._timer is not None:
+                store._timer.cancel()
+            async with store._lock:
+                pass
+
+        async with Database(path) as db:
+            store = SessionStore(db)
+            (saved,) = await store.interrupted()
+            assert saved.drawn <= crash_at and saved.channel_id == seed
+            clock = VirtualClock()
+            inbox = AnswerInbox(seed)
+            sink = FakeSink(inbox, clock)
+            results = await saved.session(inbox, sink, clock, store).run()
+            await store.close()
+            assert sink.final == results
+            assert await store.interrupted() == []
+            async with db.read() as conn:
+                async with conn.execute(
+                    "SELECT player, score FROM results WHERE game = ?", (saved.id,)
+                ) as cursor:
+                    recorded = dict(await cursor.fetchall())
+            assert recorded == results, "not recorded exactly once"
+        return (results, saved)
+
+    class Busy:
+        """A database whose first `failures` checkpoint writes fail, as if locked."""
+
+        def __init__(self, db: Database, failures: int):
+            self.db = db
+            self.failures = failures
+
+        def read(self, *args):
+            return self.db.read(*args)
+
+        def transaction(self, name: Optional[str] = None):
+            if name == "checkpoint" and self.failures:
+                self.failures -= 1
+                raise sqlite3.OperationalError("database is locked")
+            return self.db.transaction(name)
+
+    async def retry(path: Path):
+        # a finished game whose write fails is written by a retry, without
+        # waiting for another checkpoint or a shutdown
+        async with Database(path) as db:
+            busy = Busy(db, 2)
+            store = SessionStore(busy, delay=0.01)  # type: ignore
+            log.disabled = True
+            try:
+                (results, _) = await play(1000, store)
+                deadline = time.monotonic() + 5
+                while (
+                    busy.failures
+                    or store.failures
+                    or store._pending
+                    or store._timer is not None
+                    or store._lock.locked()
+                ):
+                    assert time.monotonic() < deadline, "not retried"
+                    await asyncio.sleep(0.01)
+            finally:
+                log.disabled = False
+            assert busy.failures == 0 and store.failures == 0
+            async with db.read() as conn:
+                async with conn.execute(
+                    "SELECT player, score FROM results WHERE game = ("
+                    "SELECT max(game) FROM results)"
+                ) as cursor:
+                    assert dict(await cursor.fetchall()) == results
+        print("a finished game was written after 2 failed writes, by retries")
+
+    async def main():
+        rng = random.Random(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "database.sqlite3"
+            async with Database(path) as db:
+                await migrate(db)
+            lost = []
+            for seed in range(60):
+                (expected, asked) = await play(seed)
+                crash_at = rng.randint(1, asked)
+                (results, saved) = await crash_and_resume(path, seed, crash_at)
+                assert results == expected, (seed, crash_at, results, expected)
+                lost.append(crash_at - saved.drawn)
+            print(
+                "60 games crashed at a random question and resumed with the same "
+                f"scores, asking {statistics.mean(lost):.1f} questions again on average"
+            )
+
+            async with Database(path) as db:
+                started = time.perf_counter()
+                await asyncio.gather(*(play(seed) for seed in range(300)))
+                bare = time.perf_counter() - started
+
+                store = SessionStore(db, delay=0.05)
+                started = time.perf_counter()
+                await asyncio.gather(*(play(seed, store) for seed in range(300)))
+                await store.close()
+                checkpointed = time.perf_counter() - started
+                assert await store.interrupted() == []
+                async with db.read() as conn:
+                    async with conn.execute(
+                        "SELECT COUNT(DISTINCT game) FROM results"
+                    ) as cursor:
+                        assert (await cursor.fetchone()) == (360,)
+            print(
+                f"300 concurrent games: {store.saved} checkpoints, "
+                f"{store.written} written in {store.transactions} transactions; "
+                f"{bare:.2f}s without checkpoints, {checkpointed:.2f}s with"
+            )
+            await retry(path)
+
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""
+Process-wide cache of parsed question decks.
+
+Decks are keyed by pack ID and evicted least-recently-used first once their
+estimated size exceeds the budget. Games drawing from all packs sample the bank
+instead (see utils/rounds/sampling.py), as it is too large to hold as a deck.
+"""
+import asyncio
+import sys
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from utils.rounds.start import StartQuestion
+
+Deck = tuple[StartQuestion, ...]
+DeckLoader = Callable[[int], Awaitable[list[StartQuestion]]]
+
+DEFAULT_BUDGET = 32 * 1024 * 1024  # 32 MiB
+
+
+def deck_size(deck: Deck) -> int:
+    """Rough number of bytes held by a deck."""
+    size = sys.getsizeof(deck)
+    for question in deck:
+        size += sys.getsizeof(question) + sys.getsizeof(question.__dict__)
+        size += sys.getsizeof(question.question) + sys.getsizeof(question.answer)
+        if question.image_url is not None:
+            size += sys.getsizeof(question.image_url)
+    return size
+
+
+class DeckCache:
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        """
+        Parameters
+        ----------
+        budget: Maximum estimated size of all cached decks, in bytes
+        """
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._decks: OrderedDict[int, tuple[Deck, int]] = OrderedDict()
+        self._loading: dict[int, asyncio.Future[Deck]] = {}
+
+    def __len__(self) -> int:
+        return len(self._decks)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, pack_id: int) -> Optional[Deck]:
+        entry = self._decks.get(pack_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._decks.move_to_end(pack_id)
+        return entry[0]
+
+    def put(self, pack_id: int, deck: Deck):
+        self._discard(pack_id)
+        size = deck_size(deck)
+        if size > self.budget:
+            return
+        self._decks[pack_id] = (deck, size)
+        self.size += size
+        while self.size > self.budget:
+            (_, (_, evicted_size)) = self._decks.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    async def get_or_load(self, pack_id: int, loader: DeckLoader) -> Deck:
+        """
+        Return the cached deck for `pack_id`, loading it with `loader` on a miss.
+
+        Concurrent misses for the same pack share a single load.
+        """
+        if (deck := self.get(pack_id)) is not None:
+            return deck
+        if (pending := self._loading.get(pack_id)) is not None:
+            return await asyncio.shield(pending)
+
+        future = self._loading[pack_id] = asyncio.get_running_loop().create_future()
+        try:
+            deck = tuple(await loader(pack_id))
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # don't warn about it if nobody else was waiting
+            raise
+        else:
+            # a pack invalidated while loading must not have its stale deck cached
+            if self._loading.get(pack_id) is future:
+                self.put(pack_id, deck)
+            future.set_result(deck)
+            return deck
+        finally:
+            if self._loading.get(pack_id) is future:
+                del self._loading[pack_id]
+
+    def invalidate(self, pack_id: int):
+        """Drop the deck of a pack."""
+        self._discard(pack_id)
+        self._loading.pop(pack_id, None)
+
+    def clear(self):
+        self._decks.clear()
+        self._loading.clear()
+        self.size = 0
+
+    def _discard(self, pack_id: int):
+        entry = self._decks.pop(pack_id, None)
+        if entry is not None:
+            self.size -= entry[1]
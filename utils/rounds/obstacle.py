@@ -1,19 +1,39 @@
-from PIL import Image, ImageDraw, ImageFont
+import asyncio
+import functools
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
 
 from bot import BOT_DIR
 
+if TYPE_CHECKING:
+    # Pillow is imported on first use, it is slow to import and only games
+    # with an obstacle round need it
+    from PIL import Image, ImageFont
+
 options = {
     "fill": "#0000ff",
     "outline": "#00ff00",
     "width": 2,
 }
 
+SECTIONS = ("q1", "q2", "q3", "q4", "qtt")
+ALL_STATES = range(1 << len(SECTIONS))  # every combination of covered sections
+DEFAULT_BUDGET = 64 * 1024 * 1024  # 64 MiB
+# favour encoding speed, every obstacle is encoded 32 times
+ENCODE_OPTIONS = {"PNG": {"compress_level": 3}, "WEBP": {"method": 0}}
+
+
+@functools.cache
+def font() -> "ImageFont.FreeTypeFont":
+    from PIL import ImageFont
 
-font = ImageFont.truetype(str(BOT_DIR / "resources" / "arial.ttf"), 70)
+    return ImageFont.truetype(str(BOT_DIR / "resources" / "arial.ttf"), 70)
 
 
 def draw_obstacle_overlay(
-    im: Image.Image,
+    im: "Image.Image",
     q1: bool = True,
     q2: bool = True,
     q3: bool = True,
@@ -41,25 +61,233 @@ def draw_obstacle_overlay(
     │ 3       │      4 │
     └─────────┴────────┘
     """
+    from PIL import ImageDraw
+
     draw = ImageDraw.Draw(im)
     vh = im.height
     vw = im.width
 
     if q1:
         draw.rectangle((0.0, 0.0, 0.5 * vw, 0.5 * vh), **options)  # cnv1
-        draw.text((0.075 * vw, 0.075 * vh), "1", font=font)
+        draw.text((0.075 * vw, 0.075 * vh), "1", font=font())
 
     if q2:
         draw.rectangle((0.5 * vw, 0, vw, 0.5 * vw), **options)  # cnv2
-        draw.text((0.85 * vw, 0.075 * vh), "2", font=font)
+        draw.text((0.85 * vw, 0.075 * vh), "2", font=font())
 
     if q3:
         draw.rectangle((0.0, 0.5 * vh, 0.5 * vw, im.height), **options)  # cnv3
-        draw.text((0.075 * vw, 0.76 * vh), "3", font=font)
+        draw.text((0.075 * vw, 0.76 * vh), "3", font=font())
 
     if q4:
         draw.rectangle((0.5 * vw, 0.5 * vh, vw, vh), **options)  # cnv4
-        draw.text((0.85 * vw, 0.76 * vh), "4", font=font)
+        draw.text((0.85 * vw, 0.76 * vh), "4", font=font())
 
     if qtt:
         draw.rectangle((0.25 * vw, 0.25 * vh, 0.75 * vw, 0.75 * vh), **options)
+
+
+def overlay_state(
+    q1: bool = True,
+    q2: bool = True,
+    q3: bool = True,
+    q4: bool = True,
+    qtt: bool = True,
+) -> int:
+    """Pack the covered sections into a number, bit 0 being q1 and bit 4 qtt."""
+    return q1 | q2 << 1 | q3 << 2 | q4 << 3 | qtt << 4
+
+
+def _render(im: "Image.Image", state: int, format: str) -> bytes:
+    im = im.copy()
+    draw_obstacle_overlay(
+        im,
+        **{section: bool(state >> bit & 1) for (bit, section) in enumerate(SECTIONS)},
+    )
+    fp = io.BytesIO()
+    im.save(fp, format, **ENCODE_OPTIONS.get(format.upper(), {}))
+    return fp.getvalue()
+
+
+def _decode(source: bytes) -> "Image.Image":
+    from PIL import Image
+
+    with Image.open(io.BytesIO(source)) as im:
+        return im.convert("RGB")
+
+
+class ObstacleRenderer:
+    def __init__(
+        self,
+        budget: int = DEFAULT_BUDGET,
+        format: str = "PNG",
+        workers: Optional[int] = None,
+    ):
+        """
+        Renders obstacle images with every possible overlay, caching the encoded results.
+
+        Parameters
+        ----------
+        budget: Maximum number of bytes of encoded images to keep
+        format: Image format to encode to (PNG or WEBP)
+        workers: Number of rendering threads (default chosen by ThreadPoolExecutor)
+        """
+        self.budget = budget
+        self.format = format
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._images: OrderedDict[tuple[int, int], bytes] = OrderedDict()
+        self._preparing: dict[int, asyncio.Future[None]] = {}
+
+    async def render(self, obstacle_id: int, source: bytes, state: int) -> bytes:
+        """
+        The obstacle image with the sections in `state` covered (see `overlay_state`).
+
+        Parameters
+        ----------
+        obstacle_id: ID of the obstacle
+        source: Contents of the obstacle's image file, decoded only if nothing is cached
+        state: Covered sections
+        """
+        key = (obstacle_id, state)
+        if (image := self._images.get(key)) is not None:
+            self.hits += 1
+            self._images.move_to_end(key)
+            return image
+
+        self.misses += 1
+        await self.prepare(obstacle_id, source)
+        if (image := self._images.get(key)) is not None:
+            return image
+        # doesn't fit in the budget, render it without caching
+        im = await self._run(_decode, source)
+        return await self._run(_render, im, state, self.format)
+
+    async def prepare(self, obstacle_id: int, source: bytes):
+        """Decode an obstacle image once and render all of its overlays into the cache."""
+        if (pending := self._preparing.get(obstacle_id)) is not None:
+            return await asyncio.shield(pending)
+
+        future = self._preparing[
+            obstacle_id
+        ] = asyncio.get_running_loop().create_future()
+        try:
+            im = await self._run(_decode, source)
+            images = await asyncio.gather(
+                *(self._run(_render, im, state, self.format) for state in ALL_STATES)
+            )
+            for (state, image) in zip(ALL_STATES, images):
+                self._put((obstacle_id, state), image)
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._preparing[obstacle_id]
+
+    def invalidate(self, obstacle_id: int):
+        for state in ALL_STATES:
+            if (image := self._images.pop((obstacle_id, state), None)) is not None:
+                self.size -= len(image)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _put(self, key: tuple[int, int], image: bytes):
+        if len(image) > self.budget:
+            return
+        if (old := self._images.pop(key, None)) is not None:
+            self.size -= len(old)
+        self._images[key] = image
+        self.size += len(image)
+        while self.size > self.budget:
+            (_, evicted) = self._images.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self._workers, thread_name_prefix="obstacle-renderer"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+
+if __name__ == "__main__":
+    # Self-check and benchmark: cached renders match drawing directly, and
+    # revealing a tile is a cache lookup instead of a redraw + encode.
+    import time
+
+    from PIL import Image
+
+    def sample_image(seed: int) -> bytes:
+        im = Image.radial_gradient("L").resize((1280, 720)).convert("RGB")
+        im.paste((seed * 37 % 256, 80, 160), (0, 0, 64, 64))
+        fp = io.BytesIO()
+        im.save(fp, "JPEG")
+        return fp.getvalue()
+
+    def direct(source: bytes, state: int) -> bytes:
+        return _render(_decode(source), state, "PNG")
+
+    async def main():
+        sources = {obstacle_id: sample_image(obstacle_id) for obstacle_id in range(4)}
+        renderer = ObstacleRenderer()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(renderer.prepare(i, s) for (i, s) in sources.items()))
+        prepared = time.perf_counter() - started
+        print(
+            f"prepared {len(sources)} obstacles x {len(ALL_STATES)} states "
+            f"in {prepared * 1000:.0f} ms, {renderer.size / 1024 / 1024:.1f} MiB cached"
+        )
+
+        for state in (overlay_state(), 0, overlay_state(q2=False, qtt=False)):
+            assert await renderer.render(0, sources[0], state) == direct(
+                sources[0], state
+            )
+
+        started = time.perf_counter()
+        for state in ALL_STATES:
+            direct(sources[1], state)
+        uncached = (time.perf_counter() - started) / len(ALL_STATES)
+
+        started = time.perf_counter()
+        for _ in range(100):
+            for state in ALL_STATES:
+                await renderer.render(1, sources[1], state)
+        cached = (time.perf_counter() - started) / (100 * len(ALL_STATES))
+        print(
+            f"reveal: draw + encode {uncached * 1000:.1f} ms, "
+            f"cached {cached * 1_000_000:.1f} µs "
+            f"(hits {renderer.hits}, misses {renderer.misses})"
+        )
+
+        # a budget fitting one obstacle evicts the least recently used ones
+        small = ObstacleRenderer(budget=renderer.size // len(sources) + 1)
+        await small.render(0, sources[0], 0)
+        await small.render(1, sources[1], 0)
+        assert small.evictions == len(ALL_STATES) and small.size <= small.budget
+        await small.render(0, sources[0], 0)
+        assert small.misses == 3
+
+        # concurrent misses on the same obstacle decode and render it once
+        fresh = ObstacleRenderer()
+        await asyncio.gather(*(fresh.render(2, sources[2], s) for s in ALL_STATES))
+        assert len(fresh._images) == len(ALL_STATES)
+        fresh.invalidate(2)
+        assert fresh.size == 0
+
+        for r in (renderer, small, fresh):
+            r.close()
+
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+"""
+Routing of chat messages to the games waiting for answers.
+
+Every game registers an `AnswerInbox` for its channel with the bot's
+`AnswerRouter`. Incoming messages are looked up by channel ID, so messages from
+channels without a game are dropped with a single dict lookup, no matter how
+many games are running.
+"""
+import asyncio
+import contextlib
+from typing import Collection, Iterator
+
+from discord import Message
+
+
+class ChannelBusy(Exception):
+    """Raised when a game is already running in a channel."""
+
+
+class AnswerInbox:
+    """Answers sent to a game running in a channel."""
+
+    __slots__ = ("channel_id", "players", "queue")
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.players: Collection[int] = ()  # IDs of players currently allowed to answer
+        self.queue: asyncio.Queue[Message] = asyncio.Queue()
+
+    def clear(self):
+        """Discard answers that have not been read yet."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class AnswerRouter:
+    def __init__(self):
+        self._inboxes: dict[int, AnswerInbox] = {}
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._inboxes
+
+    def __len__(self) -> int:
+        return len(self._inboxes)
+
+    @contextlib.contextmanager
+    def listen(self, channel_id: int) -> Iterator[AnswerInbox]:
+        """
+        Receive answers sent in a channel for the duration of the `with` block.
+
+        Raises
+        ------
+        ChannelBusy: Another game is already listening in this channel
+        """
+        if channel_id in self._inboxes:
+            raise ChannelBusy(channel_id)
+        inbox = self._inboxes[channel_id] = AnswerInbox(channel_id)
+        try:
+            yield inbox
+        finally:
+            del self._inboxes[channel_id]
+
+    def dispatch(self, message: Message) -> bool:
+        """Deliver a message to the game in its channel. Returns whether it was delivered."""
+        inbox = self._inboxes.get(message.channel.id)
+        if inbox is None or message.author.id not in inbox.players:
+            return False
+        inbox.queue.put_nowait(message)
+        return True
+
+
+if __name__ == "__main__":
+    # Load test: per-message dispatch cost while 1 to 10000 games are running.
+    # 99% of messages come from channels without a game.
+    import timeit
+    from types import SimpleNamespace
+
+    def fake_message(channel_id: int, author_id: int):
+        return SimpleNamespace(
+            channel=SimpleNamespace(id=channel_id),
+            author=SimpleNamespace(id=author_id),
+        )
+
+    async def main():
+        for games in (1, 10, 100, 1000, 10000):
+            router = AnswerRouter()
+            with contextlib.ExitStack() as stack:
+                for channel_id in range(games):
+                    inbox = stack.enter_context(router.listen(channel_id))
+                    inbox.players = {channel_id}
+                messages = [
+                    fake_message(x % games, x % games)
+                    if x % 100 == 0
+                    else fake_message(games + x, x)
+                    for x in range(100000)
+                ]
+                elapsed = timeit.timeit(
+                    lambda: [router.dispatch(m) for m in messages], number=5  # type: ignore
+                )
+                print(
+                    f"{games:>6} games: {elapsed / 5 / len(messages) * 1e9:.0f} ns/message"
+                )
+
+    asyncio.run(main())
@@ -0,0 +1,193 @@
+"""
+Random sampling of questions without loading whole tables.
+
+Questions are picked by drawing random IDs between the smallest and largest ID
+of the requested bucket (pack, round, score...) and seeking to the first
+question at or after each of them through the bucket's index. Every probe is an
+index seek, so the cost depends on the sample size rather than the table size.
+
+Questions that follow a gap in the IDs (e.g. after a deleted pack) are slightly
+more likely to be picked than others.
+"""
+import random
+from typing import Any, Optional
+
+import aiosqlite
+
+from utils.rounds.start import StartQuestion
+
+# columns each table can be filtered on, indexed by migration 0002
+BUCKET_COLUMNS = {
+    "starting": ("pack_id", "round"),
+    "finish": ("pack_id", "rnd", "score"),
+    "chp": ("pack_id",),
+    "obstacle": ("pack_id",),
+    "acceleration": ("pack_id",),
+}
+
+PROBE_ROUNDS = 3  # batches of random probes before falling back to a plain query
+
+
+async def sample_rows(
+    db: aiosqlite.Connection,
+    table: str,
+    n: int,
+    columns: str = "*",
+    rng: Optional[random.Random] = None,
+    **bucket: Any,
+) -> list[tuple]:
+    """
+    Pick up to `n` distinct random rows from `table`.
+
+    Parameters
+    ----------
+    db: Database connection
+    table: Table to sample from (one of `BUCKET_COLUMNS`)
+    n: Number of rows to pick
+
+    Optional parameters
+    -------------------
+    columns: Columns to select (default all)
+    rng: Random number generator to use (default the `random` module)
+    bucket: Only pick rows with these column values, e.g. pack_id=1, round=2.
+        None values are ignored.
+
+    Returns
+    -------
+    The picked rows in random order. Fewer than `n` rows are returned only if the
+    bucket does not have `n` rows.
+    """
+    rng = rng or random.Random()
+    filters = {k: v for (k, v) in bucket.items() if v is not None}
+    if unknown := set(filters) - set(BUCKET_COLUMNS[table]):
+        raise ValueError(f"cannot sample {table} by {', '.join(unknown)}")
+    where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+    params = tuple(filters.values())
+
+    bounds = []
+    for order in ("ASC", "DESC"):
+        async with db.execute(
+            f"SELECT id FROM {table} WHERE {where} ORDER BY id {order} LIMIT 1",
+            params,
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return []
+        bounds.append(row[0])
+    (lo, hi) = bounds
+
+    picked: set[int] = set()
+    for _ in range(PROBE_ROUNDS):
+        missing = n - len(picked)
+        if missing <= 0:
+            break
+        probes = [rng.randint(lo, hi) for _ in range(missing * 2)]
+        async with db.execute(
+            f"WITH probes(id) AS (VALUES {', '.join('(?)' for _ in probes)}) "
+            f"SELECT (SELECT id FROM {table} WHERE {where} AND id >= probes.id "
+            f"ORDER BY id LIMIT 1) FROM probes",
+            (*probes, *params),
+        ) as cursor:
+            for (found,) in await cursor.fetchall():
+                if found is not None and len(picked) < n:
+                    picked.add(found)
+
+    if len(picked) < n:
+        # small bucket, or most of it already picked: fill up with a plain query
+        exclude = f"AND id NOT IN ({', '.join('?' for _ in picked)})" if picked else ""
+        async with db.execute(
+            f"SELECT id FROM {table} WHERE {where} {exclude} LIMIT ?",
+            (*params, *picked, n - len(picked)),
+        ) as cursor:
+            picked.update(row[0] for row in await cursor.fetchall())
+
+    ids = list(picked)
+    rng.shuffle(ids)
+    async with db.execute(
+        f"SELECT id, {columns} FROM {table} "
+        f"WHERE id IN ({', '.join('?' for _ in ids)})",
+        ids,
+    ) as cursor:
+        rows = {row[0]: tuple(row[1:]) for row in await cursor.fetchall()}
+    return [rows[id] for id in ids if id in rows]
+
+
+async def sample_start_questions(
+    db: aiosqlite.Connection,
+    n: int,
+    pack_id: Optional[int] = None,
+    rnd: Optional[int] = None,
+) -> list[StartQuestion]:
+    """Pick up to `n` random Khởi động questions, optionally from one pack and/or round."""
+    rows = await sample_rows(
+        db,
+        "starting",
+        n,
+        "round, question, answer, image_url",
+        pack_id=pack_id,
+        round=rnd,
+    )
+    return [StartQuestion(*row) for row in rows]
+
+
+if __name__ == "__main__":
+    # Benchmark: sampling cost on synthetic banks of 10k to 1M questions,
+    # against ORDER BY RANDOM().
+    import asyncio
+    import sqlite3
+    import tempfile
+    import time
+    from pathlib import Path
+
+    from utils.migrations import migrate_sync
+
+    def build(path: Path, count: int):
+        conn = sqlite3.connect(path)
+        migrate_sync(conn)
+        conn.executemany(
+            "INSERT INTO starting(pack_id, round, question, answer, image_url) VALUES(?, ?, ?, ?, ?)",
+            (
+                (x // 45, x % 3 + 1, f"Câu hỏi số {x}?", f"đáp án {x}", None)
+                for x in range(count)
+            ),
+        )
+        conn.commit()
+        conn.close()
+
+    async def timed(coro_factory, repeat: int) -> float:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            await coro_factory()
+        return (time.perf_counter() - started) / repeat * 1000
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            for count in (10_000, 100_000, 1_000_000):
+                path = Path(tmp) / f"{count}.sqlite3"
+                build(path, count)
+                async with aiosqlite.connect(path) as db:
+                    sampled = await timed(lambda: sample_start_questions(db, 40), 50)
+                    bucket = await timed(
+                        lambda: sample_start_questions(db, 10, pack_id=7, rnd=2), 50
+                    )
+
+                    async def order_by_random():
+                        async with db.execute(
+                            "SELECT * FROM starting ORDER BY RANDOM() LIMIT 40"
+                        ) as cursor:
+                            await cursor.fetchall()
+
+                    baseline = await timed(order_by_random, 5)
+                    assert len(await sample_start_questions(db, 40)) == 40
+                    assert len(await sample_start_questions(db, 40, pack_id=7)) == 40
+                    assert (
+                        len(await sample_start_questions(db, 40, pack_id=7, rnd=2))
+                        == 15
+                    )
+                print(
+                    f"{count:>9} questions: sample 40 {sampled:.2f} ms, "
+                    f"pack/round bucket {bucket:.2f} ms, "
+                    f"ORDER BY RANDOM() {baseline:.2f} ms"
+                )
+
+    asyncio.run(main())
@@ -0,0 +1,609 @@
+"""
+Transport-agnostic engine for Khởi động games.
+
+A `GameSession` runs the rounds of one game: it reads answers from an
+`AnswerInbox`, reports everything that happens to a `SessionSink` and measures
+time with a `Clock`. The Discord cog provides a sink that renders embeds; tests
+and benchmarks can use a fake sink and a `VirtualClock` to run many sessions at
+full speed without Discord.
+
+When several players can answer, the first answer to arrive isn't necessarily
+the first one sent: gateway and event loop jitter can swap answers sent
+milliseconds apart. The session waits `grace` seconds after the first one for
+others, and the earliest by Discord's creation time, read from the message's
+snowflake ID, takes the question. Each answer's latency is measured the same
+way, from the snowflake of the question's message to the answer's.
+
+A game is a sequence of stages, the turns of O21 or the rounds of O22/O23. At
+every question boundary, the session hands its progress to its `Checkpoints`
+(see utils/rounds/checkpoint.py), and a session restored with that progress
+carries on from the same question.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from enum import Enum
+from typing import Any, Awaitable, Callable, Optional, Protocol, TypeVar
+
+from utils import metrics, tracing
+from utils.rounds.router import AnswerInbox
+from utils.rounds.start import LastQuestionState, StartQuestion, rulesets
+
+T = TypeVar("T")
+
+INTERMISSION = 5  # seconds between announcing a turn/round and its first question
+GRACE = 0.25  # seconds to wait for answers sent about as early as the first one
+
+
+def created_ms(message: Any) -> Optional[int]:
+    """When Discord created a message, in ms since the Discord epoch, from its snowflake ID."""
+    id = getattr(message, "id", None)
+    return None if id is None else id >> 22
+
+
+class SessionState(Enum):
+    Created = 1
+    Intermission = 2
+    Question = 3
+    Finished = 4
+
+
+class Clock(Protocol):
+    def time(self) -> float:
+        ...
+
+    async def sleep(self, delay: float) -> None:
+        ...
+
+    async def wait_for(self, aw: Awaitable[T], timeout: Optional[float]) -> T:
+        ...
+
+
+class LoopClock:
+    """Real time, read from the event loop's monotonic clock."""
+
+    def time(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    async def sleep(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+    async def wait_for(self, aw: Awaitable[T], timeout: Optional[float]) -> T:
+        return await asyncio.wait_for(aw, timeout)
+
+
+class VirtualClock:
+    """
+    Simulated time that jumps straight to the next scheduled event or deadline.
+
+    Callbacks scheduled with `call_later` (e.g. a fake player answering) run
+    when the session waits past their due time.
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+        self._events: list[tuple[float, int, Callable[[], Any]]] = []
+        self._seq = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def call_later(self, delay: float, callback: Callable[[], Any]):
+        heapq.heappush(self._events, (self.now + delay, next(self._seq), callback))
+
+    async def sleep(self, delay: float) -> None:
+        deadline = self.now + delay
+        while self._events and self._events[0][0] <= deadline:
+            (self.now, _, callback) = heapq.heappop(self._events)
+            callback()
+        self.now = deadline
+        await asyncio.sleep(0)
+
+    async def wait_for(self, aw: Awaitable[T], timeout: Optional[float]) -> T:
+        deadline = None if timeout is None else self.now + timeout
+        task = asyncio.ensure_future(aw)
+        try:
+            while True:
+                for _ in range(3):  # let the awaitable pick up what callbacks produced
+                    await asyncio.sleep(0)
+                if task.done():
+                    return task.result()
+                if self._events and (
+                    deadline is None or self._events[0][0] <= deadline
+                ):
+                    (self.now, _, callback) = heapq.heappop(self._events)
+                    callback()
+                    continue
+                if deadline is None:
+                    raise RuntimeError("waiting forever on a virtual clock")
+                self.now = deadline
+                raise asyncio.TimeoutError
+        finally:
+            task.cancel()
+
+
+class Checkpoints(Protocol):
+    def save(self, session: "GameSession") -> None:
+        """Remember the progress of `session`, at a question boundary or at its end."""
+
+
+class SessionSink(Protocol):
+    """Receives everything a `GameSession` shows to its players."""
+
+    async def single_player(self) -> None:
+        """Only one player joined, so O21 rules are used."""
+
+    async def turn_started(self, name: str, delay: float) -> None:
+        """An O21 turn for player `name` starts in `delay` seconds."""
+
+    async def round_started(
+        self, ruleset: str, rnd: int, rules: dict[str, Any], delay: float
+    ) -> None:
+        """Round `rnd` of an O22/O23 game starts in `delay` seconds."""
+
+    async def question(
+        self,
+        number: int,
+        question: StartQuestion,
+        remaining: Optional[float],
+        last_state: LastQuestionState,
+        last_answer: Optional[str],
+        scores: dict[int, int],
+        players: dict[int, str],
+    ) -> Any:
+        """
+        Show a question. `remaining` is the time left in the round, if it is timed.
+
+        Returns the message showing it, if any, to measure answer latencies from.
+        """
+
+    async def round_ended(self, last_answer: Optional[str]) -> None:
+        """A round (or turn) ran out of time or questions."""
+
+    async def turn_ended(self, name: str, score: int) -> None:
+        """Player `name` finished their O21 turn."""
+
+    async def results(
+        self, players: dict[int, str], results: dict[int, int], rnd: Optional[int]
+    ) -> None:
+        """Show the scores after round `rnd`, or the final scores if `rnd` is None."""
+
+
+def display_answer(answer: str) -> str:
+    """The answer to show players once a question is over."""
+    if "~|" in answer:
+        return answer.split("~|")[0]
+    return answer.translate(str.maketrans("", "", "~>+"))
+
+
+class GameSession:
+    def __init__(
+        self,
+        ruleset: str,
+        players: dict[int, str],
+        questions: list[StartQuestion],
+        inbox: AnswerInbox,
+        sink: SessionSink,
+        clock: Optional[Clock] = None,
+        checkpoints: Optional[Checkpoints] = None,
+        grace: float = GRACE,
+    ):
+        """
+        A Khởi động game between `players`.
+
+        Parameters
+        ----------
+        ruleset: One of o21, o22, o23 (O21 is used if there is a single player)
+        players: Mapping of player IDs to display names
+        questions: Questions to draw from, in order. Used questions are removed from the list.
+        inbox: Answers sent by the players
+        sink: Where to show questions and results
+
+        Optional parameters
+        -------------------
+        clock: Source of time (default `LoopClock`)
+        checkpoints: Where to save the progress of the game, once it has an `id`
+        grace: Seconds to wait, after the first answer to a question in a round
+            with several players, for answers sent before it (default 0.25)
+        """
+        self.ruleset = ruleset
+        self.players = players
+        self.questions = questions
+        self.inbox = inbox
+        self.sink = sink
+        self.clock: Clock = clock or LoopClock()
+        self.checkpoints = checkpoints
+        self.grace = grace
+        # player ID: latencies of their answers in ms, from the question to the answer
+        self.latencies: dict[int, list[int]] = {player: [] for player in players}
+        self.id: Optional[int] = None  # set once stored, see `SessionStore.create`
+        self.state = SessionState.Created
+        self.results: dict[int, int] = {player: 0 for player in players}
+        # progress, restored from a checkpoint to resume a game
+        self.stage = 0  # O21 turn or O22/O23 round being played, from 0
+        self.number = 0  # questions asked in the stage
+        self.drawn = 0  # questions popped from `questions`
+        self.remaining: Optional[float] = None  # time left in a timed stage
+
+    def _checkpoint(self):
+        if self.checkpoints is not None and self.id is not None:
+            self.checkpoints.save(self)
+
+    def _next_stage(self):
+        (self.stage, self.number, self.remaining) = (self.stage + 1, 0, None)
+        self._checkpoint()
+
+    async def run(self) -> dict[int, int]:
+        """Play the whole game, or what is left of it, and return the final results."""
+        if len(self.players) < 2:
+            if self.stage == 0:
+                if self.ruleset != "o21":
+                    await self.sink.single_player()
+                await self.play_round(self.players, **rulesets["o21"])
+                self._next_stage()
+        elif self.ruleset == "o21":
+            for (stage, (id, name)) in enumerate(self.players.items()):
+                if stage < self.stage:
+                    continue
+                self.state = SessionState.Intermission
+                await self.sink.turn_started(name, INTERMISSION)
+                await self.clock.sleep(INTERMISSION)
+                await self.play_round({id: name}, **rulesets["o21"])
+                await self.sink.turn_ended(name, self.results[id])
+                self._next_stage()
+        elif self.ruleset in ("o22", "o23"):
+            for rnd in range(self.stage + 1, 4):
+                rules = rulesets[f"{self.ruleset}_{rnd}"]
+                self.state = SessionState.Intermission
+                await self.sink.round_started(self.ruleset, rnd, rules, INTERMISSION)
+                await self.clock.sleep(INTERMISSION)
+                await self.play_round(self.players, **rules)
+                await self.sink.results(self.players, self.results, rnd)
+                self._next_stage()
+
+        self.state = SessionState.Finished
+        await self.sink.results(self.players, self.results, None)
+        # after the results: a game interrupted before showing them is resumed
+        self._checkpoint()
+        return self.results
+
+    async def play_round(
+        self,
+        players: dict[int, str],
+        limit_time: Optional[float] = None,
+        limit_count: int = -1,
+        correct_awarded: int = 10,
+        incorrect_deducted: int = 5,
+        timeout: Optional[int] = 10,
+        tolerance: Optional[int] = None,
+    ):
+        """
+        Play a Starting round, updating `self.results`. A round being resumed
+        goes on from question `self.number`, with `self.remaining` seconds left.
+
+        Parameters
+        ----------
+        players: Only allow player(s) with given ID(s) to answer the questions (single for O20/21, multi for O22+)
+
+        Optional parameters
+        -------------------
+        limit_time: Limit this starting round by time length in seconds
+        limit_count: Limit this starting round by number of questions (O20, O23)
+        correct_awarded: Award this much on answering correctly
+        incorrect_deducted: Deduct this much on answering incorrectly
+        timeout: Number of seconds to wait before moving on to next question
+        tolerance: Accept answers with missing diacritics and up to this many typos (exact matching if None)
+        """
+        end_time: Optional[float] = None
+        lqstate: LastQuestionState = LastQuestionState.Unknown
+        lqanswer: Optional[str] = None
+        if self.remaining is not None:
+            end_time = self.clock.time() + self.remaining
+        elif limit_time:
+            end_time = self.clock.time() + limit_time
+        self.inbox.players = players
+
+        judge_seconds = metrics.JUDGE_SECONDS.labels(
+            "exact" if tolerance is None else "tolerant"
+        )
+        last_question: Optional[float] = None
+
+        while self.questions and self.number != limit_count:
+            remaining = end_time - self.clock.time() if end_time is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            self.remaining = remaining
+            # the scores of the previous question are in, a question is about to start
+            self._checkpoint()
+
+            question = self.questions.pop(0)
+            self.drawn += 1
+            self.number += 1
+            self.state = SessionState.Question
+            self.inbox.clear()
+            now = self.clock.time()
+            if last_question is not None:
+                metrics.QUESTION_GAP_SECONDS.observe(now - last_question)
+            last_question = now
+            # its own trace: a game outlasts the command that started it
+            with tracing.trace(
+                "question",
+                keep=tracing.recent_questions,
+                game=self.id,
+                number=self.number,
+            ):
+                shown = await self.sink.question(
+                    self.number,
+                    question,
+                    remaining,
+                    lqstate,
+                    lqanswer,
+                    {player: self.results[player] for player in players},
+                    players,
+                )
+
+            if remaining is not None and timeout:
+                to = min(remaining, timeout)
+            elif remaining is not None:
+                to = remaining
+            else:
+                to = timeout
+
+            asked = self.clock.time()
+            try:
+                first = await self.clock.wait_for(self.inbox.queue.get(), to)
+                ((msg, latency), *beaten) = await self._buzz_in(
+                    first, players, shown, asked, to
+                )
+                started = time.perf_counter()
+                correct = question.matcher.match(msg.content, tolerance)
+                judge_seconds.observe(time.perf_counter() - started)
+                if correct:
+                    self.results[msg.author.id] += correct_awarded
+                    lqstate = LastQuestionState.Correct
+                    metrics.ANSWERS.labels("correct").inc()
+                else:
+                    self.results[msg.author.id] -= incorrect_deducted
+                    lqstate = LastQuestionState.Incorrect
+                    metrics.ANSWERS.labels("incorrect").inc()
+                self._record_latency(msg, latency, lqstate.name.lower())
+                for (other, late) in beaten:
+                    self._record_latency(other, late, "beaten")
+            except asyncio.TimeoutError:
+                lqstate = LastQuestionState.Timeout
+                metrics.ANSWERS.labels("timeout").inc()
+            lqanswer = display_answer(question.answer)
+
+        self.state = SessionState.Intermission
+        await self.sink.round_ended(lqanswer)
+
+    async def _buzz_in(
+        self,
+        first: Any,
+        players: dict[int, str],
+        shown: Any,
+        asked: float,
+        timeout: Optional[float],
+    ) -> list[tuple[Any, int]]:
+        """
+        The answers to a question sent about as early as `first`, the first one
+        to arrive, earliest first, with their latency in ms.
+
+        With several players, waits `grace` seconds for the others, but not past
+        the question's `timeout`, keeps the first answer of each player, and
+        orders them by Discord's creation time, or by arrival without it (fake
+        transports). Answers sent after the timeout are left out; raises
+        `asyncio.TimeoutError` if that leaves none.
+        """
+        arrived = [(first, self.clock.time())]
+        grace = self.grace
+        if timeout is not None:
+            grace = min(grace, asked + timeout - self.clock.time())
+        if len(players) > 1 and grace > 0:
+            await self.clock.sleep(grace)
+            now = self.clock.time()
+            while not self.inbox.queue.empty():
+                arrived.append((self.inbox.queue.get_nowait(), now))
+
+        candidates: dict[int, tuple[Any, int]] = {}
+        for (message, arrival) in sorted(
+            arrived, key=lambda entry: created_ms(entry[0]) or 0
+        ):
+            if message.author.id in candidates:
+                continue
+            (sent, question) = (created_ms(message), created_ms(shown))
+            if sent is not None and question is not None:
+                latency = sent - question
+            else:
+                latency = round((arrival - asked) * 1000)
+            if timeout is not None and latency > timeout * 1000:
+                continue  # sent after the deadline, delivered before it
+            candidates[message.author.id] = (message, latency)
+
+        ordered = list(candidates.values())
+        if not ordered:
+            raise asyncio.TimeoutError
+        if len(ordered) > 1:
+            ((winner, _), (runner_up, _)) = ordered[:2]
+            margin = (created_ms(runner_up) or 0) - (created_ms(winner) or 0)
+            metrics.BUZZ_MARGIN_SECONDS.observe(margin / 1000)
+            if winner is not first:
+                # arrived after an answer sent later: the arbitration mattered
+                metrics.BUZZ_REORDERED.inc()
+        return ordered
+
+    def _record_latency(self, message: Any, latency: int, result: str):
+        latency = max(0, latency)
+        self.latencies.setdefault(message.author.id, []).append(latency)
+        metrics.ANSWER_LATENCY_SECONDS.labels(result).observe(latency / 1000)
+
+
+if __name__ == "__main__":
+    # Run many isolated sessions concurrently against a fake transport.
+    import random
+    from types import SimpleNamespace
+
+    class FakeSink:
+        def __init__(self, inbox: AnswerInbox, clock: VirtualClock, rng: random.Random):
+            self.inbox = inbox
+            self.clock = clock
+            self.rng = rng
+            self.questions = 0
+            self.final: Optional[dict[int, int]] = None
+
+        async def single_player(self):
+            pass
+
+        async def turn_started(self, name, delay):
+            pass
+
+        async def round_started(self, ruleset, rnd, rules, delay):
+            pass
+
+        async def question(
+            self, number, question, remaining, last_state, last_answer, scores, players
+        ):
+            self.questions += 1
+            player = self.rng.choice(list(players))
+            content = question.answer if self.rng.random() < 0.5 else "sai"
+            message = SimpleNamespace(
+                author=SimpleNamespace(id=player), content=content
+            )
+            self.clock.call_later(
+                self.rng.uniform(1, 12), lambda: self.inbox.queue.put_nowait(message)
+            )
+
+        async def round_ended(self, last_answer):
+            pass
+
+        async def turn_ended(self, name, score):
+            pass
+
+        async def results(self, players, results, rnd):
+            if rnd is None:
+                self.final = dict(results)
+
+    async def play(seed: int, ruleset: str) -> FakeSink:
+        rng = random.Random(seed)
+        clock = VirtualClock()
+        inbox = AnswerInbox(seed)
+        sink = FakeSink(inbox, clock, rng)
+        players = {x: f"player {x}" for x in range(rng.randint(1, 4))} or {0: "solo"}
+        questions = [StartQuestion(1, f"q{x}", f"đáp án {x}", None) for x in range(80)]
+        session = GameSession(ruleset, players, questions, inbox, sink, clock)
+        results = await session.run()
+        assert session.state is SessionState.Finished
+        assert sink.final == results
+        assert all(score % 5 == 0 for score in results.values())
+        return sink
+
+    class RaceSink(FakeSink):
+        """
+        Player 0 answers 900 ms into each question, player 1 at 950 ms, but
+        player 0's answer is delivered last: at 1100 ms, against 1000 ms.
+        """
+
+        async def question(
+            self, number, question, remaining, last_state, last_answer, scores, players
+        ):
+            self.questions += 1
+            shown = self.clock.time()
+
+            def answer(player: int, sent: float, content: str):
+                id = round((shown + sent) * 1000) << 22
+                message = SimpleNamespace(
+                    id=id, author=SimpleNamespace(id=player), content=content
+                )
+                self.clock.call_later(
+                    sent + (0.2 if player == 0 else 0.05),
+                    lambda: self.inbox.queue.put_nowait(message),
+                )
+
+            answer(0, 0.9, question.answer)
+            answer(1, 0.95, "sai")
+            return SimpleNamespace(id=round(shown * 1000) << 22)
+
+    async def race():
+        clock = VirtualClock()
+        inbox = AnswerInbox(-1)
+        sink = RaceSink(inbox, clock, random.Random(0))
+        questions = [StartQuestion(1, f"q{x}", f"đáp án {x}", None) for x in range(40)]
+        session = GameSession(
+            "o23", {0: "sớm", 1: "muộn"}, questions, inbox, sink, clock
+        )
+        results = await session.run()
+        # the earliest answer is judged, not the first delivered
+        assert results[1] == 0 and results[0] > 0, results
+        assert set(session.latencies[0]) == {900}, session.latencies
+        assert set(session.latencies[1]) == {950}, session.latencies
+        print(f"arbitration: {sink.questions} races won by the earliest answer")
+
+    class DeadlineSink(FakeSink):
+        """
+        Each question message is created 200 ms before the sink returns. Player
+        0 answers 9.7 s in by Discord's clock, delivered at 9.8 s, on every
+        other question; player 1 at 10.05 s, after the 10 s timeout, delivered
+        at 9.9 s.
+        """
+
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.shown: list[tuple[int, float]] = []
+
+        async def question(
+            self, number, question, remaining, last_state, last_answer, scores, players
+        ):
+            self.questions += 1
+            shown = self.clock.time()
+            self.shown.append((number, shown))
+            created = shown - 0.2
+
+            def answer(player: int, sent: float, delivered: float):
+                id = round((created + sent) * 1000) << 22
+                message = SimpleNamespace(
+                    id=id, author=SimpleNamespace(id=player), content=question.answer
+                )
+                self.clock.call_later(
+                    delivered, lambda: self.inbox.queue.put_nowait(message)
+                )
+
+            if number % 2:
+                answer(0, 9.7, 9.8)
+            answer(1, 10.05, 9.9)
+            return SimpleNamespace(id=round(created * 1000) << 22)
+
+    async def deadline():
+        clock = VirtualClock()
+        inbox = AnswerInbox(-2)
+        sink = DeadlineSink(inbox, clock, random.Random(0))
+        questions = [StartQuestion(1, f"q{x}", f"đáp án {x}", None) for x in range(40)]
+        session = GameSession(
+            "o23", {0: "kịp", 1: "trễ"}, questions, inbox, sink, clock
+        )
+        results = await session.run()
+        # the grace period doesn't stretch the question past its timeout
+        gaps = [
+            b - a
+            for ((m, a), (n, b)) in zip(sink.shown, sink.shown[1:])
+            if n == m + 1  # same round
+        ]
+        assert max(gaps) <= 10 + 1e-6, max(gaps)
+        # answers sent after the timeout are not judged, even delivered in time
+        assert results[1] == 0 and not session.latencies[1], session.latencies
+        assert results[0] == 10 * len(session.latencies[0]) > 0, results
+        print(f"deadline: {sink.questions} questions, none longer than the timeout")
+
+    async def main():
+        await race()
+        await deadline()
+        count = 500
+        started = time.perf_counter()
+        sinks = await asyncio.gather(
+            *(play(x, ("o21", "o22", "o23")[x % 3]) for x in range(count))
+        )
+        elapsed = time.perf_counter() - started
+        questions = sum(sink.questions for sink in sinks)
+        print(f"{count} sessions, {questions} questions in {elapsed:.2f}s")
+
+    asyncio.run(main())
@@ -1,7 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Optional
 
+from utils.rounds.answer_matching import CompiledAnswer, compile_answer
+
 
 @dataclass
 class StartQuestion:
@@ -9,6 +11,10 @@ class StartQuestion:
     question: str
     answer: str
     image_url: Optional[str]
+    matcher: CompiledAnswer = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.matcher = compile_answer(self.answer)
 
 
 class LastQuestionState(Enum):
@@ -18,6 +24,9 @@ class LastQuestionState(Enum):
     Timeout = 4
 
 
+# Keyword arguments passed to `GameSession.play_round` for each ruleset (and each
+# round of multi-round rulesets). Add "tolerance": <max typos> to a ruleset to accept
+# answers without diacritics or with small typos, see `utils.rounds.answer_matching`.
 rulesets = {
     "o21": {
         "limit_time": 60,
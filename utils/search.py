@@ -0,0 +1,289 @@
+"""
+Full-text search over the questions and answers of every round.
+
+The contentless FTS5 table `question_search` (migration 0004) finds the rows
+matching every word of a query and ranks them with bm25; only the rows of the
+page being shown are then read from the question tables. Matching ignores case
+and diacritics, so "duong len dinh" finds "Đường lên đỉnh", and words ending
+with * match as prefixes. Queries matching `MAX_RESULTS` questions or more are
+listed newest first instead: scoring hundreds of thousands of rows takes a
+second, and ranking means little for such vague queries. A contentless index
+can't make snippets, so they are cut around the matching words here.
+"""
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+
+import aiosqlite
+
+from utils.database import Database
+
+PER_PAGE = 5
+MAX_RESULTS = 1000  # matches counted, at most MAX_RESULTS / PER_PAGE pages
+SNIPPET_WIDTH = 90  # characters
+
+# rowid of a question in the index: id * 8 + its table number
+KIND_BITS = 3
+KINDS = {
+    1: "Khởi động",
+    2: "Về đích",
+    3: "Câu hỏi phụ",
+    4: "Vượt chướng ngại vật",
+    5: "Tăng tốc",
+}
+_ROWS = {
+    1: "SELECT id, pack_id, question, answer FROM starting WHERE id IN ({})",
+    2: "SELECT id, pack_id, question, answer FROM finish WHERE id IN ({})",
+    3: "SELECT id, pack_id, question, answer FROM chp WHERE id IN ({})",
+    4: (
+        "SELECT q.id, o.pack_id, q.question, q.answer FROM obstacle_questions q "
+        "JOIN obstacle o ON o.id = q.obstacle_id WHERE q.id IN ({})"
+    ),
+    5: "SELECT id, pack_id, question, answer FROM acceleration WHERE id IN ({})",
+}
+WORD = re.compile(r"\w+")
+TERM = re.compile(r"\w+\*?")
+
+
+def fold(text: Any) -> str:
+    """Lowercase `text` and strip its diacritics, đ included, like the index does."""
+    text = unicodedata.normalize("NFD", str(text).replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def words(text: str) -> list[str]:
+    """The search terms of `text`, folded, ending with * if they are prefixes."""
+    return TERM.findall(fold(text))
+
+
+def match_expression(terms: list[str]) -> str:
+    """FTS5 query for rows containing every term."""
+    return " ".join(
+        f'"{term[:-1]}"*' if term.endswith("*") else f'"{term}"' for term in terms
+    )
+
+
+def _matches(word: str, terms: list[str]) -> bool:
+    return any(
+        word.startswith(term[:-1]) if term.endswith("*") else word == term
+        for term in terms
+    )
+
+
+def snippet(text: Any, terms: list[str], width: int = SNIPPET_WIDTH) -> str:
+    """Up to `width` characters of `text` around its first term, with the terms in bold."""
+    text = "" if text is None else str(text)
+    hits = [m for m in WORD.finditer(text) if _matches(fold(m[0]), terms)]
+    start = max(0, hits[0].start() - width // 3) if hits else 0
+    if start:  # don't cut a word
+        start = text.find(" ", start, hits[0].start()) + 1 or start
+    end = min(len(text), start + width)
+    parts = ["…" if start else ""]
+    position = start
+    for hit in hits:
+        if hit.start() < start or hit.end() > end:
+            continue
+        parts += [text[position : hit.start()], f"**{hit[0]}**"]
+        position = hit.end()
+    parts += [text[position:end], "…" if end < len(text) else ""]
+    return "".join(parts)
+
+
+@dataclass
+class SearchHit:
+    kind: int  # key of KINDS
+    id: int
+    pack_id: Optional[int]
+    question: str
+    answer: str
+
+    @property
+    def round(self) -> str:
+        return KINDS[self.kind]
+
+
+@dataclass
+class SearchPage:
+    query: str
+    terms: list[str]
+    hits: list[SearchHit]
+    total: int  # capped at MAX_RESULTS
+    page: int
+    per_page: int = PER_PAGE
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.total // self.per_page))
+
+
+async def load_questions(
+    conn: aiosqlite.Connection, keys: Iterable[int]
+) -> dict[int, SearchHit]:
+    """The questions of `keys` (id * 8 + table number) that still exist, by key."""
+    found: dict[int, SearchHit] = {}
+    by_kind: dict[int, list[int]] = {}
+    for key in keys:
+        by_kind.setdefault(key & ((1 << KIND_BITS) - 1), []).append(key >> KIND_BITS)
+    for (kind, ids) in by_kind.items():
+        sql = _ROWS[kind].format(", ".join("?" * len(ids)))
+        async with conn.execute(sql, ids) as cursor:
+            for (id, pack_id, question, answer) in await cursor.fetchall():
+                found[id << KIND_BITS | kind] = SearchHit(
+                    kind, id, pack_id, question, answer
+                )
+    return found
+
+
+async def search_questions(
+    db: Database, query: str, page: int = 0, per_page: int = PER_PAGE
+) -> SearchPage:
+    """
+    The `page`th page (from 0) of the questions matching every word of `query`, best first.
+
+    Parameters
+    ----------
+    db: Database to search
+    query: Words to look for, in questions or answers, with or without diacritics
+    """
+    terms = words(query)
+    if not terms:
+        return SearchPage(query, terms, [], 0, 0, per_page)
+    expression = match_expression(terms)
+    async with db.read("search_questions") as conn:
+        async with conn.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM question_search "
+            f"WHERE question_search MATCH ? LIMIT {MAX_RESULTS})",
+            (expression,),
+        ) as cursor:
+            (total,) = await cursor.fetchone()  # type: ignore
+        page = max(0, min(page, -(-total // per_page) - 1))
+        order = "rank" if total < MAX_RESULTS else "rowid DESC"
+        async with conn.execute(
+            "SELECT rowid FROM question_search WHERE question_search MATCH ? "
+            f"ORDER BY {order} LIMIT ? OFFSET ?",
+            (expression, per_page, page * per_page),
+        ) as cursor:
+            rowids = [rowid for (rowid,) in await cursor.fetchall()]
+
+        found = await load_questions(conn, rowids)
+    hits = [found[rowid] for rowid in rowids if rowid in found]
+    return SearchPage(query, terms, hits, total, page, per_page)
+
+
+if __name__ == "__main__":
+    # Benchmark: query latency on synthetic banks, FTS5 against LIKE scans.
+    import asyncio
+    import itertools
+    import random
+    import sqlite3
+    import statistics
+    import tempfile
+    import time
+    from pathlib import Path
+
+    from utils.migrations import migrate_sync
+
+    # a vocabulary of made-up two-syllable words with Vietnamese diacritics,
+    # used with Zipf frequencies like the words of real questions
+    ONSETS = "b c ch d đ g gi h k kh l m n ng nh ph qu r s t th tr v x".split()
+    RHYMES = "a à á ả ã ạ ăn ân ên ơn ưa ươ iêng uôn oai ương inh ông ước ai ao".split()
+    RNG = random.Random(0)
+    VOCABULARY = [
+        f"{RNG.choice(ONSETS)}{RNG.choice(RHYMES)}{RNG.choice(ONSETS)}{RNG.choice(RHYMES)}"
+        for _ in range(30_000)
+    ]
+    WEIGHTS = [1 / rank for rank in range(1, len(VOCABULARY) + 1)]
+
+    def sentence(rng: random.Random, length: int) -> str:
+        text = " ".join(rng.choices(VOCABULARY, cum_weights=CUMULATIVE, k=length))
+        return text.capitalize() + "?"
+
+    CUMULATIVE = list(itertools.accumulate(WEIGHTS))
+
+    def build(path: Path, count: int):
+        rng = random.Random(count)
+        conn = sqlite3.connect(path)
+        migrate_sync(conn)
+        conn.executemany(
+            "INSERT INTO starting(pack_id, round, question, answer) VALUES (?, ?, ?, ?)",
+            (
+                (x // 45, x % 3 + 1, sentence(rng, 14), sentence(rng, 2))
+                for x in range(count // 2)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO finish(pack_id, rnd, score, question, answer) VALUES (?, ?, ?, ?, ?)",
+            (
+                (x // 12, 1, 20, sentence(rng, 18), sentence(rng, 3))
+                for x in range(count - count // 2)
+            ),
+        )
+        # one needle, to check that diacritic-free queries find it
+        conn.execute(
+            "INSERT INTO chp(pack_id, question, answer) VALUES (0, ?, ?)",
+            ("Chiếc xuồng ba lá đi qua kênh nào?", "Kênh Đồng Tháp Mười"),
+        )
+        conn.commit()
+        conn.close()
+
+    def like(conn: sqlite3.Connection, query: str) -> int:
+        total = 0
+        for table in (
+            "starting",
+            "finish",
+            "chp",
+            "obstacle_questions",
+            "acceleration",
+        ):
+            clauses = " AND ".join(
+                "(question LIKE ? OR answer LIKE ?)" for _ in query.split()
+            )
+            args = [f"%{word}%" for word in query.split() for _ in range(2)]
+            total += conn.execute(
+                f"SELECT COUNT(*) FROM (SELECT id FROM {table} WHERE {clauses} LIMIT 1000)",
+                args,
+            ).fetchone()[0]
+        return total
+
+    async def main():
+        # a rare phrase, a very common word, two words, a prefix, a rare word
+        queries = (
+            "xuong ba la",
+            fold(VOCABULARY[3]),
+            f"{VOCABULARY[40]} {VOCABULARY[700]}",
+            fold(VOCABULARY[200])[:4] + "*",
+            VOCABULARY[5000],
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            for count in (10_000, 100_000, 1_000_000):
+                path = Path(tmp) / f"{count}.sqlite3"
+                started = time.perf_counter()
+                build(path, count)
+                built = time.perf_counter() - started
+                async with Database(path, readers=1) as db:
+                    page = await search_questions(db, "xuong ba la dong thap")
+                    assert page.hits and page.hits[0].kind == 3, page
+                    print(snippet(page.hits[0].answer, page.terms))
+                    latencies = []
+                    for _ in range(5):
+                        for query in queries:
+                            started = time.perf_counter()
+                            await search_questions(db, query, page=3)
+                            latencies.append((time.perf_counter() - started) * 1000)
+                conn = sqlite3.connect(path)
+                scans = []
+                for _ in range(3):
+                    # a rare phrase: LIMIT 1000 stops early on common words
+                    started = time.perf_counter()
+                    assert like(conn, "xuồng ba lá") == 1
+                    scans.append((time.perf_counter() - started) * 1000)
+                conn.close()
+                latencies.sort()
+                print(
+                    f"{count:>9} questions (built in {built:.1f}s): FTS5 page "
+                    f"p50 {statistics.median(latencies):.2f} ms, "
+                    f"max {latencies[-1]:.2f} ms; LIKE scan {statistics.median(scans):.1f} ms"
+                )
+
+    asyncio.run(main())
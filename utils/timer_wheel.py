@@ -0,0 +1,345 @@
+"""
+A hierarchical timer wheel shared by every running game.
+
+Question and round deadlines of all sessions are registered with one
+`TimerWheel`, driven by a single loop callback on the event loop's monotonic
+clock, instead of each `wait_for` arming and cancelling its own loop timer.
+Timers are kept in buckets of `SLOTS` ticks per level, like the Linux kernel's
+timer wheel: scheduling, cancelling and rescheduling a timer is O(1), and a
+timer fires on the first tick at or after its deadline, so deadlines are late
+by less than a tick plus whatever the event loop itself is late by.
+
+The loop callback is armed for the next tick with work to do, a non-empty slot
+of the lowest level or a cascade from a higher one, and skips the empty ticks
+in between: with deadlines seconds apart, the wheel wakes up a few times per
+second, not once per tick.
+"""
+import asyncio
+import logging
+import math
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+TICK = 0.001  # seconds
+BITS = 8
+SLOTS = 1 << BITS  # slots per level
+MASK = SLOTS - 1
+LEVELS = 4  # range of SLOTS ** LEVELS ticks, about 50 days
+
+log = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "wheel", "_slot")
+
+    def __init__(self, wheel: "TimerWheel", deadline: int, callback: Callable[[], Any]):
+        self.wheel = wheel
+        self.deadline = deadline  # tick
+        self.callback = callback
+        self._slot: Optional[dict["Timer", None]] = None
+
+    @property
+    def active(self) -> bool:
+        return self._slot is not None
+
+    def cancel(self):
+        """Stop the timer from firing. Does nothing if it already fired or was cancelled."""
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self.wheel.count -= 1
+
+    def reschedule(self, delay: float):
+        """Fire `delay` seconds from now instead, even if the timer already fired or was cancelled."""
+        self.cancel()
+        self.deadline = self.wheel.tick_of(self.wheel.time() + delay)
+        self.wheel._insert(self)
+
+
+class TimerWheel:
+    def __init__(self, tick: float = TICK):
+        """
+        Timers with a resolution of `tick` seconds, on the running event loop's clock.
+
+        Must be used from a single event loop.
+        """
+        self.tick = tick
+        self.count = 0  # active timers
+        self.fired = 0
+        self.wakeups = 0  # runs of the loop callback
+        self._levels: list[list[dict[Timer, None]]] = [
+            [{} for _ in range(SLOTS)] for _ in range(LEVELS)
+        ]
+        self._start: Optional[float] = None
+        self._now = 0  # last processed tick
+        self._handle: Optional[asyncio.TimerHandle] = None
+        # the tick `_handle` runs on: no tick before it has timers to fire or cascade
+        self._armed = 0
+        self._driving = False
+
+    def __len__(self) -> int:
+        return self.count
+
+    def time(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def tick_of(self, when: float) -> int:
+        """The first tick at or after loop time `when`."""
+        if self._start is None:
+            self._start = self.time()
+        return math.ceil((when - self._start) / self.tick)
+
+    def _passed(self) -> int:
+        """The last tick whose time has come."""
+        assert self._start is not None
+        return math.floor((self.time() - self._start) / self.tick)
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> Timer:
+        """Call `callback` in `delay` seconds. Returns a `Timer` that can cancel it."""
+        timer = Timer(self, self.tick_of(self.time() + delay), callback)
+        self._insert(timer)
+        return timer
+
+    def _insert(self, timer: Timer):
+        if not self._driving:
+            # catch up without walking the ticks that passed, all empty
+            passed = self._passed()
+            if self._handle is not None:
+                passed = min(passed, self._armed - 1)
+            self._now = max(self._now, passed)
+        deadline = max(timer.deadline, self._now + 1)
+        delta = deadline - self._now
+        for level in range(LEVELS):
+            if delta < 1 << (BITS * (level + 1)) or level == LEVELS - 1:
+                slot = self._levels[level][(deadline >> (BITS * level)) & MASK]
+                break
+        slot[timer] = None
+        timer._slot = slot
+        self.count += 1
+        if not self._driving:
+            # the timer's tick, or no later than its cascade to the level below
+            due = deadline
+            if level:
+                due = min(due, ((self._now >> (BITS * level)) + 1) << (BITS * level))
+            if self._handle is None or due < self._armed:
+                self._arm(due)
+
+    def _cascades(self, tick: int) -> bool:
+        """Whether processing `tick` moves timers down from a higher level."""
+        for level in range(1, LEVELS):
+            if tick & ((1 << (BITS * level)) - 1):
+                return False
+            if self._levels[level][(tick >> (BITS * level)) & MASK]:
+                return True
+        return False
+
+    def _next(self) -> int:
+        """The next tick with timers to fire or cascade, or a tick before it."""
+        levels = self._levels
+        tick = self._now
+        for tick in range(self._now + 1, self._now + SLOTS + 1):
+            if levels[0][tick & MASK] or (not tick & MASK and self._cascades(tick)):
+                return tick
+        # the lowest level is empty: nothing is due before a cascade, which
+        # only happens on a multiple of SLOTS
+        tick = ((tick >> BITS) + 1) << BITS
+        for _ in range(SLOTS):
+            if self._cascades(tick):
+                return tick
+            tick += SLOTS
+        return tick  # far away: wake up to look again
+
+    def _advance(self):
+        """Process the next tick: cascade higher levels down, then fire the due timers."""
+        self._now += 1
+        now = self._now
+        for level in range(1, LEVELS):
+            if now & ((1 << (BITS * level)) - 1):
+                break
+            slot = self._levels[level][(now >> (BITS * level)) & (SLOTS - 1)]
+            timers = list(slot)
+            slot.clear()
+            self.count -= len(timers)
+            for timer in timers:
+                self._insert(timer)
+
+        slot = self._levels[0][now & MASK]
+        while slot:
+            timer = next(iter(slot))
+            timer.cancel()
+            if timer.deadline > now:  # parked in the top level, not due yet
+                self._insert(timer)
+                continue
+            self.fired += 1
+            try:
+                timer.callback()
+            except Exception:
+                log.exception("timer callback failed")
+
+    def _arm(self, tick: int):
+        assert self._start is not None
+        if self._handle is not None:
+            self._handle.cancel()
+        self._armed = tick
+        self._handle = asyncio.get_running_loop().call_at(
+            self._start + tick * self.tick, self._drive
+        )
+
+    def _drive(self):
+        self.wakeups += 1
+        self._handle = None
+        # timers inserted while advancing, by a cascade or a callback, are
+        # found by `_next` instead of arming the handle each
+        self._driving = True
+        try:
+            target = self._passed()
+            while self.count and (tick := self._next()) <= target:
+                self._now = tick - 1
+                self._advance()
+            self._now = max(self._now, target)
+        finally:
+            self._driving = False
+        if self.count:
+            self._arm(self._next())
+
+
+class WheelClock:
+    """A session `Clock` whose deadlines are timers on a shared `TimerWheel`."""
+
+    def __init__(self, wheel: TimerWheel):
+        self.wheel = wheel
+
+    def time(self) -> float:
+        return self.wheel.time()
+
+    async def sleep(self, delay: float) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        timer = self.wheel.call_later(delay, lambda: _wake(waiter))
+        try:
+            await waiter
+        finally:
+            timer.cancel()
+
+    async def wait_for(self, aw: Awaitable[T], timeout: Optional[float]) -> T:
+        if timeout is None:
+            return await aw
+        task = asyncio.ensure_future(aw)
+        if timeout <= 0:
+            await asyncio.sleep(0)
+            if not task.done():
+                task.cancel()
+                raise asyncio.TimeoutError
+            return task.result()
+
+        waiter = asyncio.get_running_loop().create_future()
+        timer = self.wheel.call_later(timeout, lambda: _wake(waiter))
+        task.add_done_callback(lambda _: _wake(waiter))
+        try:
+            await waiter
+        except BaseException:
+            task.cancel()
+            raise
+        finally:
+            timer.cancel()
+        if task.done():
+            return task.result()
+        task.cancel()
+        raise asyncio.TimeoutError
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+if __name__ == "__main__":
+    # Benchmark: 10k concurrent sessions waiting for answers with question
+    # deadlines, with asyncio.wait_for per question and with the shared wheel.
+    import random
+    import statistics
+    import time
+
+    from utils.rounds.session import LoopClock
+
+    SESSIONS = 10_000
+    QUESTIONS = 4
+
+    async def check():
+        # timers spanning several levels never fire early; cancelled ones never fire
+        wheel = TimerWheel(tick=0.001)
+        loop = asyncio.get_running_loop()
+        late: list[float] = []
+        dues: list[float] = []
+        timers = []
+        for i in range(2000):
+            delay = random.choice((random.uniform(0, 0.2), random.uniform(0.2, 1.5)))
+            dues.append(loop.time() + delay)
+            timers.append(
+                wheel.call_later(delay, lambda i=i: late.append(loop.time() - dues[i]))
+            )
+        for timer in timers[::4]:
+            timer.cancel()
+        for i in range(1, len(timers), 4):
+            dues[i] = loop.time() + 0.3
+            timers[i].reschedule(0.3)
+        await asyncio.sleep(1.7)
+        assert len(late) == 1500 and len(wheel) == 0, (len(late), len(wheel))
+        assert min(late) >= 0, min(late)
+        print(f"2000 timers, max lateness {max(late) * 1000:.1f} ms")
+
+    async def session(clock, rng: random.Random, jitter: list[float]):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        for _ in range(QUESTIONS):
+            timeout = rng.uniform(1.0, 3.0)
+            if rng.random() < 0.5:  # someone answers before the deadline
+                loop.call_later(rng.uniform(0, timeout * 0.8), queue.put_nowait, "x")
+            deadline = loop.time() + timeout
+            try:
+                await clock.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                jitter.append(loop.time() - deadline)
+
+    async def run(name: str, clock):
+        rng = random.Random(1)
+        jitter: list[float] = []
+        started = time.perf_counter()
+        cpu = time.process_time()
+        await asyncio.gather(*(session(clock, rng, jitter) for _ in range(SESSIONS)))
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu
+        jitter.sort()
+        print(
+            f"{name:>12}: {len(jitter)} timeouts, jitter "
+            f"p50 {statistics.median(jitter) * 1000:.1f} ms, "
+            f"p99 {jitter[int(len(jitter) * 0.99)] * 1000:.1f} ms, "
+            f"max {jitter[-1] * 1000:.1f} ms, stdev {statistics.stdev(jitter) * 1000:.1f} ms; "
+            f"{elapsed:.2f}s wall, {cpu:.2f}s CPU"
+        )
+
+    async def idle():
+        # one game waiting on a question deadline: the wheel must not poll
+        wheel = TimerWheel()
+        timer = wheel.call_later(10, lambda: None)
+        started = time.perf_counter()
+        await asyncio.sleep(2)
+        rate = wheel.wakeups / (time.perf_counter() - started)
+        timer.cancel()
+        assert rate < 10, rate
+        print(f"idle wheel with a 10 s deadline pending: {rate:.1f} wakeups/s")
+
+    async def main():
+        await check()
+        await idle()
+        await run("wait_for", LoopClock())
+        wheel = TimerWheel()
+        started = time.perf_counter()
+        await run("timer wheel", WheelClock(wheel))
+        rate = wheel.wakeups / (time.perf_counter() - started)
+        print(
+            f"{'':>12}  {wheel.fired} timers fired on the wheel, "
+            f"{wheel.wakeups} wakeups ({rate:.0f}/s)"
+        )
+
+    asyncio.run(main())
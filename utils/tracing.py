@@ -0,0 +1,269 @@
+"""
+Tracing of slash commands and an on-demand sampling profiler.
+
+Every command wrapped by `transform_context` runs in a trace: a root span with
+sub-spans for the database reads/transactions and Discord HTTP requests made
+while handling it. The current span is held in a context variable, so tasks
+started by a command attach their spans to it. Outside of a trace, `span` does
+nothing. Finished traces are kept in `recent` and logged to the
+"mountain.tracing" logger.
+
+A command that goes on after answering its interaction, like /start running a
+game, `finish`es its trace there; the game traces each of its questions, kept
+apart in `recent_questions` so that busy games don't push out the commands.
+
+`sample_stacks` samples the stack of a thread at a fixed interval and returns
+the counts in the collapsed-stack format read by flamegraph.pl and speedscope.
+"""
+import collections
+import contextlib
+import contextvars
+import logging
+import sys
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+RECENT_TRACES = 50
+SLOW_TRACE = 1.0  # seconds, traces taking longer are logged at INFO level
+SAMPLE_INTERVAL = 0.005  # seconds between profiler samples
+
+log = logging.getLogger("mountain.tracing")
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "children", "error")
+
+    def __init__(self, name: str, attrs: dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: list["Span"] = []
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def format(self, depth: int = 0) -> Iterator[str]:
+        """Lines describing this span and its children, indented by depth."""
+        attrs = " ".join(f"{k}={v}" for (k, v) in self.attrs.items())
+        error = f" !{self.error}" if self.error else ""
+        yield (
+            f"{'  ' * depth}{self.name} {self.duration * 1000:.1f} ms"
+            f"{' ' + attrs if attrs else ''}{error}"
+        )
+        for child in self.children:
+            yield from child.format(depth + 1)
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "span", default=None
+)
+recent: collections.deque[Span] = collections.deque(maxlen=RECENT_TRACES)
+recent_questions: collections.deque[Span] = collections.deque(maxlen=RECENT_TRACES)
+
+
+@contextlib.contextmanager
+def trace(
+    name: str, *, keep: collections.deque[Span] = recent, **attrs: Any
+) -> Iterator[Span]:
+    """Run the `with` block in a new trace named `name`, kept in `keep` once finished."""
+    root = Span(name, attrs)
+    token = _current.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        if root.end is None:
+            root.error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        if root.end is None:
+            _record(root, keep)
+
+
+def finish(root: Span, keep: collections.deque[Span] = recent):
+    """
+    End the trace of `root` before its `with` block does. Spans started
+    afterwards in the block aren't recorded.
+    """
+    if root.end is None:
+        _current.set(None)
+        _record(root, keep)
+
+
+def _record(root: Span, keep: collections.deque[Span]):
+    root.end = time.perf_counter()
+    keep.append(root)
+    level = logging.INFO if root.duration >= SLOW_TRACE else logging.DEBUG
+    if log.isEnabledFor(level):
+        log.log(level, "\n".join(root.format()))
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """Record the `with` block as a sub-span of the current span, if there is one."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def resume(parent: Optional[Span]) -> Iterator[None]:
+    """
+    Make `parent` the current span in the `with` block.
+
+    For work done on behalf of a command by a task that outlives it or serves
+    several commands, like a channel's outbox.
+    """
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def instrument_http(adapter: Any):
+    """
+    Record the requests made through `adapter` as spans.
+
+    `adapter` is a discord.py `HTTPClient` or webhook adapter (used for
+    interaction responses), whose `request` method takes a `Route` first.
+    """
+    request = adapter.request
+
+    async def traced_request(route, *args, **kwargs):
+        if _current.get() is None:
+            return await request(route, *args, **kwargs)
+        with span(f"http {route.method} {route.path}"):
+            return await request(route, *args, **kwargs)
+
+    adapter.request = traced_request
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(
+    seconds: float, thread_id: int, interval: float = SAMPLE_INTERVAL
+) -> str:
+    """
+    Sample the stack of thread `thread_id` every `interval` seconds for `seconds` seconds.
+
+    Blocks, so run it in another thread than the one being sampled.
+
+    Returns
+    -------
+    One line per distinct stack, "outer;...;inner count", most frequent first.
+    """
+    counts: collections.Counter[str] = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        counts[_collapse(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for (stack, count) in counts.most_common())
+
+
+if __name__ == "__main__":
+    # Cost of spans inside and outside of a trace, and a profile of a busy loop.
+    import asyncio
+
+    N = 100_000
+
+    started = time.perf_counter()
+    for _ in range(N):
+        with span("db.read"):
+            pass
+    untraced = (time.perf_counter() - started) / N
+
+    with trace("bench") as root:
+        started = time.perf_counter()
+        for _ in range(N):
+            with span("db.read", statement="load_start_deck"):
+                pass
+        traced = (time.perf_counter() - started) / N
+    assert len(root.children) == N
+    print(f"span outside a trace {untraced * 1e9:.0f} ns, inside {traced * 1e9:.0f} ns")
+
+    async def command():
+        async def query():
+            with span("db.read", statement="get_asset"):
+                await asyncio.sleep(0.01)
+
+        with trace("start", user=1) as root:
+            with span("http POST /channels/{channel_id}/messages"):
+                await asyncio.sleep(0.02)
+            await asyncio.gather(query(), query())
+            parent = current()
+        with resume(parent), span("outbox.send"):
+            pass
+        return root
+
+    root = asyncio.run(command())
+    print("\n".join(root.format()))
+    assert [c.name for c in root.children] == [
+        "http POST /channels/{channel_id}/messages",
+        "db.read",
+        "db.read",
+        "outbox.send",
+    ]
+
+    async def game():
+        with trace("start") as root:
+            with span("http POST /interactions/{interaction_id}/{token}/callback"):
+                pass
+            finish(root)
+            with span("lobby"):
+                await asyncio.sleep(0.01)
+        return root
+
+    root = asyncio.run(game())
+    assert [c.name for c in root.children] == [
+        "http POST /interactions/{interaction_id}/{token}/callback"
+    ]
+    assert root.duration < 0.01 and recent.count(root) == 1
+    for number in range(2 * RECENT_TRACES):
+        with trace("question", keep=recent_questions, number=number):
+            pass
+    assert root in recent and len(recent_questions) == RECENT_TRACES
+
+    def busy(seconds: float):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            sum(range(1000))
+
+    thread_id = threading.get_ident()
+    sampler = threading.Thread(
+        target=lambda: print(sample_stacks(0.5, thread_id), end="")
+    )
+    sampler.start()
+    busy(0.6)
+    sampler.join()
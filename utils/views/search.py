@@ -0,0 +1,62 @@
+import discord
+
+from utils.context import Context
+from utils.database import Database
+from utils.search import MAX_RESULTS, SearchPage, search_questions, snippet
+
+
+def results_embed(page: SearchPage) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Kết quả tìm kiếm: {page.query}"[:256], color=discord.Color.blue()
+    )
+    for hit in page.hits:
+        embed.add_field(
+            name=f"{hit.round} · bộ đề {hit.pack_id} · #{hit.id}",
+            value=(
+                f"{snippet(hit.question, page.terms)}\n"
+                f"**Đáp án:** {snippet(hit.answer, page.terms, 60)}"
+            )[:1024],
+            inline=False,
+        )
+    total = f"{page.total}+" if page.total >= MAX_RESULTS else str(page.total)
+    embed.set_footer(text=f"Trang {page.page + 1}/{page.pages} · {total} câu hỏi")
+    return embed
+
+
+class SearchMenu(discord.ui.View):
+    def __init__(self, ctx: Context, db: Database, page: SearchPage, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ctx = ctx
+        self.db = db
+        self.page = page
+        self.previous = SearchPageButton(-1, "◀")
+        self.next = SearchPageButton(1, "▶")
+        self.add_item(self.previous)
+        self.add_item(self.next)
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous.disabled = self.page.page == 0
+        self.next.disabled = self.page.page >= self.page.pages - 1
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True  # type: ignore
+        await self.ctx.edit(view=self)
+
+
+class SearchPageButton(discord.ui.Button["SearchMenu"]):
+    view: SearchMenu
+
+    def __init__(self, step: int, label: str):
+        super().__init__(style=discord.ButtonStyle.secondary, label=label)
+        self.step = step
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        page = self.view.page
+        self.view.page = await search_questions(
+            self.view.db, page.query, page.page + self.step, page.per_page
+        )
+        self.view.update_buttons()
+        await self.view.ctx.edit(embed=results_embed(self.view.page), view=self.view)
@@ -16,7 +16,7 @@ class StartingMenu(discord.ui.View):
     async def on_timeout(self):
         for child in self.children:
             child.disabled = True  # type: ignore
-        await self.ctx.respond_or_edit(view=self)
+        await self.ctx.edit_coalesced(view=self)
 
 
 class StartingButton(discord.ui.Button["StartingMenu"]):
@@ -26,6 +26,8 @@ class StartingButton(discord.ui.Button["StartingMenu"]):
         super().__init__(style=discord.ButtonStyle.primary, label="Tham gia")
 
     async def callback(self, interaction: discord.Interaction):
+        # acknowledge the click now, the lobby is updated by a coalesced edit
+        await interaction.response.defer()
         self.view.players[interaction.user.id] = interaction.user.display_name
 
         assert interaction.message is not None
@@ -36,4 +38,4 @@ class StartingButton(discord.ui.Button["StartingMenu"]):
             self.disabled = True
             self.view.stop()
 
-        await interaction.response.edit_message(embed=embed)
+        await self.view.ctx.edit_coalesced(embed=embed)